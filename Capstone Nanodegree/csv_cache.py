@@ -0,0 +1,117 @@
+'''
+Parsed-input cache of the airbnb csvs.
+
+The csvs are parsed once with the multithreaded pyarrow reader, the five
+files concurrently, every column as a string like the spark csv reader
+returns them (data_types casts them afterwards). Each parsed file is
+kept as parquet in the cache directory under the hash of its content and
+of its column spec, so a re-run after a code change reads the parquet
+instead of parsing the csv again, while a csv or a spec that changed
+is parsed again because the hash differs. The spark stage reads the cached parquet with spark.read.parquet.
+
+Only local input can be cached, etl.py falls back to reading the csvs
+with spark for any other input path.
+'''
+import csv
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+
+from schemas import CALENDAR_COLUMNS, REVIEWS_COLUMNS, HOODS_COLUMNS
+
+CACHE_DIR = '.csv_cache'
+WORKERS = 5
+HASH_CHUNK = 8 * 1024 * 1024
+
+# name -> (csv file, column spec), the listings have no spec and keep their header names
+CSV_FILES = [
+    ('calendar', 'calendar.csv', CALENDAR_COLUMNS),
+    ('listings_detailed', 'listings_detailed.csv', None),
+    ('listings', 'listings.csv', None),
+    ('neighbourhoods', 'neighbourhoods.csv', HOODS_COLUMNS),
+    ('reviews_detailed', 'reviews_detailed.csv', REVIEWS_COLUMNS),
+]
+
+
+def is_local(path):
+    return '://' not in path or path.startswith('file://')
+
+
+def local_path(path):
+    return path[len('file://'):] if path.startswith('file://') else path
+
+
+def file_hash(path):
+    '''
+    blake2b of the content of a file, read in chunks
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def columns_hash(columns):
+    '''
+    blake2b of a column spec, the csv header is used without one
+    '''
+    return hashlib.blake2b(repr(columns).encode('utf8'), digest_size=8).hexdigest()
+
+
+def parse_csv(path, columns=None):
+    '''
+    parses a csv into an arrow table of string columns. the column names come
+    from the spec when given (matched by position) or from the header, empty
+    values are null and quoted values may hold line breaks, like csv_options
+    '''
+    if columns is None:
+        with open(path, newline='', encoding='utf8') as f:
+            names = next(csv.reader(f))
+    else:
+        names = [name for name, kind in columns]
+
+    return pv.read_csv(path,
+                       read_options=pv.ReadOptions(column_names=names, skip_rows=1, use_threads=True),
+                       parse_options=pv.ParseOptions(newlines_in_values=True),
+                       convert_options=pv.ConvertOptions(column_types={name: pa.string() for name in names},
+                                                         strings_can_be_null=True))
+
+
+def cache_csv(path, name, columns, cache_dir=CACHE_DIR):
+    '''
+    returns the parquet file of a csv, parsing and writing it unless the
+    cache already has one for the current content and column spec of the csv
+    '''
+    cached = os.path.join(cache_dir, '{}-{}-{}.parquet'.format(name, file_hash(path), columns_hash(columns)))
+    if os.path.exists(cached):
+        print('{}: cached'.format(name))
+        return cached
+
+    table = parse_csv(path, columns)
+    pq.write_table(table, cached + '.tmp')
+    os.replace(cached + '.tmp', cached)
+    # entries of an older version of the csv or of the spec are not needed any more
+    for entry in os.listdir(cache_dir):
+        if entry.startswith(name + '-') and os.path.join(cache_dir, entry) != cached:
+            os.remove(os.path.join(cache_dir, entry))
+    print('{}: parsed {} rows'.format(name, table.num_rows))
+    return cached
+
+
+def cache_csvs(input_data, cache_dir=CACHE_DIR, workers=WORKERS):
+    '''
+    hashes and, where needed, parses every csv of CSV_FILES concurrently.
+    returns the parquet file of each csv by name
+    '''
+    os.makedirs(cache_dir, exist_ok=True)
+    input_data = local_path(input_data)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {name: pool.submit(cache_csv, os.path.join(input_data, filename), name, columns, cache_dir)
+                   for name, filename, columns in CSV_FILES}
+        return {name: future.result() for name, future in futures.items()}
+
@@ -1,231 +1,217 @@
 # All imports and installs here
-import pandas as pd
-import numpy as np
-import configparser
 from datetime import datetime
-import os
+import sys
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import udf, col
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
 from pyspark.sql import functions as F
-from pyspark.sql import types as T
 from pyspark.sql.functions import monotonically_increasing_id, row_number, desc
 from pyspark.sql.window import Window
-from pyspark.sql.types import IntegerType, TimestampType, StructType, StructField, StringType, DateType, BooleanType, DecimalType, DoubleType
 
-output_bucket = "s3a://udacitycapstone123/" #destination s3 bucket
+from storage import get_storage, configure_builder
+from quality import write_with_stats, verify_table, sampled_checksum
+from csv_cache import cache_csvs, is_local
+from geo import with_geohash
+from schemas import (LISTING_COLUMNS, CALENDAR_COLUMNS, REVIEWS_COLUMNS, HOODS_COLUMNS,
+                     spark_schema, cast_columns)
 
-def configure_spark():
+def configure_spark(storage):
     '''
     this function configures the spark builder 
-    and configs the environment to work with aws
+    for the storage backend (s3, minio or local) read from creds.cfg
     '''
-    # Read in the configuration information
-    config = configparser.ConfigParser()
-    config.read_file(open('creds.cfg'))
-    
-    # Get the AWS access keys from the configuration file
-    KEY = config.get('AWS','KEY')
-    SECRET = config.get('AWS','SECRET')
-
-    # Set the AWS access keys as environment variables
-    os.environ['AWS_ACCESS_KEY_ID']=KEY
-    os.environ['AWS_SECRET_ACCESS_KEY']=SECRET
-
     # Set up the Spark session
-    spark = SparkSession \
+    builder = SparkSession \
             .builder \
-            .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
             .config("spark.executor.instances", 10) \
-            .config("spark.executor.memory", "8g") \
-            .getOrCreate()
+            .config("spark.executor.memory", "8g")
+    spark = configure_builder(builder, storage).getOrCreate()
+    return spark
 
-def read_csvs(calendar_csv, list_det_csv, list_csv, hoods_csv, reviews_csv):
+#the airbnb csvs have free text with quotes and line breaks in it
+csv_options = {'header': 'true', 'sep': ',', 'multiLine': 'true', 'escape': '"'}
+
+def read_csvs(spark, input_data, use_cache=True):
     '''
     reads the csvs needed for this project
-    and return them as pandas dataframes
+    and return them as spark dataframes.
+    local csvs are parsed once into the parquet cache of csv_cache
+    and read from there, every column is a string either way
     '''
+    if use_cache and is_local(input_data):
+        cached = cache_csvs(input_data)
+        return tuple(spark.read.parquet(cached[name])
+                     for name in ['calendar', 'listings_detailed', 'listings', 'neighbourhoods', 'reviews_detailed'])
+
     #read local path into variables
-    calendar_csv = 'airbnb_data/calendar.csv'
-    list_det_csv = 'airbnb_data/listings_detailed.csv'
-    list_csv = 'airbnb_data/listings.csv'
-    hoods_csv = 'airbnb_data/neighbourhoods.csv'
-    reviews_csv = 'airbnb_data/reviews_detailed.csv'
+    calendar_csv = input_data + 'calendar.csv'
+    list_det_csv = input_data + 'listings_detailed.csv'
+    list_csv = input_data + 'listings.csv'
+    hoods_csv = input_data + 'neighbourhoods.csv'
+    reviews_csv = input_data + 'reviews_detailed.csv'
     
-    #read csvs into pandas dataframe
-    calendar_df = pd.read_csv(calendar_csv)
-    list_det_df = pd.read_csv(list_det_csv)
-    list_df = pd.read_csv(list_csv)
-    hoods_df = pd.read_csv(hoods_csv)
-    reviews_df = pd.read_csv(reviews_csv)
+    #read csvs into spark dataframes, every column stays a string until data_types
+    calendar_df = spark.read.options(**csv_options).csv(calendar_csv, schema=spark_schema(CALENDAR_COLUMNS, raw=True))
+    list_det_df = spark.read.options(**csv_options).csv(list_det_csv)
+    list_df = spark.read.options(**csv_options).csv(list_csv)
+    hoods_df = spark.read.options(**csv_options).csv(hoods_csv, schema=spark_schema(HOODS_COLUMNS, raw=True))
+    reviews_df = spark.read.options(**csv_options).csv(reviews_csv, schema=spark_schema(REVIEWS_COLUMNS, raw=True))
     return calendar_df, list_det_df, list_df, hoods_df, reviews_df
 
+def merge_listings(list_det_df, list_df):
+    '''
+    left joins the summary listings onto the detailed listings.
+    columns present in both are resolved by name, keeping the detailed
+    value and falling back to the summary one, so no duplicate columns
+    (and no _x/_y suffixes) are created
+    '''
+    det = list_det_df.alias('det')
+    summary = list_df.alias('summary')
+    shared = [c for c in list_df.columns if c in list_det_df.columns and c != 'id']
+    extra = [c for c in list_df.columns if c not in list_det_df.columns]
+
+    columns = []
+    for c in list_det_df.columns:
+        if c in shared:
+            columns.append(F.coalesce(col('det.' + c), col('summary.' + c)).alias(c))
+        else:
+            columns.append(col('det.' + c))
+    columns += [col('summary.' + c) for c in extra]
+
+    return det.join(summary, col('det.id') == col('summary.id'), how='left').select(columns)
+
 def data_cleaning(calendar_df, reviews_df, list_df, list_det_df, hoods_df):
     '''
     performs the data cleaning steps identified
     and needed in the etl notebook
     '''
-    # Rename the 'price' column in the calendar dataframe
-    calendar_df = calendar_df.rename(columns={'price': 'requested_price'})
-
     # Drop certain columns from the list_det_df dataframe
-    list_det_df = list_det_df.drop(['maximum_nights','minimum_nights','price'], axis=1)
+    list_det_df = list_det_df.drop('maximum_nights','minimum_nights','price')
 
-    # Merge the two listing dataframes to create a single dataframe
-    listing_df = pd.merge(list_det_df, list_df,  how='left', left_on=['id'], right_on = ['id'])
-
-    # Transpose the dataframe and drop duplicate columns
-    listing_df_transposed = listing_df.T
-    listing_df_unique = listing_df_transposed.drop_duplicates()
-
-    # Transpose the dataframe back to its original shape
-    listing_df = listing_df_unique.T
-
-    # Remove the suffix _x generated by column duplication
-    suffix = '_x'
-    listing_df = listing_df.rename(columns={col: col.replace(suffix, '') for col in listing_df.columns})
+    # Merge the two listing dataframes to create a single dataframe without duplicate columns
+    listing_df = merge_listings(list_det_df, list_df)
 
     # Cleaning the Listing by dropping null columns, fillin nas, and replacing 0 to nans where is needed
-    listing_df = listing_df.drop('bathrooms',axis=1)
-    listing_df = listing_df.fillna('')
-    listing_df['price'] = listing_df['price'].replace('$', '')
+    listing_df = listing_df.drop('bathrooms')
     null_to_zero = ['bedrooms','beds','review_scores_rating','review_scores_accuracy','review_scores_cleanliness',
                     'review_scores_checkin','reviews_per_month','review_scores_communication','review_scores_location','review_scores_value']
-    for i in null_to_zero:
-        listing_df[i] = listing_df[i].replace('', 0)
-
-    # Print the number of duplicate rows in each dataframe
-    duplicate_listing_id = listing_df[listing_df.duplicated(['id'])]['id'].count()
-    print("Number of duplicate listing_ids in listing: ", duplicate_listing_id)
+    listing_df = listing_df.na.fill('0', subset=null_to_zero)
+    listing_df = listing_df.na.fill('')
 
-    duplicate_review_id = reviews_df[reviews_df.duplicated(['id'])]['id'].count()
-    print("Number of duplicate ids in review: ", duplicate_review_id)
+    # the reporting below runs several actions on each dataframe, cache them so
+    # the multiLine csvs are parsed once for all of them instead of once per action
+    cached = [listing_df.cache(), calendar_df.cache(), reviews_df.cache()]
 
-    duplicate_neighbourhood_group = hoods_df[hoods_df.duplicated(['neighbourhood'])]['neighbourhood'].count()
-    print("Number of duplicate neighbourhood_group in hoods_df: ", duplicate_neighbourhood_group)
+    # Print the number of duplicate rows in each dataframe
+    for name, df, key in [('listing_ids in listing', listing_df, 'id'),
+                          ('ids in review', reviews_df, 'id'),
+                          ('neighbourhood_group in hoods_df', hoods_df, 'neighbourhood')]:
+        counts = df.agg(F.count(key).alias('total'), F.countDistinct(key).alias('distinct')).first()
+        print("Number of duplicate {}: ".format(name), counts['total'] - counts['distinct'])
 
-    # Calculate the percentage of missing values in each column of each dataframe
+    # Calculate the percentage of missing values in each column of each dataframe, one pass per dataframe
     dfs = [listing_df,calendar_df,reviews_df,hoods_df]
     for df in dfs:
-        for col in df.columns:
-            pct_missing = np.mean(df[col].isnull())
-            print('{} - {}%'.format(col, round(pct_missing*100)))
-            
-            
-def data_types(listing_df):
+        pct_missing = df.agg(*[F.avg(col(c).isNull().cast('int')).alias(c) for c in df.columns]).first()
+        for c in df.columns:
+            print('{} - {}%'.format(c, round((pct_missing[c] or 0)*100)))
+
+    for df in cached:
+        df.unpersist()
+
+    return calendar_df, reviews_df, listing_df, hoods_df
+
+def data_types(listing_df, calendar_df, reviews_df, hoods_df):
     '''
     impart the correct data type to the dataframes before writing to S3.
-    For listing_df this is done manually, as turns spark dataframe from pandas dataframe,
-    for the other I define a spark schema to be passed later
+    the types of every csv are declared once in schemas.py, each dataframe is cast
+    in a single select. also returns the values that could not be cast, per csv
+    and column, for the data quality report
     '''
-    #manual conversion for listing_df fields
-    listing_df['id'] = listing_df['id'].astype('int32')
-    listing_df['listing_url'] = listing_df['listing_url'].astype('str')
-    listing_df['scrape_id'] = listing_df['scrape_id'].astype('int32')
-    listing_df['last_scraped'] = pd.to_datetime(listing_df['last_scraped'])
-    listing_df['source'] = listing_df['source'].astype('str')
-    listing_df['name'] = listing_df['name'].astype('str')
-    listing_df['description'] = listing_df['description'].astype('str')
-    listing_df['neighborhood_overview'] = listing_df['neighborhood_overview'].astype('str')
-    listing_df['picture_url'] = listing_df['picture_url'].astype('str')
-    listing_df['host_id'] = listing_df['host_id'].astype('int32')
-    listing_df['host_url'] = listing_df['host_url'].astype('str')
-    listing_df['host_name'] = listing_df['host_name'].astype('str')
-    listing_df['host_since'] = pd.to_datetime(listing_df['host_since'])
-    listing_df['host_location'] = listing_df['host_location'].astype('str')
-    listing_df['host_about'] = listing_df['host_about'].astype('str')
-    listing_df['host_response_time'] = listing_df['host_response_time'].astype('str')
-    listing_df['host_response_rate'] = listing_df['host_response_rate'].astype('str')
-    listing_df['host_acceptance_rate'] = listing_df['host_acceptance_rate'].astype('str')
-    listing_df['host_is_superhost'] = listing_df['host_is_superhost'].astype('str')
-    listing_df['host_thumbnail_url'] = listing_df['host_thumbnail_url'].astype('str')
-    listing_df['host_picture_url'] = listing_df['host_picture_url'].astype('str')
-    listing_df['host_neighbourhood'] = listing_df['host_neighbourhood'].astype('str')
-    listing_df['host_listings_count'] = listing_df['host_listings_count'].astype('str')
-    listing_df['host_total_listings_count'] = listing_df['host_total_listings_count'].astype('str')
-    listing_df['host_verifications'] = listing_df['host_verifications'].astype('str')
-    listing_df['host_has_profile_pic'] = listing_df['host_has_profile_pic'].astype('str')
-    listing_df['host_identity_verified'] = listing_df['host_identity_verified'].astype('str')
-    listing_df['neighbourhood'] = listing_df['neighbourhood'].astype('str')
-    listing_df['neighbourhood_cleansed'] = listing_df['neighbourhood_cleansed'].astype('str')
-    listing_df['neighbourhood_group_cleansed'] = listing_df['neighbourhood_group_cleansed'].astype('str')
-    listing_df['latitude'] = listing_df['latitude'].astype('float')
-    listing_df['longitude'] = listing_df['longitude'].astype('float')
-    listing_df['property_type'] = listing_df['property_type'].astype('str')
-    listing_df['room_type'] = listing_df['room_type'].astype('str')
-    listing_df['accommodates'] = listing_df['accommodates'].astype('int32')
-    listing_df['bathrooms_text'] = listing_df['bathrooms_text'].astype('str')
-    listing_df['bedrooms'] = listing_df['bedrooms'].astype('str')
-    listing_df['beds'] = listing_df['beds'].astype('int32')
-    listing_df['amenities'] = listing_df['amenities'].astype('str')
-    listing_df['price'] = listing_df['price'].replace('$', '', regex=True).astype('float', errors='ignore')
-    listing_df['minimum_minimum_nights'] = listing_df['minimum_minimum_nights'].astype('int32')
-    listing_df['maximum_minimum_nights'] = listing_df['maximum_minimum_nights'].astype('int32')
-    listing_df['minimum_maximum_nights'] = listing_df['minimum_maximum_nights'].astype('int32')
-    listing_df['maximum_maximum_nights'] = listing_df['maximum_maximum_nights'].astype('int32')
-    listing_df['minimum_nights_avg_ntm'] = listing_df['minimum_nights_avg_ntm'].astype('int32')
-    listing_df['maximum_nights_avg_ntm'] = listing_df['maximum_nights_avg_ntm'].astype('int32')
-    listing_df['has_availability'] = listing_df['has_availability'].astype('str')
-    listing_df['availability_30'] = listing_df['availability_30'].astype('int32')
-    listing_df['availability_60'] = listing_df['availability_60'].astype('int32')
-    listing_df['availability_90'] = listing_df['availability_90'].astype('int32')
-    listing_df['availability_365'] = listing_df['availability_365'].astype('int32')
-    listing_df['number_of_reviews'] = listing_df['number_of_reviews'].astype('int32')
-    listing_df['number_of_reviews_ltm'] = listing_df['number_of_reviews_ltm'].astype('int32')
-    listing_df['number_of_reviews_l30d'] = listing_df['number_of_reviews_l30d'].astype('int32')
-    listing_df['first_review'] = pd.to_datetime(listing_df['first_review'])
-    listing_df['last_review'] = pd.to_datetime(listing_df['last_review'])
-    listing_df['review_scores_rating'] = listing_df['review_scores_rating'].astype('int32')
-    listing_df['review_scores_accuracy'] = listing_df['review_scores_accuracy'].astype('int32')
-    listing_df['review_scores_cleanliness'] = listing_df['review_scores_cleanliness'].astype('int32')
-    listing_df['review_scores_checkin'] = listing_df['review_scores_checkin'].astype('int32')
-    listing_df['review_scores_communication'] = listing_df['review_scores_communication'].astype('int32')
-    listing_df['review_scores_location'] = listing_df['review_scores_location'].astype('int32')
-    listing_df['review_scores_value'] = listing_df['review_scores_value'].astype('int32')
-    listing_df['license'] = listing_df['license'].astype('str')
-    listing_df['instant_bookable'] = listing_df['instant_bookable'].astype('str')
-    listing_df['calculated_host_listings_count'] = listing_df['calculated_host_listings_count'].astype('str')
-    listing_df['calculated_host_listings_count_entire_homes'] = listing_df['calculated_host_listings_count_entire_homes'].astype('str')
-    listing_df['calculated_host_listings_count_private_rooms'] = listing_df['calculated_host_listings_count_private_rooms'].astype('str')
-    listing_df['calculated_host_listings_count_shared_rooms'] = listing_df['calculated_host_listings_count_shared_rooms'].astype('str')
-    listing_df['reviews_per_month'] = listing_df['reviews_per_month'].astype('float')
-    
-    #creating schemas for the others
-    calendar_schema = StructType([
-        StructField('listing_id', StringType(), True),
-        StructField('date', TimestampType(), True),
-        StructField('available', BooleanType(), True),
-        StructField('requested_price', DecimalType(), True),
-        StructField('adjusted_price', DecimalType(), True)
-    ])
-
-    hoods_schema = StructType([
-            StructField('neighbourhood_group', StringType()),
-            StructField('neighbourhood', StringType())
-        ])
-
-    reviews_schema = StructType([
-            StructField('listing_id', IntegerType()),
-            StructField('id', IntegerType()),
-            StructField('date', TimestampType()),
-            StructField('reviewer_id', IntegerType()),
-            StructField('reviewer_name', StringType()),
-            StructField('comments', StringType())
-        ])
-    
+    listing_df, listing_errors = cast_columns(listing_df, LISTING_COLUMNS)
+    calendar_df, calendar_errors = cast_columns(calendar_df, CALENDAR_COLUMNS)
+    reviews_df, reviews_errors = cast_columns(reviews_df, REVIEWS_COLUMNS)
+    hoods_df, hoods_errors = cast_columns(hoods_df, HOODS_COLUMNS)
+    cast_errors = {'listing': listing_errors, 'calendar': calendar_errors,
+                   'reviews': reviews_errors, 'neighbourhoods': hoods_errors}
+    return listing_df, calendar_df, reviews_df, hoods_df, cast_errors
+
+def join_amplification(name, left, right, left_keys, right_keys, how='left'):
+    '''
+    estimates the rows a join produces from the key counts of both sides,
+    without running the join itself, and prints the amplification
+    (output rows / left rows) so a fan-out is visible before writing
+    '''
+    keys = ['key_{}'.format(i) for i in range(len(left_keys))]
+    left_counts = left.groupBy([col(c).alias(k) for c, k in zip(left_keys, keys)]).agg(F.count(F.lit(1)).alias('left_rows'))
+    right_counts = right.groupBy([col(c).alias(k) for c, k in zip(right_keys, keys)]).agg(F.count(F.lit(1)).alias('right_rows'))
+    matched = F.coalesce(col('right_rows'), F.lit(1 if how == 'left' else 0))
+    stats = left_counts.join(right_counts, on=keys, how='left') \
+        .agg(F.sum('left_rows').alias('left_rows'), F.sum(col('left_rows') * matched).alias('output_rows')).first()
+    left_rows, output_rows = stats['left_rows'] or 0, stats['output_rows'] or 0
+    amplification = output_rows / left_rows if left_rows else 0
+    print('{}: {} rows -> {} rows, amplification {:.2f}x'.format(name, left_rows, output_rows, amplification))
+    return amplification
+
+def review_stats(df_reviews):
+    '''
+    pre-aggregates the reviews to one row per listing.
+    spark combines the aggregate map-side, so even the listings
+    with the most reviews only send one partial row per task
+    '''
+    return df_reviews.groupBy('listing_id') \
+        .agg(F.count('review_id').alias('total_reviews'),
+             F.min('review_date').alias('first_review_date'),
+             F.max('review_date').alias('last_review_date'))
 
-def pre_processing_s3():
+def build_booking_fact(calendar_table, listing_table, hoods_table, df_reviews):
+    '''
+    builds the BOOKINGS fact with one row per listing per calendar day.
+    the listing and neighbourhood dimensions are broadcast, the reviews are
+    joined as per-listing stats and as the count of reviews left on that day,
+    so the grain never changes (the old calendar x reviews join multiplied
+    every calendar day by every review of the listing)
     '''
-    function that created the spark dataframes,
-    prepares them to write to s3 and uploads to s3
+    listing_dim = listing_table.select('id', 'name', 'host_id', 'host_name', 'latitude', 'longitude', 'price',
+                                       'review_scores_rating', 'reviews_per_month', 'room_type',
+                                       col('neighbourhood_cleansed').alias('neighbourhood'))
+    listing_stats = review_stats(df_reviews)
+    daily_reviews = df_reviews.groupBy('listing_id', col('review_date').alias('date')) \
+        .agg(F.count('review_id').alias('reviews_on_date'))
+
+    # the amplification checks and the fact join below read the same inputs,
+    # cached so the calendar and the reviews are only scanned once
+    calendar_table, listing_dim, listing_stats, daily_reviews = \
+        [df.cache() for df in (calendar_table, listing_dim, listing_stats, daily_reviews)]
+
+    # row-count amplification of each join, all of them should stay at 1.00x
+    join_amplification('calendar x listing', calendar_table, listing_dim, ['listing_id'], ['id'])
+    join_amplification('listing x neighbourhoods', listing_dim, hoods_table, ['neighbourhood'], ['neighbourhood'])
+    join_amplification('calendar x review stats', calendar_table, listing_stats, ['listing_id'], ['listing_id'])
+    join_amplification('calendar x daily reviews', calendar_table, daily_reviews,
+                       ['listing_id', 'date'], ['listing_id', 'date'])
+
+    listing_dim = listing_dim.join(F.broadcast(hoods_table), on='neighbourhood', how='left')
+    df_bookings = calendar_table \
+        .join(F.broadcast(listing_dim), on=[calendar_table.listing_id == listing_dim.id], how='left') \
+        .join(F.broadcast(listing_stats), on='listing_id', how='left') \
+        .join(daily_reviews, on=['listing_id', 'date'], how='left') \
+        .na.fill(0, subset=['total_reviews', 'reviews_on_date'])
+
+    return df_bookings.select('listing_id', 'date', 'month', 'available', 'adjusted_price', 'minimum_nights',
+                              'maximum_nights', 'name', 'host_id', 'host_name', 'room_type', 'neighbourhood',
+                              'neighbourhood_group', 'latitude', 'longitude', 'price', 'review_scores_rating',
+                              'reviews_per_month', 'total_reviews', 'first_review_date', 'last_review_date',
+                              'reviews_on_date')
+
+def pre_processing_s3(listing_df, calendar_df, reviews_df, hoods_df):
     '''
-    #define spark dataframes
-    df_hoods = spark.read.csv(hoods_csv, header=True, sep=",", schema=hoods_schema)
-    df_reviews = spark.read.csv(reviews_csv, header=True, sep=",", schema=reviews_schema)
-    df_reviews = df_reviews.withColumnRenamed("id", "review_id").withColumnRenamed("date", "review_date")
-    df_listing = spark.createDataFrame(listing_df)
-    df_calendar = spark.read.format('csv').option('header', 'true').option('inferSchema', 'true').option('sep', ',').load(calendar_csv)
-    df_calendar = df_calendar.drop('price')
+    function that prepares the spark dataframes
+    as the tables to be written to s3
+    '''
+    df_reviews = reviews_df.withColumnRenamed("id", "review_id").withColumnRenamed("date", "review_date")
+    df_listing = listing_df
+    df_calendar = calendar_df.drop('requested_price')
     
     #preparing the various "tables" before uploading to the S3 as parquet
     # REVIEW TABLE - extract columns to create review table
@@ -234,7 +220,7 @@ def pre_processing_s3():
     reviews_table = df_reviews.select('listing_id', 'review_id', 'review_date', 'reviewer_id', 'reviewer_name', 'comments', 'month')
 
     #NEIGHBOURHOODS - extract columns to create Hoods table
-    hoods_table = df_hoods.select('neighbourhood_group', 'neighbourhood')
+    hoods_table = hoods_df.select('neighbourhood_group', 'neighbourhood')
 
     #CALENDAR - extract columns to create CALENDAR table
     df_calendar = df_calendar.withColumn('month', month('date'))
@@ -242,87 +228,76 @@ def pre_processing_s3():
 
     #LISTING - extract columns to create LISTING table
     df_listing = df_listing.withColumn('month', month('host_since'))
+    #geohash grid cell of every listing, geo_cell (its prefix) partitions the table for geo queries
+    df_listing = with_geohash(df_listing)
     #including only some columns in the listing table for demostration purposes and because it is very slow
-    listing_table = df_listing.select('id', 'month','name','description','host_id','host_name','host_since','source','latitude','longitude','price','review_scores_rating','reviews_per_month','room_type')
+    listing_table = df_listing.select('id', 'month','name','description','host_id','host_name','host_since','source','latitude','longitude','geohash','geo_cell','price','review_scores_rating','reviews_per_month','room_type','neighbourhood_cleansed')
     
-    ##Creating the fact table BOOKINGS now
-    df_bookings_stg = df_calendar.join(listing_table, on=[df_calendar.listing_id == listing_table.id], how='left')
-    df_bookings = df_bookings_stg.join(df_reviews, on=[df_bookings_stg.listing_id == df_reviews.listing_id], how='left')
-
-    #preparing BOOKINGS before uploading to the S3 as parquet
-    # extract columns to create review table
-    df_bookings = df_bookings.withColumn('month_review', month('review_date'))
-    #including only some columns in the listing table for demostration purposes and because it is very slow
-    booking_table=df_bookings.select('id','month_review','name','description','host_id','host_name','host_since','source','latitude',
-                                      'longitude','adjusted_price','review_id','review_date','reviewer_id','review_scores_rating',
-                                      'reviews_per_month','room_type')
+    ##Creating the fact table BOOKINGS now, one row per listing per calendar day
+    booking_table = build_booking_fact(calendar_table, listing_table, hoods_table, df_reviews)
     print('Data is ready to be uploaded to S3!')
+    return reviews_table, hoods_table, calendar_table, listing_table, booking_table
     
-def write_to_s3():
+#table name -> partition columns, in the order the tables are written
+table_partitions = [
+    ('reviews', ['month']),
+    ('neighbourhoods', ['neighbourhood_group']),
+    ('calendar', ['month']),
+    ('listing', ['month', 'room_type', 'geo_cell']),
+    ('booking', ['month']),
+]
+
+def write_to_s3(reviews_table, hoods_table, calendar_table, listing_table, booking_table, output_data):
     '''
-    function to write spark dataframe to s3 as parquet files
+    function to write spark dataframe to the output storage as parquet files.
+    the row count and column stats of every table are recorded during the write
+    and stored as _stats.json next to it, they are returned by table name
     '''
+    tables = [reviews_table, hoods_table, calendar_table, listing_table, booking_table]
+    stats = {}
     # WRITING TABLES AS PARQUET TO S3
-    # write REVIEW table to parquet files partitioned by month 
-    reviews_table.write.mode('overwrite').partitionBy('month').parquet(output_bucket + 'reviews')
-    print('Review Table is created in the S3 bucket!')
-
-    # write HOODS table to parquet files partitioned by neighbourhood_group
-    hoods_table.write.mode('overwrite').partitionBy('neighbourhood_group').parquet(output_bucket + 'neighbourhoods')
-    print('Neighbourhoods Table is created in the S3 bucket!')
-
-    # write CALENDAR table to parquet files partitioned by month
-    calendar_table.write.mode('overwrite').partitionBy('month').parquet(output_bucket + 'calendar')
-    print('Calendar Table is created in the S3 bucket!')
-
-    # write LISTING table to parquet files partitioned by month and room type
-    listing_table.write.mode('overwrite').partitionBy('month', 'room_type').parquet(output_bucket + 'listing')
-    print('Listing Table is created in the S3 bucket!')
-
-    # write BOOKINGS (fact) table to parquet files partitioned month
-    booking_table.write.mode('overwrite').partitionBy('month_review').parquet(output_bucket + 'booking') 
-    print('Booking Table is created in the S3 bucket!')
+    for table, (name, partition_by) in zip(tables, table_partitions):
+        stats[name] = write_with_stats(table, output_data + name, partition_by)
+        print('{} Table is created in the S3 bucket with {} rows!'.format(name.capitalize(), stats[name]['row_count']))
+    return stats
 
 
-def data_quality():
+def data_quality(spark, output_data, stats=None, tables=None, cast_errors=None):
     '''
-    reads from s3 the parquet files uploaded before.
-    runs a check to see if the num of rows coincides pre and post upload
+    checks the parquet files uploaded before against the row count and column stats
+    recorded while writing them (or the _stats.json files when stats is not given).
+    only the parquet footers are read, so even the booking table is checked in seconds.
+    when the source tables are passed, a sampled checksum of two partitions is compared too.
+    the csv values data_types could not cast are reported as warnings, they were loaded as null
     '''
-    #reading the tables from the S3 in order to parse, run analysis etc
-    listing = spark.read.parquet(output_bucket + 'listing')
-    calendar = spark.read.parquet(output_bucket + 'calendar')
-    neighbourhoods = spark.read.parquet(output_bucket + 'neighbourhoods')
-    reviews = spark.read.parquet(output_bucket + 'reviews')
-    booking = spark.read.parquet(output_bucket + 'booking')
-    
-    # Get the count of rows in the dataframe
-    uploaded_table = ['booking_table','listing_table','reviews_table','hoods_table','calendar_table']
-    downloaded_tables = ['booking','listing','reviews','neighbourhoods','calendar']
-
-    expected_count = []
-    row_count = []
-
-    for i in uploaded_table:
-        expected_count.append(i)
-
-    for i in downloaded_tables:
-        row_count.append(i)
-
-    # Compare the counts
-    for uploaded, downloaded in zip(uploaded_table, downloaded_tables):
-    if downloaded.count() != uploaded.count():
-        raise ValueError("Data is incomplete. Expected {} rows in {} but found {}".format(uploaded.count(), uploaded, downloaded.count()))
+    stats = stats or {}
+    for source, columns in (cast_errors or {}).items():
+        for column, failed in columns.items():
+            print('Warning - {}.{}: {} values could not be cast and were loaded as null'.format(source, column, failed))
+
+    errors = []
+    for i, (name, partition_by) in enumerate(table_partitions):
+        path = output_data + name
+        table_errors = verify_table(spark, path, stats.get(name))
+        if tables is not None:
+            table_errors += sampled_checksum(spark, tables[i], path, partition_by)
+        errors += ['{}: {}'.format(name, error) for error in table_errors]
+        print('{} Table checked, {} problems found'.format(name.capitalize(), len(table_errors)))
+
+    if errors:
+        raise ValueError("Data is incomplete:\n" + "\n".join(errors))
             
 def main():
-    spark = configure_spark()
+    storage = get_storage('creds.cfg')
+    spark = configure_spark(storage)
     
-    read_csvs(calendar_csv, list_det_csv, list_csv, hoods_csv, reviews_csv) 
-    data_cleaning(calendar_df, reviews_df, list_df, list_det_df, hoods_df)
-    data_types(listing_df)
-    pre_processing_s3()
-    write_to_s3()
-    data_quality()
+    calendar_df, list_det_df, list_df, hoods_df, reviews_df = read_csvs(spark, storage['input_data'],
+                                                                        '--no-cache' not in sys.argv)
+    calendar_df, reviews_df, listing_df, hoods_df = data_cleaning(calendar_df, reviews_df, list_df, list_det_df, hoods_df)
+    listing_df, calendar_df, reviews_df, hoods_df, cast_errors = data_types(listing_df, calendar_df, reviews_df, hoods_df)
+    tables = pre_processing_s3(listing_df, calendar_df, reviews_df, hoods_df)
+    stats = write_to_s3(*tables, storage['output_data'])
+    data_quality(spark, storage['output_data'], stats, tables, cast_errors)
 
 if __name__ == "__main__":
     main()
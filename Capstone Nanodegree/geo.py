@@ -0,0 +1,227 @@
+'''
+Geohash grid cells of the listings and a cell index for radius and
+nearest-neighbour lookups.
+
+with_geohash adds the geohash of every listing (GEOHASH_PRECISION chars,
+cells of about 150 m) and its prefix geo_cell (CELL_PRECISION chars,
+about 40 km), which partitions the listing table, so a geo question on
+the lake only reads the partitions of the cells it covers. The hashes are
+computed on whole pandas batches with numpy, not row by row.
+
+GeoIndex answers the lookups in memory: the listings are sorted by cell
+and only the cells overlapping the search circle are read before the
+exact haversine distance is computed, instead of a pass over every
+listing.
+
+usage: python geo.py <listing parquet path> <latitude> <longitude> [km]
+'''
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from pyspark.sql import functions as F
+from pyspark.sql.types import StringType
+
+BASE32 = np.array(list('0123456789bcdefghjkmnpqrstuvwxyz'))
+GEOHASH_PRECISION = 7
+CELL_PRECISION = 4
+INDEX_PRECISION = 6
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+
+
+def cell_bits(precision):
+    '''
+    bits of latitude and longitude in a geohash of precision chars,
+    longitude gets the extra bit when the total is odd
+    '''
+    total = 5 * precision
+    return total // 2, total - total // 2
+
+
+def quantize(lat, lon, precision):
+    '''
+    row and column of the cells of the points in the geohash grid
+    '''
+    lat_bits, lon_bits = cell_bits(precision)
+    lat_q = np.floor((np.asarray(lat, dtype=float) + 90) / 180 * (1 << lat_bits))
+    lon_q = np.floor((np.asarray(lon, dtype=float) + 180) / 360 * (1 << lon_bits))
+    lat_q = np.clip(np.nan_to_num(lat_q), 0, (1 << lat_bits) - 1).astype(np.int64)
+    lon_q = np.clip(np.nan_to_num(lon_q), 0, (1 << lon_bits) - 1).astype(np.int64)
+    return lat_q, lon_q
+
+
+def encode_cells(lat_q, lon_q, precision):
+    '''
+    geohash strings of grid cells, the bits interleaved longitude first
+    '''
+    lat_bits, lon_bits = cell_bits(precision)
+    code = np.zeros(len(lat_q), dtype=np.int64)
+    for bit in range(5 * precision):
+        if bit % 2 == 0:
+            value = (lon_q >> (lon_bits - 1 - bit // 2)) & 1
+        else:
+            value = (lat_q >> (lat_bits - 1 - bit // 2)) & 1
+        code = (code << 1) | value
+
+    chars = np.empty((len(code), precision), dtype='U1')
+    for i in range(precision):
+        chars[:, i] = BASE32[(code >> (5 * (precision - 1 - i))) & 31]
+    return chars.view('U{}'.format(precision)).ravel()
+
+
+def encode(lat, lon, precision=GEOHASH_PRECISION):
+    '''
+    geohashes of arrays of points, None where a coordinate is missing
+    '''
+    lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+    hashes = encode_cells(*quantize(lat, lon, precision), precision).astype(object)
+    hashes[np.isnan(lat) | np.isnan(lon)] = None
+    return hashes
+
+
+def haversine_km(lat, lon, lats, lons):
+    '''
+    great circle distance from one point to arrays of points
+    '''
+    lat, lon, lats, lons = map(np.radians, (lat, lon, lats, lons))
+    a = np.sin((lats - lat) / 2) ** 2 + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def geohash_column(lat, lon, precision=GEOHASH_PRECISION):
+    '''
+    spark column of the geohash of two coordinate columns, computed per arrow batch
+    '''
+    @F.pandas_udf(StringType())
+    def geohash(lat: pd.Series, lon: pd.Series) -> pd.Series:
+        return pd.Series(encode(lat.astype(float), lon.astype(float), precision), index=lat.index)
+
+    return geohash(lat, lon)
+
+
+def with_geohash(df, lat='latitude', lon='longitude'):
+    '''
+    adds the geohash of each row and its geo_cell prefix, the partition key
+    '''
+    return df.withColumn('geohash', geohash_column(F.col(lat).cast('double'), F.col(lon).cast('double'))) \
+        .withColumn('geo_cell', F.substring('geohash', 1, CELL_PRECISION))
+
+
+def cell_stats(listing_df, precision=5):
+    '''
+    listing count and price of every grid cell of precision chars, e.g. for a price map
+    '''
+    return listing_df.groupBy(F.substring('geohash', 1, precision).alias('cell')) \
+        .agg(F.count(F.lit(1)).alias('listings'),
+             F.avg('price').alias('avg_price'),
+             F.expr('percentile_approx(price, 0.5)').alias('median_price'))
+
+
+class GeoIndex:
+    '''
+    points sorted by their grid cell, with the range of each cell,
+    so a lookup only computes distances for the cells around it
+    '''
+
+    def __init__(self, ids, lat, lon, precision=INDEX_PRECISION):
+        lat, lon = np.asarray(lat, dtype=float), np.asarray(lon, dtype=float)
+        known = ~(np.isnan(lat) | np.isnan(lon))
+        self.precision = precision
+        self.lat_bits, self.lon_bits = cell_bits(precision)
+
+        lat_q, lon_q = quantize(lat[known], lon[known], precision)
+        keys = (lat_q << self.lon_bits) | lon_q
+        order = np.argsort(keys, kind='stable')
+        self.ids = np.asarray(ids)[known][order]
+        self.lat = lat[known][order]
+        self.lon = lon[known][order]
+
+        cells, starts, counts = np.unique(keys[order], return_index=True, return_counts=True)
+        self.cells = {int(cell): (start, start + count) for cell, start, count in zip(cells, starts, counts)}
+
+    @classmethod
+    def from_frame(cls, df, id_column='id', lat='latitude', lon='longitude', precision=INDEX_PRECISION):
+        return cls(df[id_column].to_numpy(), df[lat].to_numpy(dtype=float), df[lon].to_numpy(dtype=float), precision)
+
+    def candidates(self, lat, lon, km):
+        '''
+        positions of the points in the cells overlapping the box around the circle
+        '''
+        dlat = km / KM_PER_DEGREE
+        # widest longitude span of the circle, which is wider than km at its own latitude
+        ratio = np.sin(km / EARTH_RADIUS_KM) / max(np.cos(np.radians(lat)), 1e-12)
+        dlon = np.degrees(np.arcsin(ratio)) if ratio < 1 else 180
+        lat_q, lon_q = quantize([lat - dlat, lat + dlat], [lon - dlon, lon + dlon], self.precision)
+        ranges = []
+        for row in range(int(lat_q[0]), int(lat_q[1]) + 1):
+            for column in range(int(lon_q[0]), int(lon_q[1]) + 1):
+                cell = self.cells.get((row << self.lon_bits) | column)
+                if cell:
+                    ranges.append(np.arange(*cell))
+        return np.concatenate(ranges) if ranges else np.empty(0, dtype=np.int64)
+
+    def within_radius(self, lat, lon, km):
+        '''
+        ids and distances of the points within km of (lat, lon), nearest first
+        '''
+        positions = self.candidates(lat, lon, km)
+        distances = haversine_km(lat, lon, self.lat[positions], self.lon[positions])
+        inside = distances <= km
+        positions, distances = positions[inside], distances[inside]
+        order = np.argsort(distances, kind='stable')
+        return self.ids[positions[order]], distances[order]
+
+    def nearest(self, lat, lon, k=10):
+        '''
+        ids and distances of the k points nearest to (lat, lon). the radius
+        starts at one cell and doubles until it holds k points, the k nearest
+        are always among the points of a circle holding k of them
+        '''
+        km = 180 / (1 << self.lat_bits) * KM_PER_DEGREE
+        while True:
+            ids, distances = self.within_radius(lat, lon, km)
+            if len(ids) >= k or km > np.pi * EARTH_RADIUS_KM:
+                return ids[:k], distances[:k]
+            km *= 2
+
+
+def benchmark(listings, lat, lon, km=1.0, runs=20):
+    '''
+    median time of a radius query with the index and with a full pass
+    over the listings, both must return the same listings
+    '''
+    index = GeoIndex.from_frame(listings)
+    lats, lons, ids = listings['latitude'].to_numpy(dtype=float), listings['longitude'].to_numpy(dtype=float), \
+        listings['id'].to_numpy()
+
+    def full_scan():
+        return ids[haversine_km(lat, lon, lats, lons) <= km]
+
+    timings = {}
+    for name, query in [('index', lambda: index.within_radius(lat, lon, km)[0]), ('full scan', full_scan)]:
+        runs_ms = []
+        for i in range(runs):
+            start = time.perf_counter()
+            result = query()
+            runs_ms.append((time.perf_counter() - start) * 1000)
+        timings[name] = (sorted(runs_ms)[runs // 2], set(result.tolist()))
+        print('{:<10} {:>6} listings within {} km in {:.3f} ms'.format(name, len(result), km, timings[name][0]))
+
+    if timings['index'][1] != timings['full scan'][1]:
+        raise ValueError('the index and the full scan found different listings')
+    return timings
+
+
+def main():
+    import pyarrow.parquet as pq
+
+    path, lat, lon = sys.argv[1], float(sys.argv[2]), float(sys.argv[3])
+    km = float(sys.argv[4]) if len(sys.argv) > 4 else 1.0
+    listings = pq.read_table(path, columns=['id', 'latitude', 'longitude']).to_pandas()
+    benchmark(listings, lat, lon, km)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+'''
+Write-time stats and metadata-only verification of the parquet tables.
+
+write_with_stats collects the row count and the per-column null/min/max
+of a table while it is being written (a spark Observation, no extra job)
+and stores them as _stats.json next to the parquet files. verify_table
+checks the written files against those stats using only the parquet
+footers, so no data page is read back from the bucket.
+'''
+import json
+
+from pyspark.sql import Observation
+from pyspark.sql import functions as F
+from pyspark.sql.types import NumericType, DateType, TimestampType, ByteType, ShortType, IntegerType, LongType, FloatType, DoubleType
+
+STATS_FILE = '_stats.json'
+
+# only these types have footer min/max values that compare one to one with spark values
+FOOTER_COMPARABLE = (ByteType, ShortType, IntegerType, LongType, FloatType, DoubleType)
+
+
+def _hadoop_path(spark, path):
+    '''
+    returns the hadoop filesystem and path objects for a path on any backend
+    '''
+    jvm = spark._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    return hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration()), hadoop_path
+
+
+def write_with_stats(df, path, partition_by=()):
+    '''
+    writes df as parquet to path and records its stats during the same job.
+    returns the stats dict that is also written to path/_stats.json
+    '''
+    partition_by = list(partition_by)
+    data_columns = [f for f in df.schema.fields if f.name not in partition_by]
+
+    metrics = [F.count(F.lit(1)).alias('row_count')]
+    for field in data_columns:
+        metrics.append(F.sum(F.col(field.name).isNull().cast('long')).alias('nulls:' + field.name))
+        if isinstance(field.dataType, (NumericType, DateType, TimestampType)):
+            metrics.append(F.min(field.name).alias('min:' + field.name))
+            metrics.append(F.max(field.name).alias('max:' + field.name))
+
+    observation = Observation('stats')
+    writer = df.observe(observation, *metrics).write.mode('overwrite')
+    if partition_by:
+        writer = writer.partitionBy(*partition_by)
+    writer.parquet(path)
+
+    observed = observation.get
+    stats = {'row_count': observed['row_count'], 'partition_by': partition_by, 'columns': {}}
+    for field in data_columns:
+        column = {'type': field.dataType.simpleString(), 'nulls': observed['nulls:' + field.name] or 0}
+        if 'min:' + field.name in observed:
+            column['min'] = observed['min:' + field.name]
+            column['max'] = observed['max:' + field.name]
+        stats['columns'][field.name] = column
+
+    spark = df.sparkSession
+    fs, stats_path = _hadoop_path(spark, path.rstrip('/') + '/' + STATS_FILE)
+    out = fs.create(stats_path, True)
+    out.write(bytearray(json.dumps(stats, default=str, indent=2).encode('utf8')))
+    out.close()
+    return stats
+
+
+def read_stats(spark, path):
+    '''
+    reads the _stats.json written next to a table
+    '''
+    text = spark.read.text(path.rstrip('/') + '/' + STATS_FILE, wholetext=True).first()[0]
+    return json.loads(text)
+
+
+def footer_stats(spark, path):
+    '''
+    sums the row counts, null counts and min/max of every column
+    from the parquet footers of the files under path
+    '''
+    jvm = spark._jvm
+    conf = spark._jsc.hadoopConfiguration()
+    fs, root = _hadoop_path(spark, path)
+
+    stats = {'row_count': 0, 'files': 0, 'columns': {}}
+    files = fs.listFiles(root, True)
+    while files.hasNext():
+        status = files.next()
+        if not status.getPath().getName().endswith('.parquet'):
+            continue
+        input_file = jvm.org.apache.parquet.hadoop.util.HadoopInputFile.fromPath(status.getPath(), conf)
+        reader = jvm.org.apache.parquet.hadoop.ParquetFileReader.open(input_file)
+        try:
+            footer = reader.getFooter()
+        finally:
+            reader.close()
+
+        stats['files'] += 1
+        for block in footer.getBlocks():
+            stats['row_count'] += block.getRowCount()
+            for chunk in block.getColumns():
+                name = chunk.getPath().toDotString()
+                column = stats['columns'].setdefault(name, {'nulls': 0, 'min': None, 'max': None})
+                chunk_stats = chunk.getStatistics()
+                if chunk_stats is None or chunk_stats.isEmpty():
+                    continue
+                column['nulls'] += chunk_stats.getNumNulls()
+                if chunk_stats.hasNonNullValue():
+                    low, high = chunk_stats.genericGetMin(), chunk_stats.genericGetMax()
+                    column['min'] = low if column['min'] is None else min(column['min'], low)
+                    column['max'] = high if column['max'] is None else max(column['max'], high)
+    return stats
+
+
+def verify_table(spark, path, expected=None):
+    '''
+    compares the footers of the files under path with the stats recorded
+    at write time (read from _stats.json when expected is not given).
+    returns the list of mismatches, empty when the table is complete
+    '''
+    expected = expected or read_stats(spark, path)
+    found = footer_stats(spark, path)
+
+    errors = []
+    if found['row_count'] != expected['row_count']:
+        errors.append('expected {} rows but the footers hold {}'.format(expected['row_count'], found['row_count']))
+
+    comparable = {type_().simpleString() for type_ in FOOTER_COMPARABLE}
+    for name, column in expected['columns'].items():
+        written = found['columns'].get(name)
+        if written is None:
+            errors.append('column {} is missing from the parquet files'.format(name))
+            continue
+        if written['nulls'] != column['nulls']:
+            errors.append('column {}: expected {} nulls but found {}'.format(name, column['nulls'], written['nulls']))
+        if column['type'] in comparable and column.get('min') is not None:
+            if (written['min'], written['max']) != (column['min'], column['max']):
+                errors.append('column {}: expected min/max {}/{} but found {}/{}'.format(
+                    name, column['min'], column['max'], written['min'], written['max']))
+    return errors
+
+
+def sampled_checksum(spark, df, path, partition_by, partitions=2):
+    '''
+    compares the row count and an xxhash64 checksum of a few values of the first
+    partition column of the source dataframe with the same rows read back from path.
+    the filter on the partition column prunes the read to the sampled directories.
+    the partition columns are left out of the checksum, spark infers their type
+    from the directory names when reading them back
+    '''
+    partition_col = partition_by[0]
+    values = [row[0] for row in df.select(partition_col).dropna().distinct().limit(partitions).collect()]
+    columns = sorted(c for c in df.columns if c not in partition_by)
+
+    def checksum(frame):
+        return frame.agg(F.count(F.lit(1)).alias('rows'), F.sum(F.xxhash64(*columns)).alias('hash')).first()
+
+    errors = []
+    written_table = spark.read.parquet(path)
+    for value in values:
+        source = df.filter(F.col(partition_col) == value)
+        written = written_table.filter(F.col(partition_col) == value)
+        expected, found = checksum(source), checksum(written)
+        if (expected['rows'], expected['hash']) != (found['rows'], found['hash']):
+            errors.append('partition {}={}: expected {} rows / checksum {} but found {} / {}'.format(
+                partition_col, value, expected['rows'], expected['hash'], found['rows'], found['hash']))
+    return errors
@@ -0,0 +1,178 @@
+'''
+Column type spec of the airbnb csvs.
+
+Each table is described once as a list of (column, type) pairs and the
+spark schemas and the spark casts are derived from it. The types are:
+
+    int8 / int16 / int32 / int64    integers of the width given per column in the spec
+    float32 / float64               floating point numbers
+    string                          free text
+    category                        low-cardinality text, a string column
+    bool                            airbnb 't' / 'f' flags
+    date                            'yyyy-MM-dd' dates
+    price                           '$1,234.00' amounts, stored as decimal(10,2)
+    percent                         '95%' rates, stored as int8
+'''
+from pyspark.sql import functions as F
+from pyspark.sql.types import (StructType, StructField, StringType, ByteType, ShortType, IntegerType, LongType,
+                               FloatType, DoubleType, BooleanType, DateType, DecimalType)
+
+LISTING_COLUMNS = [
+    ('id', 'int64'),
+    ('listing_url', 'string'),
+    ('scrape_id', 'int64'),
+    ('last_scraped', 'date'),
+    ('source', 'category'),
+    ('name', 'string'),
+    ('description', 'string'),
+    ('neighborhood_overview', 'string'),
+    ('picture_url', 'string'),
+    ('host_id', 'int64'),
+    ('host_url', 'string'),
+    ('host_name', 'string'),
+    ('host_since', 'date'),
+    ('host_location', 'string'),
+    ('host_about', 'string'),
+    ('host_response_time', 'category'),
+    ('host_response_rate', 'percent'),
+    ('host_acceptance_rate', 'percent'),
+    ('host_is_superhost', 'bool'),
+    ('host_thumbnail_url', 'string'),
+    ('host_picture_url', 'string'),
+    ('host_neighbourhood', 'string'),
+    ('host_listings_count', 'int32'),
+    ('host_total_listings_count', 'int32'),
+    ('host_verifications', 'category'),
+    ('host_has_profile_pic', 'bool'),
+    ('host_identity_verified', 'bool'),
+    ('neighbourhood', 'string'),
+    ('neighbourhood_cleansed', 'category'),
+    ('neighbourhood_group_cleansed', 'category'),
+    ('latitude', 'float64'),
+    ('longitude', 'float64'),
+    ('property_type', 'category'),
+    ('room_type', 'category'),
+    ('accommodates', 'int8'),
+    ('bathrooms_text', 'category'),
+    ('bedrooms', 'int8'),
+    ('beds', 'int8'),
+    ('amenities', 'string'),
+    ('price', 'price'),
+    ('minimum_nights', 'int16'),
+    ('minimum_minimum_nights', 'int16'),
+    ('maximum_minimum_nights', 'int16'),
+    ('minimum_maximum_nights', 'int32'),
+    ('maximum_maximum_nights', 'int32'),
+    ('minimum_nights_avg_ntm', 'float32'),
+    ('maximum_nights_avg_ntm', 'float32'),
+    ('has_availability', 'bool'),
+    ('availability_30', 'int8'),
+    ('availability_60', 'int8'),
+    ('availability_90', 'int8'),
+    ('availability_365', 'int16'),
+    ('number_of_reviews', 'int32'),
+    ('number_of_reviews_ltm', 'int16'),
+    ('number_of_reviews_l30d', 'int16'),
+    ('first_review', 'date'),
+    ('last_review', 'date'),
+    ('review_scores_rating', 'float32'),
+    ('review_scores_accuracy', 'float32'),
+    ('review_scores_cleanliness', 'float32'),
+    ('review_scores_checkin', 'float32'),
+    ('review_scores_communication', 'float32'),
+    ('review_scores_location', 'float32'),
+    ('review_scores_value', 'float32'),
+    ('license', 'string'),
+    ('instant_bookable', 'bool'),
+    ('calculated_host_listings_count', 'int16'),
+    ('calculated_host_listings_count_entire_homes', 'int16'),
+    ('calculated_host_listings_count_private_rooms', 'int16'),
+    ('calculated_host_listings_count_shared_rooms', 'int16'),
+    ('reviews_per_month', 'float32'),
+]
+
+# the csv column 'price' is read as requested_price, the columns are matched by position
+CALENDAR_COLUMNS = [
+    ('listing_id', 'int64'),
+    ('date', 'date'),
+    ('available', 'bool'),
+    ('requested_price', 'price'),
+    ('adjusted_price', 'price'),
+    ('minimum_nights', 'int16'),
+    ('maximum_nights', 'int32'),
+]
+
+REVIEWS_COLUMNS = [
+    ('listing_id', 'int64'),
+    ('id', 'int64'),
+    ('date', 'date'),
+    ('reviewer_id', 'int64'),
+    ('reviewer_name', 'string'),
+    ('comments', 'string'),
+]
+
+HOODS_COLUMNS = [
+    ('neighbourhood_group', 'category'),
+    ('neighbourhood', 'category'),
+]
+
+SPARK_TYPES = {
+    'int8': ByteType(),
+    'int16': ShortType(),
+    'int32': IntegerType(),
+    'int64': LongType(),
+    'float32': FloatType(),
+    'float64': DoubleType(),
+    'string': StringType(),
+    'category': StringType(),
+    'bool': BooleanType(),
+    'date': DateType(),
+    'price': DecimalType(10, 2),
+    'percent': ByteType(),
+}
+
+
+def spark_schema(columns, raw=False):
+    '''
+    returns the spark schema of a table spec,
+    with raw=True every column is a string (the schema to read the csv with)
+    '''
+    return StructType([StructField(name, StringType() if raw else SPARK_TYPES[kind], True)
+                       for name, kind in columns])
+
+
+def spark_cast(name, kind):
+    '''
+    returns the spark expression that converts the raw string column to its type
+    '''
+    raw = F.col(name)
+    if kind == 'price':
+        return F.regexp_replace(raw, '[$,]', '').cast(SPARK_TYPES[kind])
+    if kind == 'percent':
+        return F.regexp_replace(raw, '%', '').cast(SPARK_TYPES[kind])
+    if kind == 'date':
+        return F.to_date(raw)
+    return raw.cast(SPARK_TYPES[kind])
+
+
+def cast_columns(df, columns, report=True):
+    '''
+    casts every column of the spark dataframe that is in the spec in one select.
+    values that cannot be cast become null instead of failing the run,
+    with report=True the number of such values is counted and printed per column.
+    returns the cast dataframe and a dict of column -> failed values
+    '''
+    spec = dict(columns)
+    to_cast = [c for c in df.columns if c in spec and spec[c] not in ('string', 'category')]
+
+    cast_errors = {}
+    if report and to_cast:
+        failed = df.agg(*[F.sum((F.col(c).isNotNull() & (F.col(c) != '') & spark_cast(c, spec[c]).isNull())
+                                .cast('int')).alias(c) for c in to_cast]).first()
+        cast_errors = {c: failed[c] for c in to_cast if failed[c]}
+        for c, n in cast_errors.items():
+            print('{} - {} values could not be cast to {}'.format(c, n, spec[c]))
+
+    casted = [spark_cast(c, spec[c]).alias(c) if c in to_cast else F.col(c) for c in df.columns]
+    return df.select(casted), cast_errors
+
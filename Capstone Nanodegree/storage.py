@@ -0,0 +1,45 @@
+'''
+Storage backends of the Capstone lake paths, see common/storage.py for
+the [STORAGE] section of creds.cfg:
+
+    [STORAGE]
+    BACKEND = local                 # s3 | minio | local
+    INPUT_DATA = airbnb_data/
+    OUTPUT_DATA = file:///tmp/airbnb-lake/
+
+Without a [STORAGE] section the original s3a:// bucket is used.
+
+usage: python storage.py [backend ...]
+'''
+from common import storage
+from common.storage import configure_builder
+
+CONFIG_FILE = 'creds.cfg'
+
+# input and output paths of each backend
+PATHS = {
+    's3': {
+        'input_data': 'airbnb_data/',
+        'output_data': 's3a://udacitycapstone123/',
+    },
+    'minio': {
+        'input_data': 'airbnb_data/',
+        'output_data': 's3a://udacitycapstone123/',
+    },
+    'local': {
+        'input_data': 'airbnb_data/',
+        'output_data': 'file:///tmp/airbnb-lake/',
+    },
+}
+
+
+def get_storage(config_file=CONFIG_FILE, backend=None):
+    return storage.get_storage(config_file, backend, PATHS)
+
+
+def main():
+    storage.main(CONFIG_FILE, PATHS)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,23 @@
 import configparser
+import sys
 import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+from sql_queries import (create_table_queries, view_create_queries, drop_table_queries, songplay_view_drop,
+                         songplay_relation_select, songplay_old_table_drop)
 
 
 def drop_tables(cur, conn):
+    cur.execute(songplay_relation_select)
+    songplay = cur.fetchone()
     for query in drop_table_queries:
+        # songplay is still the original table on a cluster created before the view
+        if query == songplay_view_drop and songplay and songplay[0] != 'VIEW':
+            query = songplay_old_table_drop
         cur.execute(query)
         conn.commit()
 
 
 def create_tables(cur, conn):
-    for query in create_table_queries:
+    for query in create_table_queries + [create for name, create in view_create_queries]:
         cur.execute(query)
         conn.commit()
 
@@ -22,8 +29,13 @@ def main():
     conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
     cur = conn.cursor()
 
-    drop_tables(cur, conn)
-    create_tables(cur, conn)
+    # --migrate keeps the tables and their data, only the missing schema is added
+    if '--migrate' in sys.argv:
+        import migrate
+        migrate.migrate(cur, conn, '--dry-run' in sys.argv)
+    else:
+        drop_tables(cur, conn)
+        create_tables(cur, conn)
 
     conn.close()
 
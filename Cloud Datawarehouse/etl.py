@@ -1,6 +1,7 @@
 import configparser
 import psycopg2
 from sql_queries import copy_table_queries, insert_table_queries
+from rollups import update_rollups, refresh_views
 
 
 def load_staging_tables(cur, conn):
@@ -15,15 +16,22 @@ def insert_tables(cur, conn):
         conn.commit()
 
 
-def main():
+def connect():
     config = configparser.ConfigParser()
     config.read('dwh.cfg')
 
     conn = psycopg2.connect("host={} dbname={} user={} password={} port={}".format(*config['CLUSTER'].values()))
     cur = conn.cursor()
+    return cur, conn
+
+
+def main():
+    cur, conn = connect()
     
     load_staging_tables(cur, conn)
     insert_tables(cur, conn)
+    update_rollups(cur, conn)
+    refresh_views(cur, conn)
 
     conn.close()
 
@@ -0,0 +1,249 @@
+'''
+Runs the Redshift load of sql_queries.py against a local Postgres, to get
+a repeatable baseline of the whole load and to try query changes before
+they reach the cluster.
+
+The statements go through LocalCursor, which rewrites the Redshift-only
+syntax (IDENTITY, GETDATE, extract(weekday), stv_mv_info) into Postgres
+and turns each COPY ... json from S3 into a bulk COPY FROM STDIN of the
+matching files of a local copy of the bucket. The json 'auto' and
+jsonpaths mappings are applied like Redshift does, so the staging tables
+hold the same rows as on the cluster.
+
+The [LOCAL] section of dwh.cfg gives the Postgres connection (DSN) and
+the local directory mirroring the bucket (DATA), e.g. after
+aws s3 sync s3://udacity-dend/log_data data/log_data (same for song_data
+and log_json_path.json).
+
+usage: python local_redshift.py [--benchmark]
+'''
+import configparser
+import io
+import json
+import os
+import re
+import sys
+import time
+
+import psycopg2
+
+import create_tables
+from rollups import update_rollups, refresh_views, benchmark
+from sql_queries import copy_table_queries, insert_table_queries
+
+DSN = 'host=127.0.0.1 dbname=studentdb user=student password=student'
+DATA = 'data'
+
+# (Redshift pattern, Postgres replacement)
+TRANSLATIONS = [
+    (r'\bIDENTITY\s*\(\s*(\d+)\s*,\s*(\d+)\s*\)', r'GENERATED BY DEFAULT AS IDENTITY (START \1 MINVALUE \1 INCREMENT \2)'),
+    (r'\bGETDATE\(\)', 'now()'),
+    (r'extract\(\s*weekday\s+from', 'extract(dow from'),
+    (r'\bENCODE\s+\w+|\bDISTKEY\b(\s*\(\w+\))?|\b(COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)|\bDISTSTYLE\s+\w+', ''),
+    (r'SELECT 1 FROM stv_mv_info WHERE name = %s', 'SELECT 1 FROM pg_matviews WHERE matviewname = %s'),
+]
+
+# session settings of Redshift that Postgres does not have
+SKIPPED = re.compile(r'\s*SET\s+enable_result_cache_for_session\b', re.I)
+
+COPY = re.compile(r"\s*copy\s+(\w+)\s+from\s+'([^']+)'.*?\bjson\s+'([^']+)'", re.S | re.I)
+
+TEXT_TYPES = ('character varying', 'text', 'character')
+
+
+def translate(query):
+    '''
+    Postgres version of a Redshift statement, None for the statements to skip
+    '''
+    if SKIPPED.match(query):
+        return None
+    for pattern, replacement in TRANSLATIONS:
+        query = re.sub(pattern, replacement, query, flags=re.I)
+    return query
+
+
+def local_path(data, url):
+    '''
+    path under the local bucket directory of an s3://bucket/key url
+    '''
+    key = re.sub(r'^s3://[^/]+/?', '', url)
+    return os.path.join(data, *key.split('/'))
+
+
+def read_json_objects(path):
+    '''
+    the json objects of a file, one after the other like COPY reads them
+    '''
+    with open(path) as f:
+        text = f.read()
+    decoder = json.JSONDecoder()
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position == len(text):
+            return
+        obj, position = decoder.raw_decode(text, position)
+        yield obj
+
+
+def json_files(path):
+    '''
+    the files under a key prefix, like the objects COPY loads from S3
+    '''
+    if os.path.isdir(path):
+        directory, prefix = path, ''
+    else:
+        directory, prefix = os.path.split(path)
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            full = os.path.join(root, name)
+            if os.path.relpath(full, directory).startswith(prefix) and name.endswith('.json'):
+                yield full
+
+
+def parse_jsonpath(expression):
+    '''
+    keys of a jsonpath like $['artist'] or $.song.title
+    '''
+    return [quoted or plain for quoted, plain in re.findall(r"\[\s*['\"]([^'\"]*)['\"]\s*\]|\.(\w+)", expression)]
+
+
+def json_value(obj, keys):
+    for key in keys:
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(key)
+    return obj
+
+
+def copy_value(value, text_column):
+    '''
+    value in the text format of COPY FROM STDIN. like Redshift, an empty
+    string is loaded as NULL in a column that is not text
+    '''
+    if value is None or (value == '' and not text_column):
+        return '\\N'
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    value = str(value)
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+class LocalCursor:
+    '''
+    psycopg2 cursor running Redshift statements on Postgres
+    '''
+
+    def __init__(self, cur, data):
+        self.cur = cur
+        self.data = data
+
+    def __getattr__(self, name):
+        return getattr(self.cur, name)
+
+    def execute(self, query, vars=None):
+        copy = COPY.match(query)
+        if copy:
+            return self.copy_json(*copy.groups())
+        query = translate(query)
+        if query is not None:
+            self.cur.execute(query, vars)
+
+    def columns(self, table):
+        self.cur.execute("""
+            SELECT column_name, data_type
+            FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = %s
+            ORDER BY ordinal_position""", (table,))
+        return self.cur.fetchall()
+
+    def copy_json(self, table, source, json_format):
+        '''
+        loads the json files of source into table with one COPY FROM STDIN
+        '''
+        columns = self.columns(table)
+        if json_format.lower() == 'auto':
+            # keys are matched with the column names regardless of case
+            paths = None
+        else:
+            with open(local_path(self.data, json_format)) as f:
+                paths = [parse_jsonpath(e) for e in json.load(f)['jsonpaths']]
+            columns = columns[:len(paths)]
+        text_columns = [data_type in TEXT_TYPES for name, data_type in columns]
+
+        buffer = io.StringIO()
+        for path in json_files(local_path(self.data, source)):
+            for obj in read_json_objects(path):
+                if paths is None:
+                    lowered = {key.lower(): value for key, value in obj.items()}
+                    values = [lowered.get(name.lower()) for name, data_type in columns]
+                else:
+                    values = [json_value(obj, keys) for keys in paths]
+                buffer.write('\t'.join(copy_value(v, t) for v, t in zip(values, text_columns)) + '\n')
+
+        buffer.seek(0)
+        self.cur.copy_expert('COPY {} ({}) FROM STDIN'.format(table, ', '.join(name for name, data_type in columns)),
+                             buffer)
+
+
+def connect():
+    '''
+    connects to the local Postgres of the [LOCAL] section of dwh.cfg,
+    returns the translating cursor and the connection
+    '''
+    config = configparser.ConfigParser()
+    config.read('dwh.cfg')
+    local = config['LOCAL'] if config.has_section('LOCAL') else {}
+
+    conn = psycopg2.connect(local.get('DSN', DSN))
+    cur = conn.cursor()
+    # Redshift sessions are in UTC, the epoch arithmetic of the inserts depends on it
+    cur.execute("SET TIME ZONE 'UTC'")
+    return LocalCursor(cur, local.get('DATA', DATA)), conn
+
+
+def step_name(query):
+    '''
+    statement and table of a load query, e.g. "truncate staging_event"
+    '''
+    match = re.search(r'(copy|TRUNCATE|DELETE FROM|INSERT INTO)\s+(\w+)', query, re.I)
+    return '{} {}'.format(match.group(1).split()[0].lower(), match.group(2))
+
+
+def run_load(cur, conn):
+    '''
+    recreates the tables and runs the whole load, returns the (step, seconds) timings
+    '''
+    steps = [('drop tables', lambda: create_tables.drop_tables(cur, conn)),
+             ('create tables', lambda: create_tables.create_tables(cur, conn))]
+    steps += [(step_name(query), lambda query=query: cur.execute(query)) for query in copy_table_queries + insert_table_queries]
+    steps += [('rollups', lambda: update_rollups(cur, conn)),
+              ('materialized views', lambda: refresh_views(cur, conn))]
+
+    timings = []
+    for name, step in steps:
+        start = time.time()
+        step()
+        conn.commit()
+        timings.append((name, time.time() - start))
+        print('{:<22} {:>8.2f}s'.format(name, timings[-1][1]))
+    print('{:<22} {:>8.2f}s'.format('total', sum(seconds for name, seconds in timings)))
+    return timings
+
+
+def main():
+    cur, conn = connect()
+
+    run_load(cur, conn)
+    if '--benchmark' in sys.argv:
+        benchmark(cur)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+'''
+Non-destructive schema migration for the Redshift cluster.
+
+The CREATE TABLE statements in sql_queries.py are the desired schema.
+They are compared with the live catalog (the diff is common/migration.py)
+and only what is missing is applied: new tables, new columns and missing
+views. Nothing is dropped, so the final tables keep their data between
+deployments; etl.py empties the staging tables before each COPY and only
+inserts the rows the final tables do not hold yet, so loading again after
+a migration adds no duplicates. Redshift has no indexes and its key
+constraints are informational only, so those are not diffed; columns
+whose type differs and columns that only exist in the database are
+reported in the plan and left as they are.
+A songplay table from before songplay_fact is the one thing dropped: its
+rows are moved into songplay_fact and the dimensions first, then the
+songplay view replaces it.
+
+usage: python migrate.py [--dry-run], or python create_tables.py --migrate
+'''
+import sys
+
+import psycopg2
+
+from common.migration import TYPE_ALIASES, parse_create_table, read_relations, plan_migration, print_plan
+from etl import connect
+from sql_queries import create_table_queries, view_create_queries, songplay_table_move
+
+# Redshift stores TEXT columns as VARCHAR(256)
+REDSHIFT_TYPE_ALIASES = dict(TYPE_ALIASES, text='character varying')
+
+
+def migrate(cur, conn, dry_run=False):
+    '''
+    plans the migration of the cluster and applies it statement by statement,
+    or only prints the plan with dry_run. returns the statements
+    '''
+    catalog = read_relations(cur)
+    tables = [parse_create_table(query) for query in create_table_queries]
+    # the rollups read the songplays loaded after their high water mark, the moved ones keep their loaded_at
+    loaded_at = 's.loaded_at' if 'loaded_at' in catalog['columns'].get('songplay', {}) else 'GETDATE()'
+    moves = {'songplay': [query.format(loaded_at=loaded_at) for query in songplay_table_move]}
+    # Redshift has no indexes and its key constraints are informational, only tables, columns and views are compared
+    statements, notes = plan_migration(catalog, tables, views=view_create_queries, aliases=REDSHIFT_TYPE_ALIASES,
+                                       moves=moves)
+    print_plan(statements, notes)
+    if dry_run:
+        return statements
+
+    for statement in statements:
+        try:
+            cur.execute(statement)
+            conn.commit()
+        except psycopg2.Error:
+            conn.rollback()
+            raise
+    if statements:
+        print('-- {} statements applied'.format(len(statements)))
+    return statements
+
+
+def main():
+    cur, conn = connect()
+
+    migrate(cur, conn, '--dry-run' in sys.argv)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+'''
+Rollup layer of the Redshift cluster: hourly and daily aggregates of
+songplay and the materialized views analysts query instead of the raw fact.
+
+update_rollups only aggregates the songplays loaded since the last run,
+whose loaded_at is above the high water mark in rollup_state, and merges
+them into the rollup tables in the same transaction that moves the mark,
+so a failed run is simply repeated. etl.py runs it after every load.
+
+usage: python rollups.py update|refresh|rebuild|benchmark
+'''
+import sys
+import time
+from datetime import datetime
+
+from sql_queries import *
+
+RUNS = 5
+# high water mark before the first run
+START = datetime(1900, 1, 1)
+
+
+def merge_queries(table, keys, delta):
+    '''
+    statements adding the plays of a delta query to the rollup table: the delta
+    is staged in a temp table (the only statement taking the high water marks),
+    then as Redshift has no upsert matching rows are updated and the others inserted
+    '''
+    staged = '{}_delta'.format(table)
+    match = ' AND '.join('{0}.{2} = {1}.{2}'.format(table, staged, k) for k in keys)
+    return 'CREATE TEMP TABLE {} AS {}'.format(staged, delta), [
+        'UPDATE {0} SET plays = {0}.plays + {1}.plays FROM {1} WHERE {2}'.format(table, staged, match),
+        'INSERT INTO {0} SELECT {1}.* FROM {1} LEFT JOIN {0} ON {2} WHERE {0}.{3} IS NULL'.format(table, staged, match, keys[0]),
+        'DROP TABLE {}'.format(staged),
+    ]
+
+
+def update_rollups(cur, conn):
+    '''
+    rolls up the songplays above the high water mark and moves the mark,
+    returns the (old, new) high water marks
+    '''
+    cur.execute(rollup_state_select, ('songplay',))
+    row = cur.fetchone()
+    high_water_mark = row[0] if row else START
+    cur.execute(songplay_high_water_mark_select)
+    new_high_water_mark = cur.fetchone()[0] or START
+
+    if new_high_water_mark > high_water_mark:
+        for table, keys, delta in rollup_queries:
+            stage, merge = merge_queries(table, keys, delta)
+            cur.execute(stage, (high_water_mark, new_high_water_mark))
+            for query in merge:
+                cur.execute(query)
+        cur.execute(rollup_state_delete, ('songplay',))
+        cur.execute(rollup_state_insert, ('songplay', new_high_water_mark))
+    conn.commit()
+    print('rolled up loaded_at {} to {}'.format(high_water_mark, new_high_water_mark))
+    return high_water_mark, new_high_water_mark
+
+
+def refresh_views(cur, conn):
+    '''
+    creates the materialized views that do not exist yet and refreshes them,
+    outside of a transaction block
+    '''
+    conn.commit()
+    conn.autocommit = True
+    try:
+        for name, create, refresh in view_queries:
+            cur.execute(view_exists_select, (name,))
+            if cur.fetchone() is None:
+                cur.execute(create)
+            else:
+                cur.execute(refresh)
+            print('refreshed ' + name)
+    finally:
+        conn.autocommit = False
+
+
+def rebuild_rollups(cur, conn):
+    '''
+    empties the rollups and rolls up every songplay again
+    '''
+    for table, keys, delta in rollup_queries:
+        cur.execute('DELETE FROM {}'.format(table))
+    cur.execute(rollup_state_delete, ('songplay',))
+    update_rollups(cur, conn)
+
+
+def median_ms(cur, query, runs=RUNS):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        cur.execute(query)
+        cur.fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def benchmark(cur):
+    '''
+    times each analytics query on the raw songplay and on its rollup,
+    the result cache is disabled so every run is computed
+    '''
+    cur.execute('SET enable_result_cache_for_session TO off')
+    for name, raw, rollup in rollup_benchmark_queries:
+        raw_ms = median_ms(cur, raw)
+        rollup_ms = median_ms(cur, rollup)
+        print('{:<22} raw {:>10.3f} ms rollup {:>10.3f} ms ({:.1f}x)'.format(
+            name, raw_ms, rollup_ms, raw_ms / max(rollup_ms, 1e-6)))
+
+
+def main():
+    from etl import connect
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'update'
+    cur, conn = connect()
+
+    if command == 'update':
+        update_rollups(cur, conn)
+        refresh_views(cur, conn)
+    elif command == 'refresh':
+        refresh_views(cur, conn)
+    elif command == 'rebuild':
+        rebuild_rollups(cur, conn)
+        refresh_views(cur, conn)
+    elif command == 'benchmark':
+        benchmark(cur)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -13,11 +13,26 @@ SONG_DATA = config.get("S3", "SONG_DATA")
 
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_event"
 staging_songs_table_drop = "DROP TABLE IF EXISTS staging_song"
-songplay_table_drop = "DROP TABLE IF EXISTS songplay"
+songplay_view_drop = "DROP VIEW IF EXISTS songplay"
+# a cluster created before songplay_fact holds songplay as a table, DROP VIEW fails on it
+songplay_relation_select = """
+    SELECT table_type FROM information_schema.tables
+    WHERE table_schema = current_schema() AND table_name = 'songplay'
+"""
+songplay_old_table_drop = "DROP TABLE IF EXISTS songplay"
+songplay_table_drop = "DROP TABLE IF EXISTS songplay_fact"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS song"
 artist_table_drop = "DROP TABLE IF EXISTS artist"
 time_table_drop = "DROP TABLE IF EXISTS time"
+location_table_drop = "DROP TABLE IF EXISTS location"
+user_agent_table_drop = "DROP TABLE IF EXISTS user_agent"
+rollup_state_table_drop = "DROP TABLE IF EXISTS rollup_state"
+plays_hourly_table_drop = "DROP TABLE IF EXISTS plays_hourly"
+song_plays_daily_table_drop = "DROP TABLE IF EXISTS song_plays_daily"
+level_location_daily_table_drop = "DROP TABLE IF EXISTS level_location_daily"
+top_songs_view_drop = "DROP MATERIALIZED VIEW IF EXISTS top_songs_mv"
+level_location_view_drop = "DROP MATERIALIZED VIEW IF EXISTS level_location_mv"
 
 # CREATE TABLES
 
@@ -60,7 +75,7 @@ staging_songs_table_create = ("""
 """)
 
 songplay_table_create = ("""
-    CREATE TABLE IF NOT EXISTS songplay (
+    CREATE TABLE IF NOT EXISTS songplay_fact (
         songplay_id INT IDENTITY(0,1),
         start_time TIMESTAMP,
         user_id INT,
@@ -68,8 +83,9 @@ songplay_table_create = ("""
         song_id VARCHAR,
         artist_id VARCHAR,
         session_id INT,
-        location TEXT,
-        user_agent TEXT
+        location_id INT,
+        user_agent_id INT,
+        loaded_at TIMESTAMP DEFAULT GETDATE()
     )
 """)
 
@@ -114,7 +130,38 @@ time_table_create = ("""
         weekday VARCHAR
     ) """)
 
+# the locations and user agents repeat on most songplays, songplay_fact only keeps their integer keys
+location_table_create = ("""
+    CREATE TABLE IF NOT EXISTS location (
+        location_id INT IDENTITY(1,1),
+        location TEXT
+    )
+""")
+
+user_agent_table_create = ("""
+    CREATE TABLE IF NOT EXISTS user_agent (
+        user_agent_id INT IDENTITY(1,1),
+        user_agent TEXT
+    )
+""")
+
+# VIEWS
+# songplay keeps the columns of the original table, so the queries reading it do not change
+
+songplay_view_create = ("""
+    CREATE OR REPLACE VIEW songplay AS
+    SELECT f.songplay_id, f.start_time, f.user_id, f.level, f.song_id, f.artist_id, f.session_id,
+        location.location, user_agent.user_agent, f.loaded_at
+    FROM songplay_fact f
+    LEFT JOIN location ON location.location_id = f.location_id
+    LEFT JOIN user_agent ON user_agent.user_agent_id = f.user_agent_id
+""")
+
 # STAGING TABLES
+# the staging tables are emptied before every COPY, so they only hold the files of this load
+
+staging_events_truncate = "TRUNCATE staging_event"
+staging_songs_truncate = "TRUNCATE staging_song"
 
 staging_events_copy = ("""
     copy staging_event
@@ -131,37 +178,119 @@ staging_songs_copy = ("""
 """).format(SONG_DATA, ARN)
 
 # FINAL TABLES
+# every insert only adds the rows that are not in the table yet, so running the load
+# again (or after a migrate.py deployment that kept the tables) adds no duplicates
 
-songplay_table_insert = ("""
-    INSERT INTO songplay (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent)
-    SELECT 
-        distinct timestamp with time zone 'epoch' + ste.ts/1000 * interval '1 second', 
-        ste.userId, 
-        ste.level, 
-        sts.song_id, 
-        sts.artist_id, 
-        ste.sessionId, 
-        ste.location, 
-        ste.userAgent
-    FROM staging_event ste 
-    INNER JOIN staging_song sts
-        ON ste.song = sts.title 
-        AND ste.artist = sts.artist_name 
-        AND ste.length = sts.duration
+# the new locations and user agents are added to their dimension before the songplays are inserted
+location_table_insert = ("""
+    INSERT INTO location (location)
+    SELECT DISTINCT ste.location
+    FROM staging_event ste
+    LEFT JOIN location ON location.location = ste.location
     WHERE ste.page = 'NextSong'
+    AND ste.location IS NOT NULL
+    AND location.location_id IS NULL
+""")
+
+user_agent_table_insert = ("""
+    INSERT INTO user_agent (user_agent)
+    SELECT DISTINCT ste.userAgent
+    FROM staging_event ste
+    LEFT JOIN user_agent ON user_agent.user_agent = ste.userAgent
+    WHERE ste.page = 'NextSong'
+    AND ste.userAgent IS NOT NULL
+    AND user_agent.user_agent_id IS NULL
+""")
+
+# a songplay is identified by its start_time, user and session
+songplay_table_insert = ("""
+    INSERT INTO songplay_fact (start_time, user_id, level, song_id, artist_id, session_id, location_id, user_agent_id)
+    SELECT DISTINCT staged.*
+    FROM (
+        SELECT 
+            timestamp with time zone 'epoch' + ste.ts/1000 * interval '1 second' AS start_time, 
+            ste.userId AS user_id, 
+            ste.level, 
+            sts.song_id, 
+            sts.artist_id, 
+            ste.sessionId AS session_id, 
+            location.location_id, 
+            user_agent.user_agent_id
+        FROM staging_event ste 
+        INNER JOIN staging_song sts
+            ON ste.song = sts.title 
+            AND ste.artist = sts.artist_name 
+            AND ste.length = sts.duration
+        LEFT JOIN location ON location.location = ste.location
+        LEFT JOIN user_agent ON user_agent.user_agent = ste.userAgent
+        WHERE ste.page = 'NextSong'
+    ) staged
+    LEFT JOIN songplay_fact f
+        ON f.start_time = staged.start_time
+        AND f.user_id = staged.user_id
+        AND f.session_id = staged.session_id
+    WHERE f.start_time IS NULL
     """)
 
+# a songplay table created before songplay_fact: its locations and user agents are added to
+# their dimension, its rows moved into songplay_fact and it is dropped for the view. the
+# songplays already in songplay_fact are skipped, so a move cut short can be run again.
+# {loaded_at} is the old loaded_at column, or GETDATE() for a table without one
+songplay_table_move = [
+    """
+    INSERT INTO location (location)
+    SELECT DISTINCT s.location
+    FROM songplay s
+    LEFT JOIN location ON location.location = s.location
+    WHERE s.location IS NOT NULL
+    AND location.location_id IS NULL
+    """,
+    """
+    INSERT INTO user_agent (user_agent)
+    SELECT DISTINCT s.user_agent
+    FROM songplay s
+    LEFT JOIN user_agent ON user_agent.user_agent = s.user_agent
+    WHERE s.user_agent IS NOT NULL
+    AND user_agent.user_agent_id IS NULL
+    """,
+    """
+    INSERT INTO songplay_fact (start_time, user_id, level, song_id, artist_id, session_id, location_id, user_agent_id, loaded_at)
+    SELECT DISTINCT moved.*
+    FROM (
+        SELECT s.start_time, s.user_id, s.level, s.song_id, s.artist_id, s.session_id,
+            location.location_id, user_agent.user_agent_id, {loaded_at} AS loaded_at
+        FROM songplay s
+        LEFT JOIN location ON location.location = s.location
+        LEFT JOIN user_agent ON user_agent.user_agent = s.user_agent
+    ) moved
+    LEFT JOIN songplay_fact f
+        ON f.start_time = moved.start_time
+        AND f.user_id = moved.user_id
+        AND f.session_id = moved.session_id
+    WHERE f.start_time IS NULL
+    """,
+    "DROP TABLE songplay",
+]
+
+# the staged users replace their rows, with the level of their last event
+user_table_delete = ("""
+    DELETE FROM users
+    USING staging_event
+    WHERE users.user_id = staging_event.userId
+    AND staging_event.page = 'NextSong'
+""")
+
 user_table_insert = ("""
     INSERT INTO users (user_id, first_name, last_name, gender, level)
-    SELECT 
-        DISTINCT userId, 
-        firstName, 
-        lastName, 
-        gender, 
-        level
-    FROM staging_event
-    WHERE page = 'NextSong' 
-    AND userId is not null
+    SELECT userId, firstName, lastName, gender, level
+    FROM (
+        SELECT userId, firstName, lastName, gender, level,
+            ROW_NUMBER() OVER (PARTITION BY userId ORDER BY ts DESC) AS latest
+        FROM staging_event
+        WHERE page = 'NextSong' 
+        AND userId is not null
+    ) staged
+    WHERE latest = 1
 """)
 
 song_table_insert = ("""
@@ -174,6 +303,7 @@ song_table_insert = ("""
         duration
     FROM staging_song
     WHERE song_id is not null
+    AND song_id NOT IN (SELECT song_id FROM song)
 """)
 
 artist_table_insert = ("""
@@ -186,6 +316,7 @@ artist_table_insert = ("""
         artist_longitude
     FROM staging_song
     WHERE artist_id is not null
+    AND artist_id NOT IN (SELECT artist_id FROM artist)
 """)
 
 time_table_insert = ("""
@@ -198,11 +329,138 @@ time_table_insert = ("""
         extract(month from start_time), 
         extract(year from start_time), 
         extract(weekday from start_time)
-    FROM songplay""")
+    FROM (
+        SELECT DISTINCT f.start_time
+        FROM songplay_fact f
+        LEFT JOIN time ON time.start_time = f.start_time
+        WHERE time.start_time IS NULL
+    ) missing""")
+
+# ROLLUPS
+# aggregates of songplay kept up to date by each etl run from the songplays loaded since
+# the high water mark (the last loaded_at rolled up) stored in rollup_state. IDENTITY values
+# are not assigned in load order on Redshift, every INSERT gets one loaded_at instead
+
+rollup_state_table_create = ("""
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        rollup VARCHAR,
+        high_water_mark TIMESTAMP
+    )
+""")
+
+plays_hourly_table_create = ("""
+    CREATE TABLE IF NOT EXISTS plays_hourly (
+        hour TIMESTAMP,
+        level VARCHAR,
+        plays BIGINT
+    )
+""")
+
+song_plays_daily_table_create = ("""
+    CREATE TABLE IF NOT EXISTS song_plays_daily (
+        day DATE,
+        song_id VARCHAR,
+        artist_id VARCHAR,
+        plays BIGINT
+    )
+""")
+
+level_location_daily_table_create = ("""
+    CREATE TABLE IF NOT EXISTS level_location_daily (
+        day DATE,
+        location TEXT,
+        level VARCHAR,
+        plays BIGINT
+    )
+""")
+
+rollup_state_select = "SELECT high_water_mark FROM rollup_state WHERE rollup = %s"
+rollup_state_delete = "DELETE FROM rollup_state WHERE rollup = %s"
+rollup_state_insert = "INSERT INTO rollup_state (rollup, high_water_mark) VALUES (%s, %s)"
+songplay_high_water_mark_select = "SELECT max(loaded_at) FROM songplay"
+
+# aggregates of the songplays with high water mark < loaded_at <= new high water mark
+plays_hourly_delta = ("""
+    SELECT date_trunc('hour', start_time) AS hour, coalesce(level, 'unknown') AS level, count(*) AS plays
+    FROM songplay
+    WHERE loaded_at > %s AND loaded_at <= %s
+    GROUP BY 1, 2
+""")
+
+song_plays_daily_delta = ("""
+    SELECT start_time::date AS day, song_id, max(artist_id) AS artist_id, count(*) AS plays
+    FROM songplay
+    WHERE loaded_at > %s AND loaded_at <= %s AND song_id IS NOT NULL
+    GROUP BY 1, 2
+""")
+
+level_location_daily_delta = ("""
+    SELECT start_time::date AS day, coalesce(location, 'unknown') AS location, coalesce(level, 'unknown') AS level, count(*) AS plays
+    FROM songplay
+    WHERE loaded_at > %s AND loaded_at <= %s
+    GROUP BY 1, 2, 3
+""")
+
+# MATERIALIZED VIEWS
+# built on the rollups, Redshift refreshes them incrementally where it can
+
+top_songs_view_create = ("""
+    CREATE MATERIALIZED VIEW top_songs_mv AS
+    SELECT d.song_id, song.title, artist.name AS artist, sum(d.plays) AS plays
+    FROM song_plays_daily d
+    JOIN song ON song.song_id = d.song_id
+    JOIN artist ON artist.artist_id = d.artist_id
+    GROUP BY d.song_id, song.title, artist.name
+""")
+
+level_location_view_create = ("""
+    CREATE MATERIALIZED VIEW level_location_mv AS
+    SELECT location,
+        sum(CASE WHEN level = 'paid' THEN plays ELSE 0 END) AS paid_plays,
+        sum(CASE WHEN level = 'free' THEN plays ELSE 0 END) AS free_plays
+    FROM level_location_daily
+    GROUP BY location
+""")
+
+view_exists_select = "SELECT 1 FROM stv_mv_info WHERE name = %s"
+top_songs_view_refresh = "REFRESH MATERIALIZED VIEW top_songs_mv"
+level_location_view_refresh = "REFRESH MATERIALIZED VIEW level_location_mv"
+
+# ROLLUP BENCHMARK QUERIES
+# (name, query on the raw songplay, query on the rollup)
+
+rollup_benchmark_queries = [
+    ('plays_per_hour',
+     "SELECT date_trunc('hour', start_time), level, count(*) FROM songplay GROUP BY 1, 2",
+     "SELECT hour, level, plays FROM plays_hourly"),
+    ('top_songs',
+     """SELECT song.title, artist.name, count(*) AS plays
+        FROM songplay
+        JOIN song ON song.song_id = songplay.song_id
+        JOIN artist ON artist.artist_id = songplay.artist_id
+        GROUP BY song.title, artist.name
+        ORDER BY plays DESC
+        LIMIT 10""",
+     "SELECT title, artist, plays FROM top_songs_mv ORDER BY plays DESC LIMIT 10"),
+    ('paid_free_by_location',
+     """SELECT location, sum(CASE WHEN level = 'paid' THEN 1 ELSE 0 END), sum(CASE WHEN level = 'free' THEN 1 ELSE 0 END)
+        FROM songplay GROUP BY location""",
+     "SELECT location, paid_plays, free_plays FROM level_location_mv"),
+]
 
 # QUERY LISTS
 
-create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create]
-drop_table_queries = [staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
-copy_table_queries = [staging_events_copy, staging_songs_copy]
-insert_table_queries = [songplay_table_insert, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+create_table_queries = [staging_events_table_create, staging_songs_table_create, songplay_table_create, user_table_create, song_table_create, artist_table_create, time_table_create,
+                        location_table_create, user_agent_table_create, rollup_state_table_create, plays_hourly_table_create, song_plays_daily_table_create, level_location_daily_table_create]
+# (view, create statement), created after the tables
+view_create_queries = [('songplay', songplay_view_create)]
+drop_table_queries = [top_songs_view_drop, level_location_view_drop, songplay_view_drop, staging_events_table_drop, staging_songs_table_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop,
+                      location_table_drop, user_agent_table_drop, rollup_state_table_drop, plays_hourly_table_drop, song_plays_daily_table_drop, level_location_daily_table_drop]
+copy_table_queries = [staging_events_truncate, staging_events_copy, staging_songs_truncate, staging_songs_copy]
+insert_table_queries = [location_table_insert, user_agent_table_insert, songplay_table_insert, user_table_delete, user_table_insert, song_table_insert, artist_table_insert, time_table_insert]
+# (rollup table, key columns, delta query)
+rollup_queries = [('plays_hourly', ['hour', 'level'], plays_hourly_delta),
+                  ('song_plays_daily', ['day', 'song_id'], song_plays_daily_delta),
+                  ('level_location_daily', ['day', 'location', 'level'], level_location_daily_delta)]
+view_queries = [('top_songs_mv', top_songs_view_create, top_songs_view_refresh),
+                ('level_location_mv', level_location_view_create, level_location_view_refresh)]
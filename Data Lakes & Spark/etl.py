@@ -1,40 +1,29 @@
 import configparser
 from datetime import datetime
 import os
+import sys
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import udf, col
 from pyspark.sql.functions import year, month, dayofmonth, hour, weekofyear, date_format
-from pyspark.sql.types import StructType, StructField, DoubleType, StringType, IntegerType, TimestampType
+from pyspark.sql.types import StructType, StructField, DoubleType, StringType, IntegerType, TimestampType, LongType
 from pyspark.sql.functions import udf, col, year, month, dayofweek, hour, weekofyear, dayofmonth, monotonically_increasing_id
 from pyspark.sql import functions as F
 from pyspark.sql import types as T
+from pyspark.sql.window import Window
 import pandas as pd
 
+from storage import get_storage, configure_builder
 
-config = configparser.ConfigParser()
-config.read('dl.cfg')
 
-os.environ['AWS_ACCESS_KEY_ID']=config['AWS']['KEY']
-os.environ['AWS_SECRET_ACCESS_KEY']=config['AWS']['SECRET']
-
-input_data = "s3a://udacity-dend/"
-output_data = "s3a://udacitybucket23456/"
-
-song_data = input_data + "song_data/A/A/A/*.json" # get filepath to song data file
-log_data = input_data + "log_data/*/*/*.json"     # get filepath to log data file
-
-def create_spark_session():
-    spark = SparkSession \
-        .builder \
-        .config("spark.jars.packages", "org.apache.hadoop:hadoop-aws:2.7.0") \
-        .getOrCreate()
+def create_spark_session(storage):
+    spark = configure_builder(SparkSession.builder, storage).getOrCreate()
     return spark
 
 def process_song_data(spark, input_data, output_data):
     
     '''
-    Reads JSON song files from input S3, build the songs and artists tables
-    and writes the output in parquet format in the destination S3
+    Reads JSON song files from the input storage, build the songs and artists tables
+    and writes the output in parquet format in the destination storage
     
     '''
     song_schema = StructType([
@@ -50,6 +39,7 @@ def process_song_data(spark, input_data, output_data):
     ])
 
     # read song data file & forcing the schema above
+    song_data = input_data + "song_data/A/A/A/*.json" # get filepath to song data file
     df_song = spark.read.json(song_data, schema=song_schema)
     
     # extract columns to create songs table
@@ -68,17 +58,136 @@ def process_song_data(spark, input_data, output_data):
     artists_table.write.mode('overwrite').parquet(output_data + 'artists')
 
 
+def hadoop_path(spark, path):
+    '''
+    hadoop path and filesystem of a path of the output storage
+    '''
+    path = spark._jvm.org.apache.hadoop.fs.Path(path)
+    return path, path.getFileSystem(spark._jsc.hadoopConfiguration())
+
+
+class DictionaryEncoder:
+    '''
+    replaces a repetitive text column of songplays (location, user agent) by
+    an integer key. the keys are kept in a dimension table (key, value) that
+    is only ever appended to, so a key never changes once written, and in a
+    dict on the driver, loaded once and reused by every call (and every
+    micro-batch of the stream), so only values never seen before are written
+    '''
+
+    def __init__(self, spark, path, key_column, value_column):
+        self.spark = spark
+        self.path = path
+        self.key_column = key_column
+        self.value_column = value_column
+        self.keys = None
+
+    def load(self):
+        self.keys = {}
+        path, fs = hadoop_path(self.spark, self.path)
+        if fs.exists(path):
+            for row in self.spark.read.parquet(self.path).collect():
+                self.keys[row[self.value_column]] = row[self.key_column]
+
+    def encode(self, df, column):
+        '''
+        adds the key column of the values of df[column], after appending the
+        new values to the dimension table
+        '''
+        if self.keys is None:
+            self.load()
+
+        values = [row[0] for row in df.select(column).distinct().collect() if row[0] is not None]
+        new = [value for value in values if value not in self.keys]
+        if new:
+            first = max(self.keys.values(), default=0) + 1
+            rows = [(first + i, value) for i, value in enumerate(new)]
+            schema = StructType([StructField(self.key_column, IntegerType()), StructField(self.value_column, StringType())])
+            self.spark.createDataFrame(rows, schema).write.mode('append').parquet(self.path)
+            self.keys.update((value, key) for key, value in rows)
+
+        lookup = self.spark.createDataFrame([(value, self.keys[value]) for value in values],
+                                            '_value string, {} int'.format(self.key_column))
+        return df.join(F.broadcast(lookup), df[column] == lookup['_value'], 'left').drop('_value')
+
+
+def dictionary_encoders(spark, output_data):
+    return (DictionaryEncoder(spark, output_data + 'locations', 'location_id', 'location'),
+            DictionaryEncoder(spark, output_data + 'user_agents', 'user_agent_id', 'user_agent'))
+
+
+def register_views(spark, output_data):
+    '''
+    registers the tables written so far as temp views, songplays with its location
+    and user agent decoded, so queries written against the original songplays run
+    as is in the session. it runs after every write, so the views list the new files
+    '''
+    written = set()
+    for table in ['songs', 'artists', 'users', 'time', 'sessions', 'locations', 'user_agents', 'songplays']:
+        path, fs = hadoop_path(spark, output_data + table)
+        if fs.exists(path):
+            view = 'songplays_fact' if table == 'songplays' else table
+            spark.read.parquet(output_data + table).createOrReplaceTempView(view)
+            written.add(table)
+    if not {'songplays', 'locations', 'user_agents'} <= written:
+        return
+    spark.sql("""
+        SELECT f.start_time, f.user_id, f.level, f.song_id, f.artist_id, f.session_id,
+            l.location, u.user_agent, f.year, f.month
+        FROM songplays_fact f
+        LEFT JOIN locations l ON l.location_id = f.location_id
+        LEFT JOIN user_agents u ON u.user_agent_id = f.user_agent_id
+    """).createOrReplaceTempView('songplays')
+
+
+def build_sessions(df_events):
+    '''
+    one row per listening session (user and sessionId) from every log event
+    of the session, not only the plays: start and end, duration, events and
+    plays, first and last level, level changes and whether it upgraded from
+    free to paid. the levels are ordered by itemInSession with window
+    functions partitioned like the aggregation, so they share one shuffle
+    '''
+    events = df_events.filter(col('sessionId').isNotNull() & col('userId').isNotNull() & (col('userId') != ''))
+    session = Window.partitionBy('userId', 'sessionId').orderBy('itemInSession', 'ts')
+    whole_session = session.rowsBetween(Window.unboundedPreceding, Window.unboundedFollowing)
+    events = events \
+        .withColumn('previous_level', F.lag('level').over(session)) \
+        .withColumn('first_level', F.first('level').over(whole_session)) \
+        .withColumn('last_level', F.last('level').over(whole_session))
+
+    level_change = (col('level') != col('previous_level')).cast('int')
+    upgrade = ((col('previous_level') == 'free') & (col('level') == 'paid')).cast('int')
+    return events.groupBy(col('userId').alias('user_id'), col('sessionId').alias('session_id')) \
+        .agg((F.min('ts') / 1000).cast(TimestampType()).alias('start_time'),
+             (F.max('ts') / 1000).cast(TimestampType()).alias('end_time'),
+             ((F.max('ts') - F.min('ts')) / 1000).cast('long').alias('duration_seconds'),
+             F.count(F.lit(1)).alias('events'),
+             F.sum((col('page') == 'NextSong').cast('int')).alias('plays'),
+             F.max('first_level').alias('first_level'),
+             F.max('last_level').alias('last_level'),
+             F.coalesce(F.sum(level_change), F.lit(0)).alias('level_changes'),
+             F.coalesce(F.max(upgrade), F.lit(0)).cast('boolean').alias('upgraded')) \
+        .withColumn('start_date', F.to_date('start_time'))
+
+
 def process_log_data(spark, input_data, output_data):
     
     '''
-    Reads JSON log files from input S3, build the users & time tables
-    and writes the output in parquet format in the destination S3
+    Reads JSON log files from the input storage, build the users & time tables
+    and writes the output in parquet format in the destination storage
     
     '''
     
     # read log data file
-    df_log = spark.read.json(log_data)
-    df_log = df_log.filter(df_log.page == 'NextSong') #this is where the relevant log data lies
+    log_data = input_data + "log_data/*/*/*.json"     # get filepath to log data file
+    df_events = spark.read.json(log_data)
+
+    # sessions are built from every event, written partitioned by their start date
+    sessions_table = build_sessions(df_events)
+    sessions_table.write.mode('overwrite').partitionBy('start_date').parquet(output_data + 'sessions')
+
+    df_log = df_events.filter(df_events.page == 'NextSong') #this is where the relevant log data lies
     
     # extract columns for users table
     users_fields = ['userId as user_id', 'firstName as first_name', 'lastName as last_name', 'gender', 'level']
@@ -121,6 +230,12 @@ def process_log_data(spark, input_data, output_data):
 
     #artists_songs_logs = artists_songs_logs.withColumnRenamed("location", "artists_songs_location")
     songplays = artists_songs_logs.join(time_table, artists_songs_logs.ts == time_table.ts, 'left').drop(artists_songs_logs.year)
+
+    # location and user agent are stored as keys of their dimension tables
+    location_encoder, user_agent_encoder = dictionary_encoders(spark, output_data)
+    joined = songplays.persist()
+    songplays = location_encoder.encode(joined, 'location')
+    songplays = user_agent_encoder.encode(songplays, 'userAgent')
     
     # write songplays table to parquet files partitioned by year and month
     songplays_table = songplays.select(
@@ -130,20 +245,176 @@ def process_log_data(spark, input_data, output_data):
             col('song_id'),
             col('artist_id'),
             col('sessionId').alias('session_id'),
-            col('location'),
-            col('userAgent').alias('user_agent'),
+            col('location_id'),
+            col('user_agent_id'),
             col('year'),
             col('month'),
         ).repartition("year", "month")
 
     songplays_table.write.mode("overwrite").partitionBy("year", "month").parquet(output_data + 'songplays')
+    joined.unpersist()
+
+
+# schema of the log files, a streaming file source cannot infer it
+log_schema = StructType([
+    StructField('artist', StringType()),
+    StructField('auth', StringType()),
+    StructField('firstName', StringType()),
+    StructField('gender', StringType()),
+    StructField('itemInSession', LongType()),
+    StructField('lastName', StringType()),
+    StructField('length', DoubleType()),
+    StructField('level', StringType()),
+    StructField('location', StringType()),
+    StructField('method', StringType()),
+    StructField('page', StringType()),
+    StructField('registration', DoubleType()),
+    StructField('sessionId', LongType()),
+    StructField('song', StringType()),
+    StructField('status', LongType()),
+    StructField('ts', LongType()),
+    StructField('userAgent', StringType()),
+    StructField('userId', StringType()),
+])
+
+
+def song_lookup(spark, output_data):
+    '''
+    song_id and artist_id of every (title, artist name) from the songs and
+    artists tables, small enough to broadcast to every micro-batch
+    '''
+    songs = spark.read.parquet(output_data + 'songs').select('title', 'song_id', 'artist_id')
+    artists = spark.read.parquet(output_data + 'artists').select('artist_id', col('name').alias('artist_name'))
+    lookup = songs.join(artists, 'artist_id').dropDuplicates(['title', 'artist_name'])
+    return F.broadcast(lookup.cache())
+
+
+# checkpoint of the log stream, the exactly-once bookkeeping of the batches lives inside it
+LOG_STREAM_CHECKPOINT = '_checkpoints/log_stream'
+
+
+def append_batch(spark, df, output_data, table, batch_id):
+    '''
+    appends the rows of one micro-batch to a table exactly once. the batch is
+    written to its own staging directory in the checkpoint, then committed by
+    renaming its files into the table and writing the table's marker for the
+    batch. a replayed batch skips the tables it committed, and a commit that
+    stopped half way is finished from the staged files instead of writing
+    them again. the markers are deleted with the checkpoint, so a new stream
+    starting again at batch 0 is not mistaken for a replay
+    '''
+    checkpoint = output_data + LOG_STREAM_CHECKPOINT
+    marker, fs = hadoop_path(spark, '{}/commits/{}/{}'.format(checkpoint, table, batch_id))
+    if fs.exists(marker):
+        return
+
+    staging, fs = hadoop_path(spark, '{}/staging/{}/{}'.format(checkpoint, table, batch_id))
+    staging = fs.makeQualified(staging)
+    if not fs.exists(spark._jvm.org.apache.hadoop.fs.Path(staging, '_SUCCESS')):
+        df.write.mode('overwrite').partitionBy('year', 'month').parquet(staging.toString())
+
+    target = fs.makeQualified(hadoop_path(spark, output_data + table)[0]).toString()
+    staged = []
+    files = fs.listFiles(staging, True)
+    while files.hasNext():
+        path = files.next().getPath()
+        if not path.getName().startswith(('_', '.')):
+            staged.append(path)
+    for path in staged:
+        # year=/month= directories of the file, relative to the staging directory
+        partition = path.getParent().toString()[len(staging.toString()):]
+        directory = spark._jvm.org.apache.hadoop.fs.Path(target + partition)
+        fs.mkdirs(directory)
+        fs.rename(path, spark._jvm.org.apache.hadoop.fs.Path(directory, 'batch-{}-{}'.format(batch_id, path.getName())))
+
+    fs.create(marker).close()
+    fs.delete(staging, True)
+
+
+def write_log_batch(spark, lookup, encoders, output_data):
+    '''
+    returns the foreachBatch function appending the time rows and songplays
+    of a micro-batch, each table committed on its own by append_batch, so a
+    batch replayed after a failure adds neither table twice
+    '''
+    def write(batch_df, batch_id):
+        df_log = batch_df.filter(batch_df.page == 'NextSong') \
+            .withColumn('start_time', (col('ts') / 1000).cast(TimestampType())) \
+            .withColumn('hour', hour('start_time')) \
+            .withColumn('day', dayofmonth('start_time')) \
+            .withColumn('week', weekofyear('start_time')) \
+            .withColumn('month', month('start_time')) \
+            .withColumn('year', year('start_time')) \
+            .withColumn('weekday', dayofweek('start_time')) \
+            .persist()
+
+        time_table = df_log.select('start_time', 'hour', 'day', 'week', 'month', 'year', 'weekday', 'ts').dropDuplicates()
+        append_batch(spark, time_table, output_data, 'time', batch_id)
+
+        location_encoder, user_agent_encoder = encoders
+        songplays = df_log.join(lookup, (df_log.song == lookup.title) & (df_log.artist == lookup.artist_name))
+        songplays = location_encoder.encode(songplays, 'location')
+        songplays = user_agent_encoder.encode(songplays, 'userAgent')
+        songplays_table = songplays.select(
+                col('start_time'),
+                col('userId').alias('user_id'),
+                col('level'),
+                col('song_id'),
+                col('artist_id'),
+                col('sessionId').alias('session_id'),
+                col('location_id'),
+                col('user_agent_id'),
+                col('year'),
+                col('month'),
+            )
+        append_batch(spark, songplays_table, output_data, 'songplays', batch_id)
+
+        df_log.unpersist()
+        register_views(spark, output_data)
+
+    return write
+
+
+def process_log_stream(spark, input_data, output_data, trigger='1 minute', once=False, max_files=100):
+    '''
+    watches the log directory and appends the time rows and songplays of the
+    new files every trigger interval (sessions span micro-batches, they are
+    only built by the batch job). the file source and the checkpoint
+    remember which files were processed, so history is never read again
+    and a restarted stream carries on where it stopped
+    '''
+    log_stream = spark.readStream.schema(log_schema) \
+        .option('maxFilesPerTrigger', max_files) \
+        .json(input_data + 'log_data/*/*/')
+
+    writer = log_stream.writeStream \
+        .foreachBatch(write_log_batch(spark, song_lookup(spark, output_data), dictionary_encoders(spark, output_data),
+                                      output_data)) \
+        .option('checkpointLocation', output_data + LOG_STREAM_CHECKPOINT)
+    if once:
+        writer = writer.trigger(once=True)
+    else:
+        writer = writer.trigger(processingTime=trigger)
+    return writer.start()
 
 
 def main():
-    spark = create_spark_session()
-    
-    process_song_data(spark, input_data, output_data)    
-    process_log_data(spark, input_data, output_data)
+    '''
+    runs the batch job, or with --stream [--once] the streaming log
+    pipeline on top of the songs and artists tables of a previous batch run
+    '''
+    storage = get_storage('dl.cfg')
+    spark = create_spark_session(storage)
+
+    if '--stream' in sys.argv:
+        query = process_log_stream(spark, storage['input_data'], storage['output_data'],
+                                   trigger=storage.get('trigger', '1 minute'), once='--once' in sys.argv)
+        query.awaitTermination()
+        return
+
+    process_song_data(spark, storage['input_data'], storage['output_data'])    
+    process_log_data(spark, storage['input_data'], storage['output_data'])
+    register_views(spark, storage['output_data'])
 
 
 if __name__ == "__main__":
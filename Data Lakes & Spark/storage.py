@@ -0,0 +1,48 @@
+'''
+Storage backends of the Sparkify lake paths, see common/storage.py for
+the [STORAGE] section of dl.cfg:
+
+    [STORAGE]
+    BACKEND = local                 # s3 | minio | local
+    INPUT_DATA = file:///tmp/udacity-dend/
+    OUTPUT_DATA = file:///tmp/sparkify-lake/
+    MASTER = local[*]               # local only, the spark master to run on
+    TRIGGER = 1 minute              # micro-batch interval of etl.py --stream
+
+Without a [STORAGE] section the original s3a:// buckets are used.
+
+usage: python storage.py [backend ...]
+'''
+from common import storage
+from common.storage import configure_builder
+
+CONFIG_FILE = 'dl.cfg'
+
+# input and output paths of each backend, the local one runs spark on every core
+PATHS = {
+    's3': {
+        'input_data': 's3a://udacity-dend/',
+        'output_data': 's3a://udacitybucket23456/',
+    },
+    'minio': {
+        'input_data': 's3a://udacity-dend/',
+        'output_data': 's3a://sparkify-lake/',
+    },
+    'local': {
+        'input_data': 'file:///tmp/udacity-dend/',
+        'output_data': 'file:///tmp/sparkify-lake/',
+        'master': 'local[*]',
+    },
+}
+
+
+def get_storage(config_file=CONFIG_FILE, backend=None):
+    return storage.get_storage(config_file, backend, PATHS)
+
+
+def main():
+    storage.main(CONFIG_FILE, PATHS)
+
+
+if __name__ == "__main__":
+    main()
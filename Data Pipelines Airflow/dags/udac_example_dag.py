@@ -3,7 +3,8 @@ import os
 from airflow import DAG
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.operators import (StageToRedshiftOperator, LoadFactOperator,
-                                LoadDimensionOperator, DataQualityOperator)
+                                LoadDimensionOperator, DataQualityOperator,
+                                CheckInputOperator)
 from helpers import SqlQueries
 
 # AWS_KEY = os.environ.get('AWS_KEY')
@@ -17,19 +18,44 @@ default_args = {
 dag = DAG('udac_example_dag',
           default_args=default_args,
           description='Load and transform data in Redshift with Airflow',
-          schedule_interval='0 * * * *'
+          schedule_interval='@daily'
         )
 
+# the event log of the day being run, the bucket holds one file
+# per day: log_data/2018/11/2018-11-01-events.json
+log_prefix = "log_data/{{ execution_date.strftime('%Y/%m') }}/{{ ds }}-events"
+
 start_operator = DummyOperator(task_id='Begin_execution',  dag=dag)
 
+# lists the day's log file and skips everything after it when there is none,
+# set LOCAL_INPUT_ROOT to list a local copy of the bucket instead of S3
+local_input_root = os.environ.get('LOCAL_INPUT_ROOT')
+
+check_events_input = CheckInputOperator(
+    task_id='Check_events_input',
+    dag=dag,
+    prefix=log_prefix,
+    s3_bucket='udacity-dend',
+    local_root=local_input_root
+)
+
 stage_events_to_redshift = StageToRedshiftOperator(
     task_id='Stage_events',
-    dag=dag
+    dag=dag,
+    table='staging_events',
+    s3_bucket='udacity-dend',
+    s3_key=log_prefix,
+    json_path='s3://udacity-dend/log_json_path.json',
+    input_check_task_id='Check_events_input',
+    local_root=local_input_root
 )
 
 stage_songs_to_redshift = StageToRedshiftOperator(
     task_id='Stage_songs',
-    dag=dag
+    dag=dag,
+    table='staging_songs',
+    s3_bucket='udacity-dend',
+    s3_key='song_data'
 )
 
 load_songplays_table = LoadFactOperator(
@@ -63,3 +89,8 @@ run_quality_checks = DataQualityOperator(
 )
 
 end_operator = DummyOperator(task_id='Stop_execution',  dag=dag)
+
+start_operator >> check_events_input >> [stage_events_to_redshift, stage_songs_to_redshift] >> load_songplays_table
+load_songplays_table >> [load_user_dimension_table, load_song_dimension_table,
+                         load_artist_dimension_table, load_time_dimension_table] >> run_quality_checks
+run_quality_checks >> end_operator
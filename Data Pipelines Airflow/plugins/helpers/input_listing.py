@@ -0,0 +1,51 @@
+import os
+
+from airflow.hooks.S3_hook import S3Hook
+
+# (bucket or local root, prefix) -> stats, so a prefix is listed once per worker process
+_listings = {}
+
+
+def list_input(prefix, s3_bucket=None, aws_credentials_id='aws_credentials', local_root=None, refresh=False):
+    """
+    Lists the input files under a prefix and returns their count and total size,
+    from S3 or, when local_root is given, from a local directory standing in for the bucket.
+    The result is cached, so the pre-check and the staging of the same prefix share one listing.
+    """
+    cache_key = (local_root or s3_bucket, prefix)
+    if not refresh and cache_key in _listings:
+        return _listings[cache_key]
+
+    if local_root is not None:
+        sizes = _local_sizes(os.path.join(local_root, prefix))
+    else:
+        sizes = _s3_sizes(s3_bucket, prefix, aws_credentials_id)
+
+    stats = {'prefix': prefix, 'files': len(sizes), 'bytes': sum(sizes)}
+    _listings[cache_key] = stats
+    return stats
+
+
+def _local_sizes(path):
+    """
+    Sizes of the files under a path, read like an S3 key prefix
+    """
+    directory, name_prefix = (path, '') if os.path.isdir(path) else os.path.split(path)
+    sizes = []
+    for root, dirs, files in os.walk(directory):
+        for name in files:
+            full = os.path.join(root, name)
+            if os.path.relpath(full, directory).startswith(name_prefix):
+                sizes.append(os.path.getsize(full))
+    return sizes
+
+
+def _s3_sizes(s3_bucket, prefix, aws_credentials_id):
+    """
+    Sizes of the objects under a prefix, one paginated list_objects_v2 call
+    """
+    client = S3Hook(aws_conn_id=aws_credentials_id).get_conn()
+    sizes = []
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=s3_bucket, Prefix=prefix):
+        sizes += [obj['Size'] for obj in page.get('Contents', [])]
+    return sizes
@@ -0,0 +1,42 @@
+from airflow.models import BaseOperator, SkipMixin
+from airflow.utils.decorators import apply_defaults
+
+from helpers.input_listing import list_input
+
+class CheckInputOperator(BaseOperator, SkipMixin):
+    """
+    Lists the input prefix of the run before anything touches the cluster.
+    When it holds fewer than min_files files every downstream task is skipped,
+    so an interval without input costs one listing call. The file count and bytes are
+    returned as the task's XCom for the staging operators to size their load.
+    """
+    ui_color = '#E8D4A2'
+    template_fields = ('prefix',)
+
+    @apply_defaults
+    def __init__(self,
+                 prefix='',
+                 s3_bucket='',
+                 aws_credentials_id='aws_credentials',
+                 local_root=None,
+                 min_files=1,
+                 *args, **kwargs):
+
+        super(CheckInputOperator, self).__init__(*args, **kwargs)
+        self.prefix = prefix
+        self.s3_bucket = s3_bucket
+        self.aws_credentials_id = aws_credentials_id
+        self.local_root = local_root
+        self.min_files = min_files
+
+    def execute(self, context):
+        stats = list_input(self.prefix, self.s3_bucket, self.aws_credentials_id, self.local_root)
+        self.log.info('{files} files, {bytes} bytes under {prefix}'.format(**stats))
+
+        if stats['files'] < self.min_files:
+            downstream = context['task'].get_flat_relatives(upstream=False)
+            self.log.info('No input for this interval, skipping {} downstream tasks'.format(len(downstream)))
+            if downstream:
+                self.skip(context['dag_run'], context['ti'].execution_date, downstream)
+
+        return stats
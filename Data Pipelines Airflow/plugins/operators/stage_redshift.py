@@ -1,26 +1,78 @@
+from airflow.contrib.hooks.aws_hook import AwsHook
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.models import BaseOperator
 from airflow.utils.decorators import apply_defaults
 
+from helpers.input_listing import list_input
+
 class StageToRedshiftOperator(BaseOperator):
     ui_color = '#358140'
+    template_fields = ('s3_key',)
+
+    copy_sql = """
+        COPY {}
+        FROM 's3://{}/{}'
+        ACCESS_KEY_ID '{}'
+        SECRET_ACCESS_KEY '{}'
+        FORMAT AS JSON '{}'
+        {}
+    """
+
+    # below this many bytes the load is small, Redshift's compression and
+    # statistics analysis would take longer than the COPY itself
+    small_load_bytes = 64 * 1024 * 1024
 
     @apply_defaults
     def __init__(self,
-                 # Define your operators params (with defaults) here
-                 # Example:
-                 # redshift_conn_id=your-connection-name
+                 redshift_conn_id='redshift',
+                 aws_credentials_id='aws_credentials',
+                 table='',
+                 s3_bucket='',
+                 s3_key='',
+                 json_path='auto',
+                 input_check_task_id=None,
+                 local_root=None,
                  *args, **kwargs):
 
         super(StageToRedshiftOperator, self).__init__(*args, **kwargs)
-        # Map params here
-        # Example:
-        # self.conn_id = conn_id
-
-    def execute(self, context):
-        self.log.info('StageToRedshiftOperator not implemented yet')
-
+        self.redshift_conn_id = redshift_conn_id
+        self.aws_credentials_id = aws_credentials_id
+        self.table = table
+        self.s3_bucket = s3_bucket
+        self.s3_key = s3_key
+        self.json_path = json_path
+        self.input_check_task_id = input_check_task_id
+        self.local_root = local_root
 
+    def input_stats(self, context):
+        """
+        File count and bytes of the input, from the XCom of the pre-check task
+        or from a (cached) listing of the same key, in local_root when the pre-check
+        lists a local copy of the bucket. None without a pre-check task, the input
+        is then loaded without being listed
+        """
+        if not self.input_check_task_id:
+            return None
+        stats = context['ti'].xcom_pull(task_ids=self.input_check_task_id)
+        if stats and stats['prefix'] == self.s3_key:
+            return stats
+        return list_input(self.s3_key, self.s3_bucket, self.aws_credentials_id, self.local_root)
 
+    def execute(self, context):
+        stats = self.input_stats(context)
+        options = ''
+        if stats is not None:
+            self.log.info('Staging {files} files, {bytes} bytes from {prefix} into {table}'.format(table=self.table, **stats))
+            if stats['files'] == 0:
+                self.log.info('Nothing to stage')
+                return
+            if stats['bytes'] < self.small_load_bytes:
+                options = 'COMPUPDATE OFF STATUPDATE OFF'
 
+        credentials = AwsHook(self.aws_credentials_id).get_credentials()
+        redshift = PostgresHook(postgres_conn_id=self.redshift_conn_id)
 
+        redshift.run('DELETE FROM {}'.format(self.table))
+        redshift.run(self.copy_sql.format(self.table, self.s3_bucket, self.s3_key,
+                                          credentials.access_key, credentials.secret_key,
+                                          self.json_path, options))
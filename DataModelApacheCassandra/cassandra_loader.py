@@ -0,0 +1,178 @@
+import csv
+import gzip
+import sys
+import time
+from collections import deque
+
+from cassandra.query import BatchStatement, BatchType
+
+from cql_queries import *
+
+from table_generator import row_converter
+
+# the generated tables to load, their csv columns and partition keys come from the query specs
+load_tables = [session_item, user_session, user_song]
+
+
+class InFlightWindow:
+    '''
+    keeps at most `size` async requests running,
+    waiting for the oldest one before a new one is sent
+    '''
+
+    def __init__(self, session, size):
+        self.session = session
+        self.size = size
+        self.futures = deque()
+
+    def submit(self, statement, values=None):
+        if len(self.futures) >= self.size:
+            self.futures.popleft().result()
+        self.futures.append(self.session.execute_async(statement, values))
+
+    def drain(self):
+        while self.futures:
+            self.futures.popleft().result()
+
+
+class PartitionBatcher:
+    '''
+    groups the rows of one table by partition key and sends each group
+    as an unlogged batch, so every batch is written by a single replica
+    '''
+
+    def __init__(self, window, prepared, key_columns, batch_size, max_buffered):
+        self.window = window
+        self.prepared = prepared
+        self.key_columns = key_columns
+        self.batch_size = batch_size
+        self.max_buffered = max_buffered
+        self.partitions = {}
+        self.buffered = 0
+        self.rows = 0
+
+    def add(self, values):
+        rows = self.partitions.setdefault(values[:self.key_columns], [])
+        rows.append(values)
+        self.buffered += 1
+        self.rows += 1
+        if len(rows) >= self.batch_size:
+            self.flush(values[:self.key_columns])
+        elif self.buffered >= self.max_buffered:
+            self.flush_all()
+
+    def flush(self, key):
+        rows = self.partitions.pop(key)
+        self.buffered -= len(rows)
+        if len(rows) == 1:
+            self.window.submit(self.prepared, rows[0])
+            return
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for values in rows:
+            batch.add(self.prepared, values)
+        self.window.submit(batch)
+
+    def flush_all(self):
+        for key in list(self.partitions):
+            self.flush(key)
+
+
+def load_events(session, filepath, tables=load_tables, concurrency=128, batch_size=50, max_buffered=20000):
+    '''
+    reads the event csv once and loads every query table from it
+    (the generated definitions of cql_queries.py) with prepared statements,
+    partition-aware unlogged batches and at most `concurrency` requests in flight.
+    returns the number of rows written per table
+    '''
+    window = InFlightWindow(session, concurrency)
+
+    start = time.time()
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rt', encoding='utf8', newline='') as f:
+        csvreader = csv.reader(f)
+        header = next(csvreader)
+        # the partition key columns come first in every generated table
+        batchers = [(d['table'], row_converter(d, header),
+                     PartitionBatcher(window, session.prepare(d['insert']), len(d['partition_key']), batch_size, max_buffered))
+                    for d in tables]
+        for line in csvreader:
+            for name, to_values, batcher in batchers:
+                batcher.add(to_values(line))
+
+    for name, to_values, batcher in batchers:
+        batcher.flush_all()
+    window.drain()
+    seconds = time.time() - start
+
+    rows = {name: batcher.rows for name, to_values, batcher in batchers}
+    total = sum(rows.values())
+    for name, count in rows.items():
+        print('{}: {} rows'.format(name, count))
+    print('{} rows loaded in {:.2f}s ({:.0f} rows/sec)'.format(total, seconds, total / seconds if seconds else 0))
+    return rows
+
+
+class StubFuture:
+    def result(self):
+        return []
+
+
+class StubSession:
+    '''
+    stands in for a cassandra session, it accepts every statement
+    and counts them, so the loader can run without a cluster
+    '''
+
+    def __init__(self):
+        self.statements = 0
+
+    def prepare(self, query):
+        # a plain statement with %s markers, so batches still bind and encode the values
+        return query.replace('?', '%s')
+
+    def execute(self, statement, values=None):
+        self.statements += 1
+        return []
+
+    def execute_async(self, statement, values=None):
+        self.statements += 1
+        return StubFuture()
+
+
+def create_session(hosts=('127.0.0.1',)):
+    '''
+    connects to the cluster, creates the keyspace and the tables
+    and returns the cluster and session
+    '''
+    from cassandra.cluster import Cluster
+
+    cluster = Cluster(list(hosts))
+    session = cluster.connect()
+    session.execute(keyspace_create)
+    session.set_keyspace(keyspace)
+    for query in create_table_queries:
+        session.execute(query)
+    return cluster, session
+
+
+def main():
+    '''
+    loads event_datafile_new.csv (or the csv / csv.gz given) into the
+    local cassandra node, or into a stub session with --stub
+    '''
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    filepath = args[0] if args else 'event_datafile_new.csv'
+    if '--stub' in sys.argv:
+        load_events(StubSession(), filepath)
+        return
+
+    cluster, session = create_session()
+    try:
+        load_events(session, filepath)
+    finally:
+        session.shutdown()
+        cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
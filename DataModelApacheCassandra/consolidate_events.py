@@ -0,0 +1,111 @@
+import csv
+import glob
+import gzip
+import os
+import shutil
+import sys
+import tempfile
+from multiprocessing import Pool
+
+# columns kept in event_datafile_new.csv and their position in the event_data files
+output_columns = ['artist','firstName','gender','itemInSession','lastName','length',
+                  'level','location','sessionId','song','userId']
+source_columns = (0, 2, 3, 4, 5, 6, 7, 8, 12, 13, 16)
+
+csv.register_dialect('myDialect', quoting=csv.QUOTE_ALL, skipinitialspace=True)
+
+
+def event_files(filepath):
+    '''
+    walks every subdirectory of filepath
+    and yields the event csv files in a stable order
+    '''
+    for root, dirs, files in os.walk(filepath):
+        dirs.sort()
+        for f in sorted(glob.glob(os.path.join(root, '*.csv'))):
+            yield f
+
+
+def open_output(output):
+    '''
+    opens the consolidated file for writing, gzip compressed when it ends with .gz
+    '''
+    if output.endswith('.gz'):
+        return gzip.open(output, 'wt', encoding='utf8', newline='')
+    return open(output, 'w', encoding='utf8', newline='')
+
+
+def copy_rows(filepath, writer):
+    '''
+    streams the rows of one event file into the writer,
+    keeping only the output columns of rows with an artist.
+    returns the number of rows written
+    '''
+    count = 0
+    with open(filepath, 'r', encoding='utf8', newline='') as csvfile:
+        csvreader = csv.reader(csvfile)
+        next(csvreader, None)
+        for row in csvreader:
+            if not row or row[0] == '':
+                continue
+            writer.writerow([row[i] for i in source_columns])
+            count += 1
+    return count
+
+
+def write_part(args):
+    '''
+    converts one event file into a headerless part file, run in a worker process
+    '''
+    filepath, part = args
+    with open(part, 'w', encoding='utf8', newline='') as f:
+        return copy_rows(filepath, csv.writer(f, dialect='myDialect'))
+
+
+def consolidate(filepath, output='event_datafile_new.csv', processes=1):
+    '''
+    pipes the rows of every event file straight into the output csv.
+    only one row (or one part file per worker) is held at a time,
+    so memory does not grow with the number of days of events.
+    returns the number of files and rows written
+    '''
+    files = list(event_files(filepath))
+    rows = 0
+    with open_output(output) as f:
+        writer = csv.writer(f, dialect='myDialect')
+        writer.writerow(output_columns)
+
+        if processes <= 1:
+            for datafile in files:
+                rows += copy_rows(datafile, writer)
+        else:
+            tmpdir = tempfile.mkdtemp()
+            try:
+                parts = [(datafile, os.path.join(tmpdir, '{:06d}.csv'.format(i))) for i, datafile in enumerate(files)]
+                with Pool(processes) as pool:
+                    # imap keeps the file order, each part is appended as soon as it is ready
+                    for (datafile, part), count in zip(parts, pool.imap(write_part, parts)):
+                        with open(part, 'r', encoding='utf8', newline='') as p:
+                            shutil.copyfileobj(p, f)
+                        os.remove(part)
+                        rows += count
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print('{} rows from {} files written to {}'.format(rows, len(files), output))
+    return len(files), rows
+
+
+def main():
+    '''
+    consolidates event_data into event_datafile_new.csv,
+    usage: python consolidate_events.py [processes] [--gzip]
+    '''
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    processes = int(args[0]) if args else 1
+    output = 'event_datafile_new.csv.gz' if '--gzip' in sys.argv else 'event_datafile_new.csv'
+    consolidate(os.path.join(os.getcwd(), 'event_data'), output, processes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+from table_generator import query_specs, table_definition
+
+# KEYSPACE
+
+keyspace = "udacity"
+
+keyspace_create = ("""
+    CREATE KEYSPACE IF NOT EXISTS udacity
+    WITH REPLICATION =
+    { 'class' : 'SimpleStrategy', 'replication_factor' : 1 }
+""")
+
+# TABLES, generated from the query specs of table_generator.py
+
+# table name -> primary key, statements and csv columns of the table serving its query
+table_definitions = {spec['table']: table_definition(spec) for spec in query_specs}
+
+# Query 1: artist, song title and song's length heard during sessionId = 338, and itemInSession = 4
+session_item = table_definitions['session_item']
+# Query 2: artist, song (sorted by itemInSession) and user name for userid = 10, sessionid = 182
+user_session = table_definitions['user_session']
+# Query 3: every user name who listened to the song 'All Hands Against His Own'
+user_song = table_definitions['user_song']
+
+# DROP TABLES
+
+session_item_table_drop = session_item['drop']
+user_session_table_drop = user_session['drop']
+user_song_table_drop = user_song['drop']
+
+# CREATE TABLES
+
+session_item_table_create = session_item['create']
+user_session_table_create = user_session['create']
+user_song_table_create = user_song['create']
+
+# INSERT RECORDS
+
+session_item_insert = session_item['insert']
+user_session_insert = user_session['insert']
+user_song_insert = user_song['insert']
+
+# FIND SONGS
+
+session_item_select = session_item['select']
+user_session_select = user_session['select']
+user_song_select = user_song['select']
+
+# QUERY LISTS
+
+create_table_queries = [session_item_table_create, user_session_table_create, user_song_table_create]
+drop_table_queries = [session_item_table_drop, user_session_table_drop, user_song_table_drop]
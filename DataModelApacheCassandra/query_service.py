@@ -0,0 +1,174 @@
+import csv
+import sys
+import time
+from collections import OrderedDict
+
+from cql_queries import *
+
+
+class TTLCache:
+    '''
+    least recently used cache whose entries also expire after `ttl` seconds
+    '''
+
+    def __init__(self, maxsize=10000, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+
+class QueryService:
+    '''
+    read path over the three query tables: prepared selects,
+    a configurable page size and an LRU/TTL cache for hot keys
+    '''
+
+    def __init__(self, session, fetch_size=500, cache_size=10000, cache_ttl=60):
+        self.session = session
+        self.session.default_fetch_size = fetch_size
+        self.cache = TTLCache(cache_size, cache_ttl) if cache_size else None
+        self.statements = {
+            'session_item': session.prepare(session_item_select),
+            'user_session': session.prepare(user_session_select),
+            'user_song': session.prepare(user_song_select),
+        }
+
+    def query(self, table, *values):
+        '''
+        runs the prepared select of a table. a result that fits in one page is
+        returned as a tuple of rows, the same immutable tuple is cached and handed
+        to every later lookup of the key. a result of several pages is returned as
+        the driver's paged ResultSet, not cached, and the pages after the first are
+        only fetched as it is iterated
+        '''
+        key = (table,) + values
+        if self.cache is not None:
+            rows = self.cache.get(key)
+            if rows is not None:
+                return rows
+        result = self.session.execute(self.statements[table], values)
+        if getattr(result, 'has_more_pages', False):
+            return result
+        # the whole result is in the first page, reading it fetches nothing more
+        rows = tuple(result)
+        if self.cache is not None:
+            self.cache.put(key, rows)
+        return rows
+
+    def session_item(self, session_id, item_in_session):
+        '''
+        artist, song and length heard in a session at a given item
+        '''
+        return self.query('session_item', session_id, item_in_session)
+
+    def user_session(self, user_id, session_id):
+        '''
+        artist, song and user name of a user's session, ordered by item_in_session
+        '''
+        return self.query('user_session', user_id, session_id)
+
+    def song_listeners(self, song):
+        '''
+        every user who listened to a song
+        '''
+        return self.query('user_song', song)
+
+
+def create_session(hosts=('127.0.0.1',)):
+    '''
+    connects with token-aware routing, so each prepared select
+    goes straight to a replica of its partition
+    '''
+    from cassandra.cluster import Cluster, ExecutionProfile, EXEC_PROFILE_DEFAULT
+    from cassandra.policies import TokenAwarePolicy, DCAwareRoundRobinPolicy
+
+    profile = ExecutionProfile(load_balancing_policy=TokenAwarePolicy(DCAwareRoundRobinPolicy()))
+    cluster = Cluster(list(hosts), execution_profiles={EXEC_PROFILE_DEFAULT: profile})
+    session = cluster.connect(keyspace)
+    return cluster, session
+
+
+def lookup_keys(filepath, limit=1000):
+    '''
+    collects (user_id, session_id) pairs from the event csv to replay as lookups
+    '''
+    keys = []
+    seen = set()
+    with open(filepath, encoding='utf8', newline='') as f:
+        csvreader = csv.DictReader(f)
+        for row in csvreader:
+            key = (int(row['userId']), int(row['sessionId']))
+            if key not in seen:
+                seen.add(key)
+                keys.append(key)
+            if len(keys) >= limit:
+                break
+    return keys
+
+
+def percentile(latencies, p):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def benchmark(service, keys, lookups=20000):
+    '''
+    replays user_session lookups over the keys, like the dashboard does,
+    and prints the p50/p99 latency and the cache hit rate
+    '''
+    latencies = []
+    for i in range(lookups):
+        user_id, session_id = keys[i % len(keys)]
+        start = time.perf_counter()
+        service.user_session(user_id, session_id)
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    print('{} lookups: p50 {:.3f} ms, p99 {:.3f} ms'.format(
+        lookups, percentile(latencies, 0.50), percentile(latencies, 0.99)))
+    if service.cache is not None:
+        print('cache hit rate {:.1%}'.format(service.cache.hits / max(1, service.cache.hits + service.cache.misses)))
+    return latencies
+
+
+def main():
+    '''
+    benchmarks the user_session lookups against the local cassandra node
+    (or a stub session with --stub), with and without the cache
+    '''
+    keys = lookup_keys('event_datafile_new.csv')
+    if '--stub' in sys.argv:
+        from cassandra_loader import StubSession
+        cluster, session = None, StubSession()
+    else:
+        cluster, session = create_session()
+
+    try:
+        for cache_size in (0, 10000):
+            print('cache size {}'.format(cache_size))
+            benchmark(QueryService(session, cache_size=cache_size), keys)
+    finally:
+        if cluster is not None:
+            cluster.shutdown()
+
+
+if __name__ == "__main__":
+    main()
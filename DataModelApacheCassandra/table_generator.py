@@ -0,0 +1,241 @@
+'''
+Query-driven table generator for the Cassandra tables.
+
+Every table is described by the query it serves: the columns it selects,
+the columns in its WHERE clause and the columns the result is ordered or
+made unique by. From that the generator derives the primary key, the
+CREATE TABLE / DROP / INSERT / SELECT statements (cql_queries.py is
+built from them) and the csv column each value comes from, which the
+loader reads its rows with. analyze_partitions reads the event csv once and estimates the rows
+and bytes of every partition, warning about hot or oversized partitions
+and suggesting a composite or bucketed partition key.
+'''
+import csv
+import gzip
+import math
+import sys
+
+# cql type and event_datafile_new.csv column of every column a table can use
+column_types = {
+    'artist': ('text', 'artist'),
+    'first_name': ('text', 'firstName'),
+    'gender': ('text', 'gender'),
+    'item_in_session': ('int', 'itemInSession'),
+    'last_name': ('text', 'lastName'),
+    'length': ('float', 'length'),
+    'level': ('text', 'level'),
+    'location': ('text', 'location'),
+    'session_id': ('int', 'sessionId'),
+    'song': ('text', 'song'),
+    'user_id': ('int', 'userId'),
+}
+
+# python type a csv value is converted to before it is bound to a column of each cql type
+cql_converters = {'text': str, 'int': int, 'float': float, 'bigint': int, 'double': float}
+
+# where: equality columns of the query, clustering: columns the rows are ordered or made unique by
+query_specs = [
+    {'table': 'session_item',
+     'query': "artist, song title and song's length heard during sessionId = 338, and itemInSession = 4",
+     'select': ['artist', 'song', 'length'],
+     'where': ['session_id', 'item_in_session'],
+     'clustering': ['item_in_session']},
+    {'table': 'user_session',
+     # partitioned by user and session, a partition by user_id alone grows with every session of the user
+     'query': 'artist, song (sorted by itemInSession) and user name for userid = 10, sessionid = 182',
+     'select': ['artist', 'song', 'first_name', 'last_name'],
+     'where': ['user_id', 'session_id'],
+     'clustering': ['item_in_session']},
+    {'table': 'user_song',
+     # partitioned by song so the query reads one partition instead of needing ALLOW FILTERING
+     'query': "every user name who listened to the song 'All Hands Against His Own'",
+     'select': ['user_id', 'first_name', 'last_name'],
+     'where': ['song'],
+     'clustering': ['user_id']},
+]
+
+# rough on-disk size of the fixed width types, text is counted by its utf8 length
+type_bytes = {'int': 4, 'float': 4, 'bigint': 8, 'double': 8}
+# per row overhead (timestamps, clustering prefix, row header), an estimate
+ROW_OVERHEAD = 16
+
+# partitions above these are reported as oversized
+MAX_PARTITION_ROWS = 100000
+MAX_PARTITION_BYTES = 100 * 1024 * 1024
+# partitions with more than HOT_FACTOR times the mean rows (and at least HOT_MIN_ROWS) are reported as hot
+HOT_FACTOR = 10
+HOT_MIN_ROWS = 1000
+
+
+def table_definition(spec):
+    '''
+    derives the primary key, the CREATE TABLE / DROP / INSERT / SELECT statements
+    and the csv column mapping of the table serving one query spec
+    '''
+    clustering = list(spec.get('clustering', []))
+    partition_key = list(spec.get('partition_key') or [c for c in spec['where'] if c not in clustering])
+    columns = []
+    for c in partition_key + clustering + spec['select']:
+        if c not in columns:
+            columns.append(c)
+
+    if len(partition_key) > 1:
+        key = '({})'.format(', '.join(partition_key))
+    else:
+        key = partition_key[0]
+    primary_key = ', '.join([key] + clustering)
+
+    drop = "DROP TABLE IF EXISTS {}".format(spec['table'])
+    create = "CREATE TABLE IF NOT EXISTS {} (\n{},\n        PRIMARY KEY ({})\n    )".format(
+        spec['table'], ',\n'.join('        {} {}'.format(c, column_types[c][0]) for c in columns), primary_key)
+    insert = "INSERT INTO {} ({})\n    VALUES ({})".format(
+        spec['table'], ', '.join(columns), ', '.join('?' for c in columns))
+    select = "SELECT {} FROM {}\n    WHERE {}".format(
+        ', '.join(spec['select']), spec['table'], ' AND '.join('{} = ?'.format(c) for c in spec['where']))
+
+    return {
+        'table': spec['table'],
+        'columns': columns,
+        'partition_key': partition_key,
+        'clustering': clustering,
+        'where': spec['where'],
+        'create': create,
+        'drop': drop,
+        'insert': insert,
+        'select': select,
+        'csv_columns': [column_types[c][1] for c in columns],
+    }
+
+
+def row_converter(definition, header):
+    '''
+    returns the function turning a line of the event csv (with this header)
+    into the values of the table's INSERT, in its column order
+    '''
+    positions = {name: i for i, name in enumerate(header)}
+    cells = [(positions[csv_column], cql_converters[column_types[c][0]])
+             for c, csv_column in zip(definition['columns'], definition['csv_columns'])]
+    return lambda line: tuple(convert(line[i]) for i, convert in cells)
+
+
+def value_bytes(column, value):
+    '''
+    estimated bytes of one cell
+    '''
+    cql_type = column_types[column][0]
+    return type_bytes.get(cql_type, len(value.encode('utf8')))
+
+
+def analyze_partitions(filepath, definitions):
+    '''
+    reads the event csv once and estimates the rows and bytes of every partition
+    of every table. returns a report per table with the partition stats,
+    the hot and oversized partitions and a suggested partition key.
+    lines with the same primary key are upserted into one row, like cassandra does,
+    so a partition holds one row per distinct clustering key
+    '''
+    # table -> partition key -> clustering key -> bytes of the row
+    partitions = {d['table']: {} for d in definitions}
+
+    opener = gzip.open if filepath.endswith('.gz') else open
+    with opener(filepath, 'rt', encoding='utf8', newline='') as f:
+        csvreader = csv.reader(f)
+        header = next(csvreader)
+        positions = {name: i for i, name in enumerate(header)}
+        layouts = [(d, [positions[column_types[c][1]] for c in d['partition_key']],
+                    [positions[column_types[c][1]] for c in d['clustering']],
+                    [(c, positions[column_types[c][1]]) for c in d['columns']]) for d in definitions]
+        for line in csvreader:
+            for d, key_positions, clustering_positions, cells in layouts:
+                key = tuple(line[i] for i in key_positions)
+                rows = partitions[d['table']].setdefault(key, {})
+                rows[tuple(line[i] for i in clustering_positions)] = \
+                    ROW_OVERHEAD + sum(value_bytes(c, line[i]) for c, i in cells)
+
+    # [rows, bytes] of every partition
+    return [partition_report(d, {key: [len(rows), sum(rows.values())] for key, rows in partitions[d['table']].items()})
+            for d in definitions]
+
+
+def partition_report(definition, partitions):
+    '''
+    summarizes the partitions of one table and suggests a better partition key
+    when some partitions are hot or oversized
+    '''
+    rows = sorted(stats[0] for stats in partitions.values())
+    total = sum(rows)
+    mean = total / len(rows) if rows else 0
+    p99 = rows[min(len(rows) - 1, int(len(rows) * 0.99))] if rows else 0
+
+    hot = [(key, stats) for key, stats in partitions.items() 
+           if stats[0] > max(HOT_FACTOR * mean, HOT_MIN_ROWS)]
+    oversized = [(key, stats) for key, stats in partitions.items()
+                 if stats[0] > MAX_PARTITION_ROWS or stats[1] > MAX_PARTITION_BYTES]
+
+    report = {
+        'table': definition['table'],
+        'partition_key': definition['partition_key'],
+        'partitions': len(rows),
+        'rows': total,
+        'mean_rows': mean,
+        'p99_rows': p99,
+        'max_rows': rows[-1] if rows else 0,
+        'max_bytes': max((stats[1] for stats in partitions.values()), default=0),
+        'hot': sorted(hot, key=lambda item: -item[1][0])[:10],
+        'oversized': oversized,
+        'suggestion': None,
+    }
+    if hot or oversized:
+        report['suggestion'] = suggest_partition_key(definition, report)
+    return report
+
+
+def suggest_partition_key(definition, report):
+    '''
+    a WHERE column that is only a clustering column can move into the partition key
+    and the query still finds its partition, otherwise a bucket column spreads the
+    rows of a partition over enough buckets to stay under the limits
+    '''
+    for c in definition['clustering']:
+        if c in definition['where']:
+            partition_key = definition['partition_key'] + [c]
+            clustering = [k for k in definition['clustering'] if k != c]
+            return 'composite partition key: PRIMARY KEY (({}){})'.format(
+                ', '.join(partition_key), ''.join(', ' + k for k in clustering))
+
+    buckets = max(2, math.ceil(report['max_rows'] / max(1, report['mean_rows'] * HOT_FACTOR)),
+                  math.ceil(report['max_rows'] / MAX_PARTITION_ROWS),
+                  math.ceil(report['max_bytes'] / MAX_PARTITION_BYTES))
+    return ('bucketed partition key: add bucket int = hash({}) % {} and use PRIMARY KEY (({}, bucket){}), '
+            'reads query the {} buckets in parallel').format(
+                definition['clustering'][0] if definition['clustering'] else definition['columns'][-1], buckets,
+                ', '.join(definition['partition_key']), ''.join(', ' + k for k in definition['clustering']), buckets)
+
+
+def print_report(report):
+    print('{}: {} rows in {} partitions of ({}), mean {:.1f} / p99 {} / max {} rows, max {:.1f} KB'.format(
+        report['table'], report['rows'], report['partitions'], ', '.join(report['partition_key']),
+        report['mean_rows'], report['p99_rows'], report['max_rows'], report['max_bytes'] / 1024))
+    for key, (rows, size) in report['hot']:
+        print('    WARNING hot partition {}: {} rows, {:.1f} KB'.format(key, rows, size / 1024))
+    for key, (rows, size) in report['oversized']:
+        print('    WARNING oversized partition {}: {} rows, {:.1f} KB'.format(key, rows, size / 1024))
+    if report['suggestion']:
+        print('    suggestion: ' + report['suggestion'])
+
+
+def main():
+    '''
+    prints the generated statements of every query spec and the partition
+    analysis of event_datafile_new.csv (or the csv / csv.gz given)
+    '''
+    filepath = sys.argv[1] if len(sys.argv) > 1 else 'event_datafile_new.csv'
+    definitions = [table_definition(spec) for spec in query_specs]
+    for d in definitions:
+        print('-- {}\n{};\n{};\n{};\n'.format(d['table'], d['create'], d['insert'], d['select']))
+    for report in analyze_partitions(filepath, definitions):
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+'''
+SQL backends of sparkifydb: the local Postgres server or an embedded DuckDB
+database file, which needs no server and runs in the etl process.
+
+The schema and the statements of sql_queries.py are shared. DuckDBCursor
+rewrites the few Postgres-only parts on the fly (%s parameters, SERIAL,
+foreign keys, materialized views, the catalog queries) and insert_frame
+inserts a whole pandas dataframe with one statement on either backend:
+DuckDB scans the dataframe in place, Postgres gets the rows in batches.
+
+    python create_tables.py --backend duckdb
+    python etl.py --backend duckdb
+
+--database NAME loads another database than sparkifydb (or NAME.duckdb).
+The benchmark loads its own, sparkifydb_benchmark, so it never drops the
+sparkifydb being worked on.
+
+usage: python backends.py benchmark [backend ...]
+'''
+import os
+import re
+import subprocess
+import sys
+import time
+
+from sql_queries import songplay_partitions_select, table_sizes_select
+
+BACKENDS = ('postgres', 'duckdb')
+DATABASE = 'sparkifydb'
+BENCHMARK_DATABASE = 'sparkifydb_benchmark'
+POSTGRES_DSN = "host=127.0.0.1 dbname={} user=student password=student"
+DUCKDB_FILE = '{}.duckdb'
+BATCH_ROWS = 1000
+RUNS = 20
+
+# (Postgres pattern, DuckDB replacement)
+TRANSLATIONS = [
+    (r'%s', '?'),
+    (r'\s*REFERENCES\s+\w+\s*\(\w+\)', ''),
+    (r'\bnumeric\b', 'DOUBLE'),
+    (r'\)\s*PARTITION BY RANGE\s*\(\w+\)', ')'),
+    (r'DROP MATERIALIZED VIEW', 'DROP TABLE'),
+]
+
+# catalog queries of Postgres and their DuckDB equivalent
+QUERIES = {
+    # songplay_fact is never partitioned on DuckDB
+    songplay_partitions_select: "SELECT NULL, NULL, NULL WHERE false",
+    table_sizes_select: """
+        SELECT table_name, estimated_size, 0
+        FROM duckdb_tables()
+        WHERE table_name IN ('songplay_fact', 'location', 'user_agent')
+        ORDER BY table_name""",
+}
+
+# the foreign keys are not created on DuckDB, so there is nothing to drop or add back
+SKIPPED = re.compile(r'\s*ALTER TABLE \w+\s+(DROP|ADD) CONSTRAINT', re.I)
+
+CREATE_TABLE = re.compile(r'\s*CREATE TABLE IF NOT EXISTS (\w+)', re.I)
+MATERIALIZED_VIEW = re.compile(r'\s*CREATE MATERIALIZED VIEW IF NOT EXISTS (\w+) AS(.*)', re.S | re.I)
+REFRESH = re.compile(r'\s*REFRESH MATERIALIZED VIEW (?:CONCURRENTLY )?(\w+)', re.I)
+VALUES = re.compile(r'VALUES\s*\(\s*%s(\s*,\s*%s)*\s*\)', re.I)
+FRAME = '_frame'
+
+
+def backend_arg(argv=None):
+    '''
+    the backend given with --backend, postgres by default
+    '''
+    argv = sys.argv if argv is None else argv
+    backend = argv[argv.index('--backend') + 1] if '--backend' in argv else 'postgres'
+    if backend not in BACKENDS:
+        raise ValueError('Unknown backend {}, expected one of {}'.format(backend, list(BACKENDS)))
+    return backend
+
+
+def database_arg(argv=None):
+    '''
+    the database given with --database, sparkifydb by default
+    '''
+    argv = sys.argv if argv is None else argv
+    return argv[argv.index('--database') + 1] if '--database' in argv else DATABASE
+
+
+class DuckDBCursor:
+    '''
+    DuckDB connection used like a psycopg2 cursor, running the Postgres statements of
+    sql_queries.py. statements run in a transaction until the connection commits, like psycopg2
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.rowcount = -1
+
+    def __getattr__(self, name):
+        return getattr(self.conn.db, name)
+
+    def translate(self, query):
+        if query in QUERIES:
+            return QUERIES[query]
+        table = CREATE_TABLE.match(query)
+        if table:
+            # SERIAL columns take their values from a sequence of their own
+            for column in re.findall(r'(\w+) SERIAL\b', query, re.I):
+                sequence = '{}_{}_seq'.format(table.group(1), column)
+                self.conn.db.execute('CREATE SEQUENCE IF NOT EXISTS {}'.format(sequence))
+                query = re.sub(r'\b{} SERIAL\b'.format(column), "{} INTEGER DEFAULT nextval('{}')".format(column, sequence), query)
+        view = MATERIALIZED_VIEW.match(query)
+        if view:
+            # materialized views are tables filled from the definition on every refresh
+            self.conn.views[view.group(1)] = view.group(2)
+            query = 'CREATE TABLE IF NOT EXISTS {} AS {}'.format(view.group(1), view.group(2))
+        for pattern, replacement in TRANSLATIONS:
+            query = re.sub(pattern, replacement, query, flags=re.I)
+        return query
+
+    def execute(self, query, vars=None):
+        if SKIPPED.match(query):
+            return
+        self.conn.begin()
+        refresh = REFRESH.match(query)
+        if refresh:
+            name = refresh.group(1)
+            self.conn.db.execute('DELETE FROM {}'.format(name))
+            # DuckDB checks the unique index against the deleted rows until the delete is committed
+            self.conn.commit()
+            self.conn.begin()
+            self.conn.db.execute('INSERT INTO {} {}'.format(name, self.conn.views[name]))
+            return
+
+        self.conn.db.execute(self.translate(query), None if vars is None else list(vars))
+        self.rowcount = -1
+        writes = re.match(r'\s*(INSERT|UPDATE|DELETE)\b', query, re.I) or \
+            (re.match(r'\s*WITH\b', query, re.I) and re.search(r'\bINSERT INTO\b', query, re.I))
+        if writes and not re.search(r'\bRETURNING\b', query, re.I):
+            # DuckDB returns the count of changed rows as the result
+            row = self.conn.db.fetchone()
+            self.rowcount = row[0] if row else -1
+
+    def insert_frame(self, query, df):
+        '''
+        runs an INSERT ... VALUES (%s, ...) query for all the rows of df at once,
+        selecting them from the dataframe instead of the VALUES list
+        '''
+        self.conn.begin()
+        self.conn.db.register(FRAME, df)
+        try:
+            self.conn.db.execute(self.translate(VALUES.sub('SELECT * FROM {}'.format(FRAME), query)))
+        finally:
+            self.conn.db.unregister(FRAME)
+
+
+class DuckDBConnection:
+    '''
+    DuckDB database with the commit/rollback/close of a psycopg2 connection
+    '''
+
+    def __init__(self, path=DUCKDB_FILE.format(DATABASE)):
+        import duckdb
+
+        self.db = duckdb.connect(path)
+        self.views = {}
+        self.in_transaction = False
+
+    def begin(self):
+        if not self.in_transaction:
+            self.db.begin()
+            self.in_transaction = True
+
+    def commit(self):
+        if self.in_transaction:
+            self.db.commit()
+            self.in_transaction = False
+
+    def rollback(self):
+        if self.in_transaction:
+            self.db.rollback()
+            self.in_transaction = False
+
+    def cursor(self):
+        return DuckDBCursor(self)
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+def connect(backend='postgres', database=DATABASE):
+    '''
+    connects to the sparkify database of the backend
+    and returns the cursor and connection.
+    psycopg2 is only needed for Postgres
+    '''
+    if backend == 'duckdb':
+        conn = DuckDBConnection(DUCKDB_FILE.format(database))
+    else:
+        import psycopg2
+
+        conn = psycopg2.connect(POSTGRES_DSN.format(database))
+    return conn.cursor(), conn
+
+
+def create_database(database=DATABASE):
+    '''
+    starts a new, empty DuckDB database file and returns its cursor and connection
+    '''
+    path = DUCKDB_FILE.format(database)
+    for name in (path, path + '.wal'):
+        if os.path.exists(name):
+            os.remove(name)
+    return connect('duckdb', database)
+
+
+def insert_frame(cur, query, df):
+    '''
+    inserts every row of df with an INSERT ... VALUES (%s, ...) query of sql_queries.py,
+    the columns of df in the order of the query
+    '''
+    if isinstance(cur, DuckDBCursor):
+        cur.insert_frame(query, df)
+        return
+    from psycopg2.extras import execute_batch
+
+    # python values for psycopg2, missing values as NULL
+    rows = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+    execute_batch(cur, query, rows, page_size=BATCH_ROWS)
+
+
+def median_ms(cur, query, params=None, runs=RUNS):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        cur.execute(query, params)
+        cur.fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def benchmark(backends=BACKENDS):
+    '''
+    runs create_tables.py and the full etl.py load on every backend, from the same
+    data files, then compares the row counts and times the benchmark.py query set.
+    everything is loaded into BENCHMARK_DATABASE, which create_tables.py drops first
+    '''
+    from benchmark import benchmark_queries
+
+    results = {}
+    for backend in backends:
+        start = time.time()
+        for script in ('create_tables.py', 'etl.py'):
+            subprocess.run([sys.executable, script, '--backend', backend, '--database', BENCHMARK_DATABASE],
+                           check=True, stdout=subprocess.DEVNULL)
+        load_seconds = time.time() - start
+
+        cur, conn = connect(backend, BENCHMARK_DATABASE)
+        counts = {}
+        for table in ('songplay', 'users', 'song', 'artist', 'time', 'sessions'):
+            cur.execute('SELECT count(*) FROM {}'.format(table))
+            counts[table] = cur.fetchone()[0]
+        timings = {name: median_ms(cur, query, params) for name, query, params in benchmark_queries(cur)}
+        conn.close()
+
+        results[backend] = (load_seconds, counts, timings)
+        print('{}: full load in {:.2f}s, {}'.format(backend, load_seconds,
+                                                    ', '.join('{} {}'.format(t, n) for t, n in counts.items())))
+
+    if len({str(counts) for load_seconds, counts, timings in results.values()}) > 1:
+        print('the backends loaded different row counts')
+    names = list(results.values())[0][2]
+    print('{:<15}'.format('') + ''.join('{:>14}'.format(backend) for backend in results))
+    for name in names:
+        print('{:<15}'.format(name) + ''.join('{:>11.3f} ms'.format(results[backend][2][name]) for backend in results))
+    return results
+
+
+def main():
+    if sys.argv[1:2] == ['benchmark']:
+        benchmark(sys.argv[2:] or BACKENDS)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+'''
+Benchmark query set for sparkifydb: the song_select lookup of the etl,
+top songs, per-user activity, hourly trends and one month of plays.
+
+Each query is timed and its EXPLAIN (ANALYZE, BUFFERS) plan is written to
+query_plans_<label>.txt. With --compare the queries also run with the
+indexes of index_queries dropped inside a transaction that is rolled back,
+so the gain of every index shows up without changing the database.
+
+usage: python benchmark.py [label] [--compare]
+'''
+import sys
+import time
+
+from etl import connect
+from sql_queries import *
+
+RUNS = 20
+
+
+def benchmark_queries(cur):
+    '''
+    (name, query, parameters) of the query set, the parameters come from
+    the loaded data: a song that song_select finds, the most active user
+    and the first month of songplays
+    '''
+    cur.execute("""SELECT song.title, artist.name, song.duration
+                   FROM song JOIN artist ON artist.artist_id = song.artist_id LIMIT 1""")
+    song = cur.fetchone()
+    cur.execute("SELECT user_id FROM songplay GROUP BY user_id ORDER BY count(*) DESC LIMIT 1")
+    user = cur.fetchone()
+    cur.execute("SELECT date_trunc('month', min(start_time)), date_trunc('month', min(start_time)) + interval '1 month' FROM songplay")
+    month = cur.fetchone()
+    return [
+        ('song_select', song_select, song),
+        ('top_songs', top_songs_select, None),
+        ('user_activity', user_activity_select, user),
+        ('hourly_trends', hourly_trends_select, None),
+        ('monthly_plays', monthly_plays_select, month),
+    ]
+
+
+def run_queries(cur, queries, runs=RUNS):
+    '''
+    times every query over `runs` executions and captures its plan,
+    returns {name: (median ms, plan text)}
+    '''
+    results = {}
+    for name, query, params in queries:
+        timings = []
+        for i in range(runs):
+            start = time.perf_counter()
+            cur.execute(query, params)
+            cur.fetchall()
+            timings.append((time.perf_counter() - start) * 1000)
+        cur.execute('EXPLAIN (ANALYZE, BUFFERS) ' + query, params)
+        plan = '\n'.join(row[0] for row in cur.fetchall())
+        results[name] = (sorted(timings)[len(timings) // 2], plan)
+    return results
+
+
+def write_plans(results, label):
+    filename = 'query_plans_{}.txt'.format(label)
+    with open(filename, 'w') as f:
+        for name, (median, plan) in results.items():
+            f.write('-- {} ({:.3f} ms median)\n{}\n\n'.format(name, median, plan))
+    print('plans written to {}'.format(filename))
+
+
+def print_table_sizes(cur):
+    '''
+    on-disk size (heap, indexes and toast) of the fact and its location / user agent dimensions
+    '''
+    cur.execute(table_sizes_select)
+    for table, rows, size in cur.fetchall():
+        print('{:<15} {:>10} rows {:>10.1f} KB'.format(table, rows, size / 1024))
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    label = args[0] if args else 'indexed'
+    cur, conn = connect()
+
+    queries = benchmark_queries(cur)
+    results = run_queries(cur, queries)
+    write_plans(results, label)
+
+    if '--compare' in sys.argv:
+        for query in index_drop_queries:
+            cur.execute(query)
+        unindexed = run_queries(cur, queries)
+        conn.rollback()
+        write_plans(unindexed, label + '_without_indexes')
+        for name in results:
+            print('{:<15} {:>10.3f} ms without indexes {:>10.3f} ms with indexes ({:.1f}x)'.format(
+                name, unindexed[name][0], results[name][0], unindexed[name][0] / max(results[name][0], 1e-6)))
+    else:
+        for name, (median, plan) in results.items():
+            print('{:<15} {:>10.3f} ms'.format(name, median))
+    print_table_sizes(cur)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,30 @@
-import psycopg2
-from sql_queries import create_table_queries, drop_table_queries
+import sys
+import backends
+from backends import backend_arg, database_arg
+from sql_queries import create_table_queries, partitioned_create_table_queries, view_create_queries, drop_table_queries, index_queries
 
 
-def create_database():
+def create_database(database=backends.DATABASE):
     """
-    - Creates and connects to the sparkifydb
-    - Returns the connection and cursor to sparkifydb
+    - Creates and connects to the sparkifydb (or the database given)
+    - Returns the connection and cursor to it
     """
-    
+    import psycopg2
+
     # connect to default database
     conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
     conn.set_session(autocommit=True)
     cur = conn.cursor()
     
     # create sparkify database with UTF8 encoding
-    cur.execute("DROP DATABASE IF EXISTS sparkifydb")
-    cur.execute("CREATE DATABASE sparkifydb WITH ENCODING 'utf8' TEMPLATE template0")
+    cur.execute("DROP DATABASE IF EXISTS {}".format(database))
+    cur.execute("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0".format(database))
 
     # close connection to default database
     conn.close()    
     
     # connect to sparkify database
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
-    
-    return cur, conn
+    return backends.connect('postgres', database)
 
 
 def drop_tables(cur, conn):
@@ -36,11 +36,13 @@ def drop_tables(cur, conn):
         conn.commit()
 
 
-def create_tables(cur, conn):
+def create_tables(cur, conn, table_queries=create_table_queries):
     """
-    Creates each table using the queries in `create_table_queries` list. 
+    Creates each table using the queries in `create_table_queries` list
+    (or `partitioned_create_table_queries` for a partitioned songplay_fact),
+    then the views in `view_create_queries` and the indexes in `index_queries`.
     """
-    for query in create_table_queries:
+    for query in table_queries + [create for name, create in view_create_queries] + index_queries:
         cur.execute(query)
         conn.commit()
 
@@ -54,14 +56,42 @@ def main():
     
     - Drops all the tables.  
     
-    - Creates all tables needed. 
+    - Creates all tables needed, with songplay_fact partitioned by month
+    when run with --partitioned. 
+
+    - With --backend duckdb starts a new DuckDB database file instead
+    of the sparkifydb on Postgres, --database NAME creates NAME instead
+    of sparkifydb. 
+
+    - With --migrate nothing is dropped, migrate.py only adds the tables,
+    columns, constraints, views and indexes the existing sparkifydb (or the
+    --database given) is missing, on Postgres only. 
     
     - Finally, closes the connection. 
     """
-    cur, conn = create_database()
+    if '--migrate' in sys.argv:
+        # the migration diffs the Postgres catalog, a DuckDB file is created anew instead
+        if backend_arg() != 'postgres':
+            raise ValueError('--migrate only runs on the postgres backend')
+        import migrate
+        dry_run = '--dry-run' in sys.argv
+        if not dry_run:
+            migrate.ensure_database(database_arg())
+        cur, conn = backends.connect('postgres', database_arg())
+        migrate.migrate(cur, conn, dry_run)
+        conn.close()
+        return
+
+    if backend_arg() == 'duckdb':
+        cur, conn = backends.create_database(database_arg())
+    else:
+        cur, conn = create_database(database_arg())
     
     drop_tables(cur, conn)
-    create_tables(cur, conn)
+    if '--partitioned' in sys.argv:
+        create_tables(cur, conn, partitioned_create_table_queries)
+    else:
+        create_tables(cur, conn)
 
     conn.close()
 
@@ -1,8 +1,52 @@
 import os
+import sys
 import glob
-import psycopg2
+import time
 import pandas as pd
 from sql_queries import *
+from backends import backend_arg, database_arg, insert_frame
+import backends
+from partitions import ensure_partitions
+from rollups import update_rollups, update_sessions, refresh_views
+
+
+class DimensionCache:
+    '''
+    in-process dictionary of the integer keys of a dimension (location, user_agent),
+    filled from the table on first use. a value missing from it is inserted once
+    and its new key cached, so each distinct value costs one round trip per run
+    '''
+
+    def __init__(self, intern_query, keys_query):
+        self.intern_query = intern_query
+        self.keys_query = keys_query
+        self.keys = None
+
+    def key(self, cur, value):
+        if value is None or value != value:
+            # missing values (None or NaN) have no key
+            return None
+        if self.keys is None:
+            cur.execute(self.keys_query)
+            self.keys = dict(cur.fetchall())
+        if value not in self.keys:
+            cur.execute(self.intern_query, (value,))
+            self.keys[value] = cur.fetchone()[0]
+        return self.keys[value]
+
+
+location_keys = DimensionCache(location_table_intern, location_keys_select)
+user_agent_keys = DimensionCache(user_agent_table_intern, user_agent_keys_select)
+
+
+def song_ids(cur, song, artist, length):
+    '''
+    song_id and artist_id of a songplay from the song and artist tables,
+    (None, None) when the song is not in the database
+    '''
+    cur.execute(song_select, (song, artist, length))
+    results = cur.fetchone()
+    return results if results else (None, None)
 
 
 def process_song_file(cur, filepath):
@@ -44,33 +88,35 @@ def process_log_file(cur, filepath):
     # insert time data records
     time_data = [t,t.dt.hour,t.dt.day,t.dt.week,t.dt.month,t.dt.year,t.dt.dayofweek]
     column_labels = ('start_time','hour', 'day', 'week', 'month', 'year', 'dayofweek')
-    time_df = pd.DataFrame(dict(zip(column_labels, time_data)))
+    time_df = pd.DataFrame(dict(zip(column_labels, time_data))).drop_duplicates('start_time')
 
-    for i, row in time_df.iterrows():
-        cur.execute(time_table_insert, list(row))
+    # every row of a frame is inserted by one statement (or one batch of statements)
+    insert_frame(cur, time_table_insert, time_df)
 
-    # load user table
-    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']]
+    # load user table, the last row of a user has its current level
+    user_df = df[['userId', 'firstName', 'lastName', 'gender', 'level']].drop_duplicates('userId', keep='last')
 
     # insert user records
-    for i, row in user_df.iterrows():
-        cur.execute(user_table_insert, row)
-
-    # insert songplay records
-    for index, row in df.iterrows():
-        
-        # get songid and artistid from song and artist tables
-        cur.execute(song_select, (row.song, row.artist, row.length))
-        results = cur.fetchone()
-        
-        if results:
-            songid, artistid = results
-        else:
-            songid, artistid = None, None
-
-        # insert songplay record
-        songplay_data = (t[index], row.userId, row.level, songid, artistid, row.sessionId, row.location, row.userAgent)
-        cur.execute(songplay_table_insert, songplay_data)
+    insert_frame(cur, user_table_insert, user_df)
+
+    # create the monthly songplay_fact partitions this file needs, if it is partitioned
+    ensure_partitions(cur, t)
+
+    # get songid and artistid from song and artist tables
+    ids = [song_ids(cur, song, artist, length) for song, artist, length in zip(df.song, df.artist, df.length)]
+
+    # insert songplay records, with the keys of their location and user agent
+    songplay_df = pd.DataFrame({
+        'start_time': t,
+        'user_id': df.userId,
+        'level': df.level,
+        'song_id': [song_id for song_id, artist_id in ids],
+        'artist_id': [artist_id for song_id, artist_id in ids],
+        'session_id': df.sessionId,
+        'location_id': [location_keys.key(cur, v) for v in df.location],
+        'user_agent_id': [user_agent_keys.key(cur, v) for v in df.userAgent],
+    }, index=df.index)
+    insert_frame(cur, songplay_table_insert, songplay_df)
 
 
 def process_data(cur, conn, filepath, func):
@@ -98,17 +144,57 @@ def process_data(cur, conn, filepath, func):
         print('{}/{} files processed.'.format(i, num_files))
 
 
+def bulk_load(cur, conn, filepath, func, load_queries):
+    '''
+    runs process_data between the (before, after) queries of load_queries:
+    the indexes and constraints that only slow the inserts down are dropped
+    before the files load and rebuilt once, over the whole table, afterwards
+    '''
+    before, after = load_queries
+    for query in before:
+        cur.execute(query)
+    conn.commit()
+
+    process_data(cur, conn, filepath, func)
+
+    start = time.time()
+    for query in after:
+        cur.execute(query)
+    conn.commit()
+    print('indexes and constraints rebuilt in {:.2f}s'.format(time.time() - start))
+
+
+def connect(backend='postgres', database=backends.DATABASE):
+    '''
+    connects to the sparkify database (on the local Postgres
+    or the DuckDB file, see backends.py)
+    and returns the cursor and connection
+    '''
+    return backends.connect(backend, database)
+
+
 def main():
     '''
     creates connection and cursor,
-    executes process_data function described above
+    executes process_data function described above,
+    with --bulk the indexes and foreign keys are rebuilt after each load,
+    with --backend duckdb the tables are loaded into the DuckDB file,
+    with --database NAME into NAME instead of sparkifydb,
+    then adds the new songplays to the rollups and refreshes the views
     
     '''
-    conn = psycopg2.connect("host=127.0.0.1 dbname=sparkifydb user=student password=student")
-    cur = conn.cursor()
-
-    process_data(cur, conn, filepath='data/song_data', func=process_song_file)
-    process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+    cur, conn = connect(backend_arg(), database_arg())
+
+    if '--bulk' in sys.argv:
+        bulk_load(cur, conn, 'data/song_data', process_song_file, song_load_queries)
+        bulk_load(cur, conn, 'data/log_data', process_log_file, log_load_queries)
+    else:
+        process_data(cur, conn, filepath='data/song_data', func=process_song_file)
+        process_data(cur, conn, filepath='data/log_data', func=process_log_file)
+
+    update_rollups(cur, conn)
+    update_sessions(cur, conn)
+    refresh_views(cur, conn)
 
     conn.close()
 
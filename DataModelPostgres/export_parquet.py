@@ -0,0 +1,188 @@
+'''
+Exports the sparkifydb star schema to parquet for local analysis.
+
+Every table is read through a server-side (named) cursor, so only
+BATCH_ROWS rows are held at a time, and each batch is written as a row
+group of the parquet file of its partition. songplay and time are
+partitioned by year and month like the tables of the Spark job. songplay
+is exported incrementally: only the rows above the last exported
+songplay_id, kept in _export_state.json, are read. time and the other
+dimensions are exported in full every run, a backfilled log file can add
+start_times below the last one exported.
+
+The output reads back with the Spark job's readers, e.g.
+spark.read.parquet('export/songplay'), or with pandas / pyarrow.
+
+usage: python export_parquet.py [output dir] [--full] [--batch-rows N]
+'''
+import json
+import os
+import shutil
+import sys
+import time
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from sql_queries import export_queries
+
+BATCH_ROWS = 50000
+STATE_FILE = '_export_state.json'
+
+# arrow type of the postgres type oids in cursor.description, text for the others
+ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1082: pa.date32(),
+    1114: pa.timestamp('us'),
+    1184: pa.timestamp('us', tz='UTC'),
+}
+
+# lower bound of the incremental keys before the first export
+START = {'songplay_id': 0}
+
+
+def load_state(output):
+    path = os.path.join(output, STATE_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(output, state):
+    '''
+    writes the state under a temporary name and renames it, so a crash never leaves half a file
+    '''
+    path = os.path.join(output, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + '.tmp', path)
+
+
+def arrow_schema(description):
+    return pa.schema([(column.name, ARROW_TYPES.get(column.type_code, pa.string())) for column in description])
+
+
+class PartitionWriters:
+    '''
+    one parquet writer per partition directory (year=2018/month=11) of a table,
+    the files are written under a hidden name that readers skip until commit
+    '''
+
+    def __init__(self, path, schema, partition_by, run_id):
+        self.path = path
+        self.partition_by = partition_by
+        self.positions = [schema.get_field_index(c) for c in partition_by]
+        self.schema = pa.schema([f for f in schema if f.name not in partition_by])
+        self.data_positions = [i for i, f in enumerate(schema) if f.name not in partition_by]
+        self.filename = 'part-{}.parquet'.format(run_id)
+        self.writers = {}
+
+    def write(self, rows):
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row[i] for i in self.positions), []).append(row)
+
+        for values, group in groups.items():
+            if values not in self.writers:
+                directory = os.path.join(self.path, *('{}={}'.format(c, v) for c, v in zip(self.partition_by, values)))
+                os.makedirs(directory, exist_ok=True)
+                self.writers[values] = (pq.ParquetWriter(os.path.join(directory, '.' + self.filename), self.schema),
+                                        directory)
+            columns = list(zip(*group))
+            batch = pa.record_batch([pa.array(columns[i], type=self.schema.field(n).type)
+                                     for n, i in enumerate(self.data_positions)], schema=self.schema)
+            self.writers[values][0].write_batch(batch)
+
+    def commit(self):
+        '''
+        closes the files and gives them their visible name
+        '''
+        for writer, directory in self.writers.values():
+            writer.close()
+            os.replace(os.path.join(directory, '.' + self.filename), os.path.join(directory, self.filename))
+
+
+def export_table(conn, output, table, query, key, partition_by, last_key, run_id, batch_rows=BATCH_ROWS):
+    '''
+    streams one table into parquet, returns the rows written and the last key exported
+    '''
+    cur = conn.cursor(name='export_{}'.format(table))
+    cur.itersize = batch_rows
+    cur.execute(query, (last_key,) if key else None)
+
+    path = os.path.join(output, table if key else table + '.tmp')
+    writers = None
+    rows = 0
+    while True:
+        batch = cur.fetchmany(batch_rows)
+        if not batch:
+            break
+        if writers is None:
+            schema = arrow_schema(cur.description)
+            writers = PartitionWriters(path, schema, partition_by, run_id)
+            key_position = schema.get_field_index(key) if key else None
+        writers.write(batch)
+        rows += len(batch)
+        if key:
+            last_key = batch[-1][key_position]
+    cur.close()
+
+    if writers is not None:
+        writers.commit()
+    if not key and os.path.exists(path):
+        # full exports replace the previous one
+        shutil.rmtree(os.path.join(output, table), ignore_errors=True)
+        os.replace(path, os.path.join(output, table))
+    return rows, last_key
+
+
+def export(conn, output='export', full=False, batch_rows=BATCH_ROWS):
+    '''
+    exports every table of export_queries and records the last keys.
+    the state is saved as soon as a table's files are committed, so when a later
+    table fails the next run does not export the committed rows again
+    '''
+    os.makedirs(output, exist_ok=True)
+    state = {} if full else load_state(output)
+    if full:
+        for table, query, key, partition_by in export_queries:
+            shutil.rmtree(os.path.join(output, table), ignore_errors=True)
+    run_id = time.strftime('%Y%m%d%H%M%S')
+
+    for table, query, key, partition_by in export_queries:
+        start = time.time()
+        last_key = state.get(table, START.get(key))
+        rows, last_key = export_table(conn, output, table, query, key, partition_by, last_key, run_id, batch_rows)
+        if key:
+            state[table] = last_key
+            save_state(output, state)
+        print('{}: {} rows exported in {:.2f}s'.format(table, rows, time.time() - start))
+    conn.commit()
+    save_state(output, state)
+    return state
+
+
+def main():
+    from etl import connect
+
+    args = sys.argv[1:]
+    batch_rows = BATCH_ROWS
+    if '--batch-rows' in args:
+        batch_rows = int(args[args.index('--batch-rows') + 1])
+        del args[args.index('--batch-rows'):args.index('--batch-rows') + 2]
+    paths = [a for a in args if not a.startswith('--')]
+    cur, conn = connect()
+
+    export(conn, paths[0] if paths else 'export', '--full' in args, batch_rows)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
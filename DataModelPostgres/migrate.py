@@ -0,0 +1,121 @@
+'''
+Non-destructive schema migration for sparkifydb.
+
+The CREATE TABLE, CREATE VIEW and CREATE INDEX statements in sql_queries.py
+are the desired schema. They are compared with the live catalog and only
+what is missing is applied: new tables, new columns, new primary key /
+unique / foreign key constraints, new views and new indexes. Nothing is dropped; columns whose
+type differs and columns that only exist in the database are reported in
+the plan and left as they are. The one exception is a songplay table from
+before songplay_fact: its rows are moved into songplay_fact and the
+dimensions, then it is dropped and replaced by the songplay view. The diff
+itself is common/migration.py.
+
+usage: python migrate.py [--dry-run] [--database NAME], or python create_tables.py --migrate
+'''
+import sys
+
+import psycopg2
+
+import backends
+from backends import database_arg
+from common.migration import (parse_create_table, parse_create_index, read_relations, plan_migration, print_plan,
+                              constraint_sql)
+from sql_queries import (create_table_queries, partitioned_create_table_queries, view_create_queries, index_queries,
+                         songplay_key, songplay_duplicates_delete, songplay_table_move)
+
+
+def read_catalog(cur):
+    '''
+    reads the tables, views, columns, constraints and indexes of the current schema
+    '''
+    catalog = read_relations(cur)
+
+    cur.execute("""
+        SELECT c.contype, r.relname, f.relname,
+            ARRAY(SELECT a.attname FROM pg_attribute a
+                  WHERE a.attrelid = c.conrelid AND a.attnum = ANY(c.conkey) ORDER BY a.attname)
+        FROM pg_constraint c
+        JOIN pg_class r ON r.oid = c.conrelid
+        JOIN pg_namespace n ON n.oid = r.relnamespace
+        LEFT JOIN pg_class f ON f.oid = c.confrelid
+        WHERE n.nspname = current_schema() AND c.contype IN ('p', 'u', 'f')""")
+    constraints = {(contype, table, tuple(cols), ref) for contype, table, ref, cols in cur.fetchall()}
+
+    cur.execute("SELECT indexname, tablename FROM pg_indexes WHERE schemaname = current_schema()")
+    indexes = dict(cur.fetchall())
+
+    cur.execute("""
+        SELECT c.relname FROM pg_partitioned_table p
+        JOIN pg_class c ON c.oid = p.partrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = current_schema()""")
+    partitioned = {row[0] for row in cur.fetchall()}
+
+    catalog.update(constraints=constraints, indexes=indexes, partitioned=partitioned)
+    return catalog
+
+
+def ensure_database(database=backends.DATABASE):
+    '''
+    creates sparkifydb (or the database given) if it does not exist yet, without touching an existing one
+    '''
+    conn = psycopg2.connect("host=127.0.0.1 dbname=studentdb user=student password=student")
+    conn.set_session(autocommit=True)
+    cur = conn.cursor()
+    cur.execute("SELECT 1 FROM pg_database WHERE datname = %s", (database,))
+    if cur.fetchone() is None:
+        cur.execute("CREATE DATABASE {} WITH ENCODING 'utf8' TEMPLATE template0".format(database))
+        print('created database {}'.format(database))
+    conn.close()
+
+
+def migrate(cur, conn, dry_run=False):
+    '''
+    plans the migration of the connected database and applies it in one
+    transaction, or only prints the plan with dry_run. returns the statements
+    '''
+    catalog = read_catalog(cur)
+    if 'songplay' in catalog['partitioned']:
+        # its monthly partitions have the names the songplay_fact partitions would get
+        raise ValueError('songplay is a partitioned table, move its rows into songplay_fact '
+                         'and drop it before migrating')
+    # a partitioned songplay_fact is compared with its partitioned definition
+    queries = partitioned_create_table_queries if 'songplay_fact' in catalog['partitioned'] else create_table_queries
+    tables = [parse_create_table(query) for query in queries]
+    indexes = [parse_create_index(query) for query in index_queries]
+    statements, notes = plan_migration(catalog, tables, indexes, view_create_queries,
+                                       moves={'songplay': songplay_table_move})
+    # the songplays loaded twice by the etl runs before the key was unique are removed before it is added
+    songplay_unique = constraint_sql(('u', 'songplay_fact', songplay_key, None, None))
+    if songplay_unique in statements:
+        statements.insert(statements.index(songplay_unique), ' '.join(songplay_duplicates_delete.split()))
+    print_plan(statements, notes)
+    if dry_run or not statements:
+        return statements
+
+    try:
+        for statement in statements:
+            cur.execute(statement)
+        conn.commit()
+    except psycopg2.Error:
+        conn.rollback()
+        raise
+    print('-- {} statements applied'.format(len(statements)))
+    return statements
+
+
+def main():
+    dry_run = '--dry-run' in sys.argv
+    database = database_arg()
+    if not dry_run:
+        ensure_database(database)
+    cur, conn = backends.connect('postgres', database)
+
+    migrate(cur, conn, dry_run)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
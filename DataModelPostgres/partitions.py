@@ -0,0 +1,132 @@
+'''
+Monthly partitions of songplay_fact when it is created with
+python create_tables.py --partitioned.
+
+Postgres routes every insert into songplay_fact to the partition of its
+start_time, ensure_partitions creates the partitions a log file needs
+before its rows are inserted. Queries filtering on start_time only scan
+the partitions of the months they ask for, and retention detaches or
+drops whole months, which only changes the catalog.
+
+usage: python partitions.py list
+       python partitions.py create YYYY-MM [YYYY-MM]
+       python partitions.py detach YYYY-MM
+       python partitions.py drop-before YYYY-MM [--detach]
+'''
+import sys
+from datetime import datetime
+
+from sql_queries import (songplay_partition_create, songplay_partition_detach,
+                         songplay_partition_drop, songplay_partitions_select)
+
+
+def partition_name(year, month):
+    return 'songplay_y{:04d}m{:02d}'.format(year, month)
+
+
+def month_bounds(year, month):
+    '''
+    first instant of the month and of the next one
+    '''
+    start = datetime(year, month, 1)
+    end = datetime(year + month // 12, month % 12 + 1, 1)
+    return start, end
+
+
+def parse_month(text):
+    month = datetime.strptime(text, '%Y-%m')
+    return month.year, month.month
+
+
+def songplay_partitions(cur):
+    '''
+    returns whether songplay_fact is partitioned and the names of its partitions
+    '''
+    cur.execute(songplay_partitions_select)
+    rows = cur.fetchall()
+    partitioned = bool(rows) and rows[0][0] == 'p'
+    return partitioned, [name for relkind, name, bound in rows if name]
+
+
+def create_partition(cur, year, month):
+    start, end = month_bounds(year, month)
+    name = partition_name(year, month)
+    cur.execute(songplay_partition_create.format(name), (start, end))
+    return name
+
+
+def ensure_partitions(cur, timestamps):
+    '''
+    creates the missing monthly partitions of the timestamps about to be
+    inserted, does nothing when songplay_fact is a plain table. returns the
+    partitions created
+    '''
+    partitioned, existing = songplay_partitions(cur)
+    if not partitioned:
+        return []
+
+    created = []
+    for year, month in sorted({(ts.year, ts.month) for ts in timestamps}):
+        if partition_name(year, month) not in existing:
+            created.append(create_partition(cur, year, month))
+    return created
+
+
+def detach_partition(cur, year, month):
+    '''
+    detaches a month from songplay_fact, it stays as a standalone table
+    that can be archived or dropped later
+    '''
+    name = partition_name(year, month)
+    cur.execute(songplay_partition_detach.format(name))
+    return name
+
+
+def drop_partitions_before(cur, year, month, detach_only=False):
+    '''
+    detaches (and drops, unless detach_only) every partition older than the given month
+    '''
+    partitioned, existing = songplay_partitions(cur)
+    cutoff = partition_name(year, month)
+    removed = []
+    for name in existing:
+        # the names sort like the months they hold
+        if name < cutoff:
+            cur.execute(songplay_partition_detach.format(name))
+            if not detach_only:
+                cur.execute(songplay_partition_drop.format(name))
+            removed.append(name)
+    return removed
+
+
+def main():
+    from etl import connect
+
+    command, args = sys.argv[1], [a for a in sys.argv[2:] if not a.startswith('--')]
+    cur, conn = connect()
+
+    if command == 'list':
+        cur.execute(songplay_partitions_select)
+        for relkind, name, bound in cur.fetchall():
+            if name:
+                print('{} {}'.format(name, bound))
+    elif command == 'create':
+        first = parse_month(args[0])
+        last = parse_month(args[-1])
+        year, month = first
+        while (year, month) <= last:
+            print('created ' + create_partition(cur, year, month))
+            year, month = year + month // 12, month % 12 + 1
+    elif command == 'detach':
+        print('detached ' + detach_partition(cur, *parse_month(args[0])))
+    elif command == 'drop-before':
+        detach_only = '--detach' in sys.argv
+        for name in drop_partitions_before(cur, *parse_month(args[0]), detach_only=detach_only):
+            print('{} {}'.format('detached' if detach_only else 'dropped', name))
+
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+'''
+Rollup layer of sparkifydb: hourly and daily aggregates of songplay, the
+sessions table and the materialized views analysts query instead of the
+raw fact.
+
+update_rollups only aggregates the songplays loaded since the last run,
+whose songplay_id is above the high water mark in rollup_state, and adds
+them to the rollup tables in the same transaction that moves the mark,
+so a failed run is simply repeated. etl.py runs it after every load.
+
+usage: python rollups.py update|refresh|rebuild|benchmark
+'''
+import sys
+import time
+
+from sql_queries import *
+
+RUNS = 20
+
+
+def merge_sql(table, keys, delta):
+    '''
+    adds the plays of a delta query to the rollup table
+    '''
+    return ("INSERT INTO {0} SELECT * FROM ({1}) delta "
+            "ON CONFLICT ({2}) DO UPDATE SET plays = {0}.plays + EXCLUDED.plays").format(table, delta, ', '.join(keys))
+
+
+def update_rollups(cur, conn):
+    '''
+    rolls up the songplays above the high water mark and moves the mark,
+    returns the (old, new) high water marks
+    '''
+    cur.execute(rollup_state_select, ('songplay',))
+    row = cur.fetchone()
+    high_water_mark = row[0] if row else 0
+    cur.execute(songplay_high_water_mark_select)
+    new_high_water_mark = cur.fetchone()[0]
+
+    if new_high_water_mark > high_water_mark:
+        for table, keys, delta in rollup_queries:
+            cur.execute(merge_sql(table, keys, delta), (high_water_mark, new_high_water_mark))
+        cur.execute(rollup_state_upsert, ('songplay', new_high_water_mark))
+    conn.commit()
+    print('rolled up songplay_id {} to {}'.format(high_water_mark, new_high_water_mark))
+    return high_water_mark, new_high_water_mark
+
+
+def update_sessions(cur, conn):
+    '''
+    recomputes the sessions that got songplays above their own high water mark,
+    returns the (old, new) high water marks
+    '''
+    cur.execute(rollup_state_select, ('sessions',))
+    row = cur.fetchone()
+    high_water_mark = row[0] if row else 0
+    cur.execute(songplay_high_water_mark_select)
+    new_high_water_mark = cur.fetchone()[0]
+
+    if new_high_water_mark > high_water_mark:
+        cur.execute(sessions_upsert, (high_water_mark, new_high_water_mark))
+        print('{} sessions updated'.format(cur.rowcount))
+        cur.execute(rollup_state_upsert, ('sessions', new_high_water_mark))
+    conn.commit()
+    return high_water_mark, new_high_water_mark
+
+
+def refresh_views(cur, conn):
+    '''
+    creates the materialized views that do not exist yet and refreshes them
+    '''
+    for name, create, index, refresh in view_queries:
+        cur.execute(create)
+        cur.execute(index)
+        cur.execute(refresh)
+        conn.commit()
+        print('refreshed ' + name)
+
+
+def rebuild_rollups(cur, conn):
+    '''
+    empties the rollups and rolls up every songplay again
+    '''
+    for table, keys, delta in rollup_queries:
+        cur.execute('TRUNCATE {}'.format(table))
+    cur.execute('TRUNCATE sessions')
+    cur.execute('DELETE FROM rollup_state')
+    update_rollups(cur, conn)
+    update_sessions(cur, conn)
+
+
+def median_ms(cur, query, runs=RUNS):
+    timings = []
+    for i in range(runs):
+        start = time.perf_counter()
+        cur.execute(query)
+        cur.fetchall()
+        timings.append((time.perf_counter() - start) * 1000)
+    return sorted(timings)[len(timings) // 2]
+
+
+def benchmark(cur):
+    '''
+    times each analytics query on the raw songplay and on its rollup
+    '''
+    for name, raw, rollup in rollup_benchmark_queries:
+        raw_ms = median_ms(cur, raw)
+        rollup_ms = median_ms(cur, rollup)
+        print('{:<22} raw {:>10.3f} ms rollup {:>10.3f} ms ({:.1f}x)'.format(
+            name, raw_ms, rollup_ms, raw_ms / max(rollup_ms, 1e-6)))
+
+
+def main():
+    from etl import connect
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'update'
+    cur, conn = connect()
+
+    if command == 'update':
+        update_rollups(cur, conn)
+        update_sessions(cur, conn)
+        refresh_views(cur, conn)
+    elif command == 'refresh':
+        refresh_views(cur, conn)
+    elif command == 'rebuild':
+        rebuild_rollups(cur, conn)
+        refresh_views(cur, conn)
+    elif command == 'benchmark':
+        benchmark(cur)
+
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
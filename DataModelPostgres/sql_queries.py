@@ -1,15 +1,44 @@
 # DROP TABLES
 
-songplay_table_drop = "DROP TABLE IF EXISTS songplay"
+songplay_view_drop = "DROP VIEW IF EXISTS songplay"
+songplay_table_drop = "DROP TABLE IF EXISTS songplay_fact"
 user_table_drop = "DROP TABLE IF EXISTS users"
 song_table_drop = "DROP TABLE IF EXISTS song"
 artist_table_drop = "DROP TABLE IF EXISTS artist"
 time_table_drop = "DROP TABLE IF EXISTS time"
+location_table_drop = "DROP TABLE IF EXISTS location"
+user_agent_table_drop = "DROP TABLE IF EXISTS user_agent"
+rollup_state_table_drop = "DROP TABLE IF EXISTS rollup_state"
+plays_hourly_table_drop = "DROP TABLE IF EXISTS plays_hourly"
+song_plays_daily_table_drop = "DROP TABLE IF EXISTS song_plays_daily"
+level_location_daily_table_drop = "DROP TABLE IF EXISTS level_location_daily"
+sessions_table_drop = "DROP TABLE IF EXISTS sessions"
+top_songs_view_drop = "DROP MATERIALIZED VIEW IF EXISTS top_songs_mv"
+level_location_view_drop = "DROP MATERIALIZED VIEW IF EXISTS level_location_mv"
 
 # CREATE TABLES
 
-songplay_table_create = ("CREATE TABLE IF NOT EXISTS songplay (songplay_id SERIAL PRIMARY KEY, start_time TIMESTAMP REFERENCES time (start_time), user_id varchar REFERENCES users (user_id), level VARCHAR, song_id VARCHAR REFERENCES song (song_id), artist_id VARCHAR REFERENCES artist (artist_id), session_id varchar, location varchar, user_agent TEXT);")
-#CONSTRAINT songplayuser UNIQUE(start_time, user_id, level, session_id)
+songplay_table_create = ("CREATE TABLE IF NOT EXISTS songplay_fact (songplay_id SERIAL PRIMARY KEY, start_time TIMESTAMP REFERENCES time (start_time), user_id varchar REFERENCES users (user_id), level VARCHAR, song_id VARCHAR REFERENCES song (song_id), artist_id VARCHAR REFERENCES artist (artist_id), session_id varchar, location_id int REFERENCES location (location_id), user_agent_id int REFERENCES user_agent (user_agent_id), \
+UNIQUE (start_time, user_id, session_id));")
+# a songplay is identified by its start_time, user and session, loading a log file again adds no rows
+songplay_key = ('start_time', 'user_id', 'session_id')
+
+# songplay_fact range partitioned by month on start_time, the primary key has to include the partition key
+songplay_partitioned_table_create = ("""
+    CREATE TABLE IF NOT EXISTS songplay_fact (
+        songplay_id SERIAL,
+        start_time TIMESTAMP NOT NULL REFERENCES time (start_time),
+        user_id varchar REFERENCES users (user_id),
+        level VARCHAR,
+        song_id VARCHAR REFERENCES song (song_id),
+        artist_id VARCHAR REFERENCES artist (artist_id),
+        session_id varchar,
+        location_id int REFERENCES location (location_id),
+        user_agent_id int REFERENCES user_agent (user_agent_id),
+        PRIMARY KEY (songplay_id, start_time),
+        UNIQUE (start_time, user_id, session_id)
+    ) PARTITION BY RANGE (start_time)
+""")
 
 user_table_create = ("CREATE TABLE IF NOT EXISTS users (user_id varchar PRIMARY KEY, first_name varchar, last_name varchar, gender varchar, level varchar);")
 
@@ -20,10 +49,80 @@ artist_table_create = ("CREATE TABLE IF NOT EXISTS artist (artist_id varchar PRI
 
 time_table_create = ("CREATE TABLE IF NOT EXISTS time (start_time timestamp UNIQUE NOT NULL, hour int, day int, week int, month int, year int, dayofweek varchar);")
 
+# the locations and user agents repeat on most songplays, songplay_fact only keeps their integer keys
+location_table_create = ("CREATE TABLE IF NOT EXISTS location (location_id SERIAL PRIMARY KEY, location varchar UNIQUE NOT NULL);")
+
+user_agent_table_create = ("CREATE TABLE IF NOT EXISTS user_agent (user_agent_id SERIAL PRIMARY KEY, user_agent TEXT UNIQUE NOT NULL);")
+
+# VIEWS
+# songplay keeps the columns of the original table, so the queries reading it do not change
+
+songplay_view_create = ("""
+    CREATE OR REPLACE VIEW songplay AS
+    SELECT f.songplay_id, f.start_time, f.user_id, f.level, f.song_id, f.artist_id, f.session_id,
+        location.location, user_agent.user_agent
+    FROM songplay_fact f
+    LEFT JOIN location ON location.location_id = f.location_id
+    LEFT JOIN user_agent ON user_agent.user_agent_id = f.user_agent_id
+""")
+
 # INSERT RECORDS
 
-songplay_table_insert = ("INSERT INTO songplay (start_time, user_id, level, song_id, artist_id, session_id, location, user_agent) \
-VALUES (%s,%s,%s,%s,%s,%s,%s,%s)")
+songplay_table_insert = ("INSERT INTO songplay_fact (start_time, user_id, level, song_id, artist_id, session_id, location_id, user_agent_id) \
+VALUES (%s,%s,%s,%s,%s,%s,%s,%s) ON CONFLICT (start_time, user_id, session_id) DO NOTHING")
+
+# the songplays loaded more than once before songplay_key was unique, all but the first are deleted
+songplay_duplicates_delete = ("""
+    DELETE FROM songplay_fact a
+    USING songplay_fact b
+    WHERE a.start_time = b.start_time
+    AND a.user_id = b.user_id
+    AND a.session_id = b.session_id
+    AND a.songplay_id > b.songplay_id
+""")
+
+# a songplay table created before songplay_fact: its locations and user agents are interned,
+# its rows moved into songplay_fact with their songplay_id, so the rollup high water marks
+# stay valid, and it is dropped for the view. the first of its duplicated songplays is kept
+songplay_table_move = [
+    """
+    INSERT INTO location (location)
+    SELECT DISTINCT location FROM songplay WHERE location IS NOT NULL
+    ON CONFLICT (location) DO NOTHING
+    """,
+    """
+    INSERT INTO user_agent (user_agent)
+    SELECT DISTINCT user_agent FROM songplay WHERE user_agent IS NOT NULL
+    ON CONFLICT (user_agent) DO NOTHING
+    """,
+    """
+    INSERT INTO songplay_fact (songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location_id, user_agent_id)
+    SELECT s.songplay_id, s.start_time, s.user_id, s.level, s.song_id, s.artist_id, s.session_id,
+        location.location_id, user_agent.user_agent_id
+    FROM songplay s
+    LEFT JOIN location ON location.location = s.location
+    LEFT JOIN user_agent ON user_agent.user_agent = s.user_agent
+    ORDER BY s.songplay_id
+    ON CONFLICT (start_time, user_id, session_id) DO NOTHING
+    """,
+    "SELECT setval(pg_get_serial_sequence('songplay_fact', 'songplay_id'), (SELECT coalesce(max(songplay_id), 0) + 1 FROM songplay_fact), false)",
+    "DROP TABLE songplay",
+]
+
+# a conflicting insert still returns the key of the existing row
+location_table_intern = ("""
+    INSERT INTO location (location) VALUES (%s)
+    ON CONFLICT (location) DO UPDATE SET location = EXCLUDED.location
+    RETURNING location_id
+""")
+location_keys_select = "SELECT location, location_id FROM location"
+
+user_agent_table_intern = ("""
+    INSERT INTO user_agent (user_agent) VALUES (%s)
+    ON CONFLICT (user_agent) DO UPDATE SET user_agent = EXCLUDED.user_agent
+    RETURNING user_agent_id
+""")
+user_agent_keys_select = "SELECT user_agent, user_agent_id FROM user_agent"
 
 user_table_insert = ("""
     INSERT INTO users (user_id, first_name, last_name, gender, level)
@@ -52,7 +151,290 @@ song_select = ("""SELECT song.song_id, artist.artist_id
                WHERE song.title=%s AND artist.name=%s AND song.duration=%s
                """)
 
+# SONGPLAY PARTITIONS
+
+songplay_partition_create = "CREATE TABLE IF NOT EXISTS {} PARTITION OF songplay_fact FOR VALUES FROM (%s) TO (%s)"
+songplay_partition_detach = "ALTER TABLE songplay_fact DETACH PARTITION {}"
+songplay_partition_drop = "DROP TABLE IF EXISTS {}"
+
+# relkind is 'p' when songplay_fact is partitioned, with its partitions and their bounds
+songplay_partitions_select = ("""
+    SELECT parent.relkind, child.relname, pg_get_expr(child.relpartbound, child.oid)
+    FROM pg_class parent
+    LEFT JOIN pg_inherits i ON i.inhparent = parent.oid
+    LEFT JOIN pg_class child ON child.oid = i.inhrelid
+    WHERE parent.oid = to_regclass('songplay_fact')
+    ORDER BY child.relname
+""")
+
+# INDEXES
+# song_select filters song on title and duration and joins artist on its primary key,
+# songplay_fact gets an index per foreign key for the joins and the per-user queries,
+# start_time already leads the index of its unique (start_time, user_id, session_id) key
+
+song_lookup_index_create = "CREATE INDEX IF NOT EXISTS song_title_duration_idx ON song (title, duration, artist_id)"
+songplay_user_index_create = "CREATE INDEX IF NOT EXISTS songplay_user_id_idx ON songplay_fact (user_id)"
+songplay_song_index_create = "CREATE INDEX IF NOT EXISTS songplay_song_id_idx ON songplay_fact (song_id)"
+songplay_artist_index_create = "CREATE INDEX IF NOT EXISTS songplay_artist_id_idx ON songplay_fact (artist_id)"
+
+song_lookup_index_drop = "DROP INDEX IF EXISTS song_title_duration_idx"
+songplay_user_index_drop = "DROP INDEX IF EXISTS songplay_user_id_idx"
+songplay_song_index_drop = "DROP INDEX IF EXISTS songplay_song_id_idx"
+songplay_artist_index_drop = "DROP INDEX IF EXISTS songplay_artist_id_idx"
+
+# BULK LOAD
+# the foreign keys of songplay_fact are dropped while the log files load and added back
+# afterwards, so they are validated once over the table instead of once per row
+
+songplay_fk_drop = ("""
+    ALTER TABLE songplay_fact
+        DROP CONSTRAINT IF EXISTS songplay_fact_start_time_fkey,
+        DROP CONSTRAINT IF EXISTS songplay_fact_user_id_fkey,
+        DROP CONSTRAINT IF EXISTS songplay_fact_song_id_fkey,
+        DROP CONSTRAINT IF EXISTS songplay_fact_artist_id_fkey,
+        DROP CONSTRAINT IF EXISTS songplay_fact_location_id_fkey,
+        DROP CONSTRAINT IF EXISTS songplay_fact_user_agent_id_fkey
+""")
+
+songplay_fk_create = ("""
+    ALTER TABLE songplay_fact
+        ADD CONSTRAINT songplay_fact_start_time_fkey FOREIGN KEY (start_time) REFERENCES time (start_time),
+        ADD CONSTRAINT songplay_fact_user_id_fkey FOREIGN KEY (user_id) REFERENCES users (user_id),
+        ADD CONSTRAINT songplay_fact_song_id_fkey FOREIGN KEY (song_id) REFERENCES song (song_id),
+        ADD CONSTRAINT songplay_fact_artist_id_fkey FOREIGN KEY (artist_id) REFERENCES artist (artist_id),
+        ADD CONSTRAINT songplay_fact_location_id_fkey FOREIGN KEY (location_id) REFERENCES location (location_id),
+        ADD CONSTRAINT songplay_fact_user_agent_id_fkey FOREIGN KEY (user_agent_id) REFERENCES user_agent (user_agent_id)
+""")
+
+# BENCHMARK QUERIES
+
+top_songs_select = ("""
+    SELECT song.title, artist.name, count(*) AS plays
+    FROM songplay
+    JOIN song ON song.song_id = songplay.song_id
+    JOIN artist ON artist.artist_id = songplay.artist_id
+    GROUP BY song.title, artist.name
+    ORDER BY plays DESC
+    LIMIT 10
+""")
+
+user_activity_select = ("""
+    SELECT songplay.start_time, songplay.level, songplay.session_id, songplay.song_id
+    FROM songplay
+    WHERE songplay.user_id = %s
+    ORDER BY songplay.start_time
+""")
+
+# a partitioned songplay only scans the partition of the month
+monthly_plays_select = ("""
+    SELECT songplay.level, count(*) AS plays
+    FROM songplay
+    WHERE songplay.start_time >= %s AND songplay.start_time < %s
+    GROUP BY songplay.level
+""")
+
+table_sizes_select = ("""
+    SELECT c.relname, c.reltuples::bigint, pg_total_relation_size(c.oid)
+    FROM pg_class c
+    WHERE c.relname IN ('songplay_fact', 'location', 'user_agent')
+    ORDER BY c.relname
+""")
+
+hourly_trends_select = ("""
+    SELECT time.hour, count(*) AS plays, count(DISTINCT songplay.user_id) AS users
+    FROM songplay
+    JOIN time ON time.start_time = songplay.start_time
+    GROUP BY time.hour
+    ORDER BY time.hour
+""")
+
+# ROLLUPS
+# aggregates of songplay kept up to date by each etl run from the songplays loaded since
+# the high water mark (the last songplay_id rolled up) stored in rollup_state
+
+rollup_state_table_create = ("CREATE TABLE IF NOT EXISTS rollup_state (rollup varchar PRIMARY KEY, high_water_mark bigint NOT NULL);")
+
+plays_hourly_table_create = ("CREATE TABLE IF NOT EXISTS plays_hourly (hour timestamp, level varchar, plays bigint NOT NULL, PRIMARY KEY (hour, level));")
+
+song_plays_daily_table_create = ("CREATE TABLE IF NOT EXISTS song_plays_daily (day date, song_id varchar, artist_id varchar, plays bigint NOT NULL, PRIMARY KEY (day, song_id));")
+
+level_location_daily_table_create = ("CREATE TABLE IF NOT EXISTS level_location_daily (day date, location varchar, level varchar, plays bigint NOT NULL, PRIMARY KEY (day, location, level));")
+
+rollup_state_select = "SELECT high_water_mark FROM rollup_state WHERE rollup = %s"
+rollup_state_upsert = ("""
+    INSERT INTO rollup_state (rollup, high_water_mark) VALUES (%s, %s)
+    ON CONFLICT (rollup) DO UPDATE SET high_water_mark = EXCLUDED.high_water_mark
+""")
+songplay_high_water_mark_select = "SELECT coalesce(max(songplay_id), 0) FROM songplay"
+
+# aggregates of the songplays with high water mark < songplay_id <= new high water mark
+plays_hourly_delta = ("""
+    SELECT date_trunc('hour', start_time) AS hour, coalesce(level, 'unknown') AS level, count(*) AS plays
+    FROM songplay
+    WHERE songplay_id > %s AND songplay_id <= %s
+    GROUP BY 1, 2
+""")
+
+song_plays_daily_delta = ("""
+    SELECT start_time::date AS day, song_id, max(artist_id) AS artist_id, count(*) AS plays
+    FROM songplay
+    WHERE songplay_id > %s AND songplay_id <= %s AND song_id IS NOT NULL
+    GROUP BY 1, 2
+""")
+
+level_location_daily_delta = ("""
+    SELECT start_time::date AS day, coalesce(location, 'unknown') AS location, coalesce(level, 'unknown') AS level, count(*) AS plays
+    FROM songplay
+    WHERE songplay_id > %s AND songplay_id <= %s
+    GROUP BY 1, 2, 3
+""")
+
+# SESSIONS
+# one row per listening session, computed with window functions over its plays. a session
+# can continue in a later log file, so the sessions that got new songplays are recomputed whole
+
+sessions_table_create = ("""
+    CREATE TABLE IF NOT EXISTS sessions (
+        session_id varchar,
+        user_id varchar,
+        start_time timestamp NOT NULL,
+        end_time timestamp NOT NULL,
+        duration_seconds int NOT NULL,
+        plays int NOT NULL,
+        first_level varchar,
+        last_level varchar,
+        level_changes int NOT NULL,
+        upgraded boolean NOT NULL,
+        PRIMARY KEY (session_id, user_id)
+    )
+""")
+
+# sessions with a songplay in high water mark < songplay_id <= new high water mark
+sessions_upsert = ("""
+    WITH touched AS (
+        SELECT DISTINCT session_id, user_id
+        FROM songplay_fact
+        WHERE songplay_id > %s AND songplay_id <= %s AND session_id IS NOT NULL AND user_id IS NOT NULL
+    ), plays AS (
+        SELECT f.session_id, f.user_id, f.start_time, f.level,
+            lag(f.level) OVER w AS previous_level,
+            first_value(f.level) OVER w AS first_level,
+            last_value(f.level) OVER (w ROWS BETWEEN UNBOUNDED PRECEDING AND UNBOUNDED FOLLOWING) AS last_level
+        FROM songplay_fact f
+        JOIN touched USING (session_id, user_id)
+        WINDOW w AS (PARTITION BY f.session_id, f.user_id ORDER BY f.start_time, f.songplay_id)
+    )
+    INSERT INTO sessions
+    SELECT session_id, user_id, min(start_time), max(start_time),
+        extract(epoch FROM max(start_time) - min(start_time))::int,
+        count(*),
+        max(first_level),
+        max(last_level),
+        count(*) FILTER (WHERE level <> previous_level),
+        coalesce(bool_or(previous_level = 'free' AND level = 'paid'), false)
+    FROM plays
+    GROUP BY session_id, user_id
+    ON CONFLICT (session_id, user_id) DO UPDATE SET
+        start_time = EXCLUDED.start_time, end_time = EXCLUDED.end_time, duration_seconds = EXCLUDED.duration_seconds,
+        plays = EXCLUDED.plays, first_level = EXCLUDED.first_level, last_level = EXCLUDED.last_level,
+        level_changes = EXCLUDED.level_changes, upgraded = EXCLUDED.upgraded
+""")
+
+# MATERIALIZED VIEWS
+# built on the rollups, the unique indexes let them refresh concurrently
+
+top_songs_view_create = ("""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS top_songs_mv AS
+    SELECT d.song_id, song.title, artist.name AS artist, sum(d.plays) AS plays
+    FROM song_plays_daily d
+    JOIN song ON song.song_id = d.song_id
+    JOIN artist ON artist.artist_id = d.artist_id
+    GROUP BY d.song_id, song.title, artist.name
+""")
+top_songs_view_index = "CREATE UNIQUE INDEX IF NOT EXISTS top_songs_mv_song_id_idx ON top_songs_mv (song_id)"
+
+level_location_view_create = ("""
+    CREATE MATERIALIZED VIEW IF NOT EXISTS level_location_mv AS
+    SELECT location,
+        sum(CASE WHEN level = 'paid' THEN plays ELSE 0 END) AS paid_plays,
+        sum(CASE WHEN level = 'free' THEN plays ELSE 0 END) AS free_plays
+    FROM level_location_daily
+    GROUP BY location
+""")
+level_location_view_index = "CREATE UNIQUE INDEX IF NOT EXISTS level_location_mv_location_idx ON level_location_mv (location)"
+
+top_songs_view_refresh = "REFRESH MATERIALIZED VIEW CONCURRENTLY top_songs_mv"
+level_location_view_refresh = "REFRESH MATERIALIZED VIEW CONCURRENTLY level_location_mv"
+
+# ROLLUP BENCHMARK QUERIES
+# (name, query on the raw songplay, query on the rollup)
+
+rollup_benchmark_queries = [
+    ('plays_per_hour',
+     "SELECT date_trunc('hour', start_time), level, count(*) FROM songplay GROUP BY 1, 2",
+     "SELECT hour, level, plays FROM plays_hourly"),
+    ('top_songs',
+     top_songs_select,
+     "SELECT title, artist, plays FROM top_songs_mv ORDER BY plays DESC LIMIT 10"),
+    ('paid_free_by_location',
+     """SELECT location, sum(CASE WHEN level = 'paid' THEN 1 ELSE 0 END), sum(CASE WHEN level = 'free' THEN 1 ELSE 0 END)
+        FROM songplay GROUP BY location""",
+     "SELECT location, paid_plays, free_plays FROM level_location_mv"),
+    ('plays_per_session',
+     """SELECT session_id, user_id, count(*), max(start_time) - min(start_time)
+        FROM songplay GROUP BY session_id, user_id""",
+     "SELECT session_id, user_id, plays, duration_seconds FROM sessions"),
+]
+
+# EXPORT QUERIES
+# the columns exported to parquet, numerics as float8 so they map to arrow doubles.
+# incremental exports only read the rows above the last exported key
+
+songplay_export_select = ("""
+    SELECT songplay_id, start_time, user_id, level, song_id, artist_id, session_id, location, user_agent,
+        extract(year FROM start_time)::int AS year, extract(month FROM start_time)::int AS month
+    FROM songplay
+    WHERE songplay_id > %s
+    ORDER BY songplay_id
+""")
+
+# time has no key that follows the load order, an older log file loaded later adds
+# start_times below the last one exported, so it is exported in full
+time_export_select = "SELECT start_time, hour, day, week, month, year, dayofweek FROM time"
+
+user_export_select = "SELECT user_id, first_name, last_name, gender, level FROM users"
+song_export_select = "SELECT song_id, title, artist_id, year, duration::float8 AS duration FROM song"
+artist_export_select = "SELECT artist_id, name, location, latitude::float8 AS latitude, longitude::float8 AS longitude FROM artist"
+
 # QUERY LISTS
 
-create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create,songplay_table_create]
-drop_table_queries = [songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop]
\ No newline at end of file
+rollup_table_queries = [rollup_state_table_create, plays_hourly_table_create, song_plays_daily_table_create, level_location_daily_table_create,
+                        sessions_table_create]
+create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, location_table_create, user_agent_table_create,
+                        songplay_table_create] + rollup_table_queries
+partitioned_create_table_queries = [user_table_create, song_table_create, artist_table_create, time_table_create, location_table_create, user_agent_table_create,
+                                    songplay_partitioned_table_create] + rollup_table_queries
+# (view, create statement), created after the tables
+view_create_queries = [('songplay', songplay_view_create)]
+drop_table_queries = [top_songs_view_drop, level_location_view_drop, songplay_view_drop, songplay_table_drop, user_table_drop, song_table_drop, artist_table_drop, time_table_drop,
+                      location_table_drop, user_agent_table_drop, rollup_state_table_drop, plays_hourly_table_drop, song_plays_daily_table_drop, level_location_daily_table_drop,
+                      sessions_table_drop]
+# (rollup table, key columns, delta query)
+rollup_queries = [('plays_hourly', ['hour', 'level'], plays_hourly_delta),
+                  ('song_plays_daily', ['day', 'song_id'], song_plays_daily_delta),
+                  ('level_location_daily', ['day', 'location', 'level'], level_location_daily_delta)]
+view_queries = [('top_songs_mv', top_songs_view_create, top_songs_view_index, top_songs_view_refresh),
+                ('level_location_mv', level_location_view_create, level_location_view_index, level_location_view_refresh)]
+index_queries = [song_lookup_index_create, songplay_user_index_create, songplay_song_index_create, songplay_artist_index_create]
+index_drop_queries = [song_lookup_index_drop, songplay_user_index_drop, songplay_song_index_drop, songplay_artist_index_drop]
+# (before, after) the bulk load of the song files and of the log files, the song lookup index stays while the logs load
+song_load_queries = ([song_lookup_index_drop], [song_lookup_index_create, "ANALYZE song", "ANALYZE artist"])
+log_load_queries = ([songplay_fk_drop, songplay_user_index_drop, songplay_song_index_drop, songplay_artist_index_drop],
+                    [songplay_fk_create, songplay_user_index_create, songplay_song_index_create, songplay_artist_index_create,
+                     "ANALYZE songplay_fact", "ANALYZE time", "ANALYZE users", "ANALYZE location", "ANALYZE user_agent"])
+# (table, select, incremental key or None for a full export, partition columns)
+export_queries = [('songplay', songplay_export_select, 'songplay_id', ['year', 'month']),
+                  ('time', time_export_select, None, ['year', 'month']),
+                  ('users', user_export_select, None, []),
+                  ('song', song_export_select, None, []),
+                  ('artist', artist_export_select, None, [])]
\ No newline at end of file
@@ -0,0 +1,225 @@
+'''
+Schema diff shared by the migrate.py of DataModelPostgres and Cloud Datawarehouse.
+
+The CREATE TABLE, CREATE INDEX and CREATE VIEW statements of a project's
+sql_queries.py are parsed into table specs and compared with the catalog
+its migrate.py reads from the database. plan_migration returns what is
+missing (tables, columns, key constraints, indexes, views) as statements to
+apply and every other difference as a note. Nothing is dropped, except a
+table that a view now replaces, once its rows are moved into the tables
+the view reads.
+'''
+import re
+
+# catalog name of the type aliases used in sql_queries.py
+TYPE_ALIASES = {
+    'varchar': 'character varying',
+    'int': 'integer',
+    'int4': 'integer',
+    'int8': 'bigint',
+    'serial': 'integer',
+    'bigserial': 'bigint',
+    'float': 'double precision',
+    'float8': 'double precision',
+    'decimal': 'numeric',
+    'bool': 'boolean',
+    'char': 'character',
+    'timestamp': 'timestamp without time zone',
+}
+
+# words that end the type of a column definition
+COLUMN_KEYWORDS = ('PRIMARY', 'REFERENCES', 'UNIQUE', 'NOT', 'NULL', 'DEFAULT', 'CHECK', 'CONSTRAINT',
+                   'IDENTITY', 'ENCODE', 'DISTKEY', 'SORTKEY')
+
+CONSTRAINT_TYPES = {'p': 'PRIMARY KEY', 'u': 'UNIQUE', 'f': 'FOREIGN KEY'}
+
+
+def split_top_level(body):
+    '''
+    splits a column list on the commas that are not inside parentheses
+    '''
+    parts, depth, current = [], 0, ''
+    for char in body:
+        if char == ',' and depth == 0:
+            parts.append(current.strip())
+            current = ''
+            continue
+        depth += (char == '(') - (char == ')')
+        current += char
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def column_list(text):
+    return tuple(c.strip() for c in text.split(','))
+
+
+def parse_create_table(query):
+    '''
+    parses a CREATE TABLE statement into its table name, its columns
+    (name, type, the rest of the definition) and its constraints
+    (type, table, columns, referenced table and columns)
+    '''
+    match = re.search(r'CREATE TABLE(?: IF NOT EXISTS)?\s+(\w+)\s*\((.*?)\)\s*(?:PARTITION BY [^;]*)?;?\s*$', query, re.S | re.I)
+    table, body = match.group(1), match.group(2)
+    columns, constraints = [], []
+
+    for part in split_top_level(body):
+        part = ' '.join(part.split())
+        if part.upper().startswith('CONSTRAINT '):
+            part = part.split(None, 2)[2]
+        key = re.match(r'(PRIMARY KEY|UNIQUE)\s*\((.*?)\)', part, re.I)
+        foreign = re.match(r'FOREIGN KEY\s*\((.*?)\)\s*REFERENCES\s+(\w+)\s*\((.*?)\)', part, re.I)
+        if key:
+            constraints.append(('p' if key.group(1).upper() == 'PRIMARY KEY' else 'u',
+                                table, column_list(key.group(2)), None, None))
+            continue
+        if foreign:
+            constraints.append(('f', table, column_list(foreign.group(1)),
+                                foreign.group(2), column_list(foreign.group(3))))
+            continue
+
+        name, rest = part.split(None, 1)
+        words = rest.split()
+        type_end = next((i for i, w in enumerate(words) if re.sub(r'\(.*', '', w).upper() in COLUMN_KEYWORDS), len(words))
+        data_type = ' '.join(words[:type_end])
+        options = ' '.join(words[type_end:])
+        columns.append((name, data_type, options))
+
+        if re.search(r'\bPRIMARY KEY\b', options, re.I):
+            constraints.append(('p', table, (name,), None, None))
+        if re.search(r'\bUNIQUE\b', options, re.I):
+            constraints.append(('u', table, (name,), None, None))
+        reference = re.search(r'REFERENCES\s+(\w+)\s*\((.*?)\)', options, re.I)
+        if reference:
+            constraints.append(('f', table, (name,), reference.group(1), column_list(reference.group(2))))
+
+    return {'table': table, 'columns': columns, 'constraints': constraints, 'create': query.strip().rstrip(';')}
+
+
+def parse_create_index(query):
+    '''
+    parses a CREATE INDEX statement into its index and table name
+    '''
+    match = re.search(r'CREATE (?:UNIQUE )?INDEX(?: IF NOT EXISTS)?\s+(\w+)\s+ON\s+(\w+)', query, re.I)
+    return {'index': match.group(1), 'table': match.group(2), 'create': query.strip().rstrip(';')}
+
+
+def normalize_type(data_type, aliases=TYPE_ALIASES):
+    '''
+    catalog name of a column type, without length or precision
+    '''
+    base = re.sub(r'\(.*\)', '', data_type).strip().lower()
+    return aliases.get(base, base)
+
+
+def read_relations(cur):
+    '''
+    reads the tables, views and columns of the current schema from information_schema
+    '''
+    cur.execute("""
+        SELECT table_name, table_type
+        FROM information_schema.tables
+        WHERE table_schema = current_schema()""")
+    relations = dict(cur.fetchall())
+
+    cur.execute("""
+        SELECT table_name, column_name, data_type
+        FROM information_schema.columns
+        WHERE table_schema = current_schema()
+        ORDER BY table_name, ordinal_position""")
+    columns = {}
+    for table, column, data_type in cur.fetchall():
+        columns.setdefault(table, {})[column] = data_type
+    return {'relations': relations, 'columns': columns}
+
+
+def constraint_sql(constraint):
+    contype, table, columns, ref_table, ref_columns = constraint
+    sql = 'ALTER TABLE {} ADD {} ({})'.format(table, CONSTRAINT_TYPES[contype], ', '.join(columns))
+    if contype == 'f':
+        sql += ' REFERENCES {} ({})'.format(ref_table, ', '.join(ref_columns))
+    return sql
+
+
+def add_column_sql(table, name, data_type, options):
+    '''
+    ALTER TABLE ADD COLUMN of a new column. key constraints are added separately,
+    an IDENTITY can only be set at CREATE TABLE and NOT NULL is left out,
+    the rows already in the table have no value for it
+    '''
+    options = re.sub(r'IDENTITY\s*\(.*?\)|\bPRIMARY KEY\b|\bUNIQUE\b|\bNOT NULL\b|REFERENCES\s+\w+\s*\(.*?\)',
+                     '', options, flags=re.I)
+    return ' '.join('ALTER TABLE {} ADD COLUMN {} {} {}'.format(table, name, data_type, options).split())
+
+
+def plan_migration(catalog, tables, indexes=(), views=(), aliases=TYPE_ALIASES, moves=None):
+    '''
+    compares the desired tables, indexes and views with the catalog and returns
+    the statements to apply, in order, and the differences that are only reported.
+    the key constraints are only compared when the catalog has read them.
+    moves maps a view still held by a table of the same name to the statements
+    that move the table's rows into the new tables and drop it, the view is
+    created after them
+    '''
+    statements, notes = [], []
+    moves = moves or {}
+    moved = set()
+    existing = {(contype, table, tuple(sorted(cols)), ref) for contype, table, cols, ref in catalog.get('constraints', ())}
+
+    for spec in tables:
+        table = spec['table']
+        live = catalog['columns'].get(table)
+        if live is None:
+            statements.append(spec['create'])
+            continue
+
+        for name, data_type, options in spec['columns']:
+            if name.lower() not in live:
+                statements.append(add_column_sql(table, name, data_type, options))
+                if re.search(r'\bIDENTITY\b', options, re.I):
+                    notes.append('{}.{} is added without IDENTITY, it is only set at CREATE TABLE'.format(table, name))
+            elif normalize_type(data_type, aliases) != live[name.lower()]:
+                notes.append('{}.{} is {} in the database and {} in sql_queries.py, not changed'.format(
+                    table, name, live[name.lower()], data_type))
+        desired = {name.lower() for name, data_type, options in spec['columns']}
+        for name in live:
+            if name not in desired:
+                notes.append('{}.{} is not in sql_queries.py, kept'.format(table, name))
+
+        if 'constraints' in catalog:
+            for constraint in spec['constraints']:
+                contype, table, columns, ref_table, ref_columns = constraint
+                key = (contype, table, tuple(sorted(c.lower() for c in columns)), ref_table)
+                if key not in existing:
+                    statements.append(constraint_sql(constraint))
+
+    for name, create in views:
+        kind = catalog['relations'].get(name)
+        if kind is None:
+            statements.append(' '.join(create.split()))
+        elif kind != 'VIEW' and name in moves:
+            statements.extend(' '.join(statement.split()) for statement in moves[name])
+            statements.append(' '.join(create.split()))
+            moved.add(name)
+        elif kind != 'VIEW':
+            notes.append('{} is a table in the database and a view in sql_queries.py, '
+                         'rename or drop the table to create the view'.format(name))
+
+    # the indexes of a moved table are dropped with it, even when their name is the one wanted
+    live_indexes = catalog.get('indexes', {})
+    for index in indexes:
+        if index['index'] not in live_indexes or live_indexes[index['index']] in moved:
+            statements.append(index['create'])
+
+    return statements, notes
+
+
+def print_plan(statements, notes):
+    for note in notes:
+        print('-- ' + note)
+    if not statements:
+        print('-- schema is up to date')
+    for statement in statements:
+        print(statement + ';')
@@ -0,0 +1,203 @@
+'''
+Storage backends for the data lake paths, shared by the Spark projects.
+
+The same job can target real S3, a local MinIO-style S3 endpoint or the
+local filesystem, depending on the [STORAGE] section of the project's
+config file:
+
+    [STORAGE]
+    BACKEND = local                 # s3 | minio | local
+    INPUT_DATA = file:///tmp/input/
+    OUTPUT_DATA = file:///tmp/lake/
+    ENDPOINT = http://127.0.0.1:9000   # minio only
+    MASTER = local[*]               # local only, the spark master to run on
+    MULTIPART_SIZE = 67108864       # optional per-backend tuning overrides, in bytes
+    CONNECTION_MAXIMUM = 100
+    FAST_UPLOAD = true
+
+    [AWS]
+    KEY = ...
+    SECRET = ...
+
+Each project's storage.py holds its default paths per backend and wraps
+get_storage and main with them. Without a [STORAGE] section the s3
+defaults of the project are used.
+'''
+import configparser
+import subprocess
+import sys
+import time
+
+# the s3a connector, hadoop-aws 2.7 only knows the fs.s3a options set in hadoop_options
+HADOOP_AWS = "org.apache.hadoop:hadoop-aws:2.7.0"
+SIZE_UNITS = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# default tuning for each backend, the keys are the s3a settings they map to
+TUNING = {
+    's3': {
+        'multipart_size': '104857600',
+        'connection_maximum': '100',
+        'fast_upload': 'true',
+    },
+    'minio': {
+        'endpoint': 'http://127.0.0.1:9000',
+        'multipart_size': '33554432',
+        'connection_maximum': '50',
+        'fast_upload': 'true',
+    },
+    'local': {},
+}
+
+
+def byte_size(value):
+    '''
+    a size in bytes, also accepting a K, M or G suffix,
+    hadoop-aws 2.7 only parses plain byte counts
+    '''
+    value = value.strip().upper()
+    if value[-1:] in SIZE_UNITS:
+        return str(int(value[:-1]) * SIZE_UNITS[value[-1]])
+    return str(int(value))
+
+
+def get_storage(config_file, backend=None, paths=None):
+    '''
+    reads the storage settings from the config file
+    and returns a dict with the backend name, the input/output
+    paths, the credentials and the tuning values to apply.
+    paths holds the project's default settings of each backend
+    '''
+    config = configparser.ConfigParser(inline_comment_prefixes=('#',))
+    config.read(config_file)
+
+    section = config['STORAGE'] if config.has_section('STORAGE') else {}
+    backend = (backend or section.get('BACKEND', 's3')).strip().lower()
+    if backend not in TUNING:
+        raise ValueError("Unknown storage backend {}, expected one of {}".format(backend, sorted(TUNING)))
+
+    storage = dict(TUNING[backend], **(paths or {}).get(backend, {}))
+    storage['backend'] = backend
+    # the overrides in [STORAGE] belong to the backend configured there
+    if section.get('BACKEND', backend).strip().lower() == backend:
+        for key in section:
+            if key != 'backend':
+                storage[key] = section[key].strip()
+    if storage.get('multipart_size'):
+        storage['multipart_size'] = byte_size(storage['multipart_size'])
+
+    # credentials are only read here and handed to the hadoop config,
+    # nothing is pushed into the environment
+    if backend != 'local' and config.has_section('AWS'):
+        storage['key'] = config['AWS'].get('KEY')
+        storage['secret'] = config['AWS'].get('SECRET')
+
+    for key in ('input_data', 'output_data'):
+        if not storage[key].endswith('/'):
+            storage[key] += '/'
+    return storage
+
+
+def hadoop_options(storage):
+    '''
+    translates the storage settings into the spark.hadoop.fs.s3a.*
+    options for the chosen backend
+    '''
+    if storage['backend'] == 'local':
+        return {}
+
+    options = {
+        'fs.s3a.impl': 'org.apache.hadoop.fs.s3a.S3AFileSystem',
+        'fs.s3a.multipart.size': storage.get('multipart_size'),
+        'fs.s3a.connection.maximum': storage.get('connection_maximum'),
+        'fs.s3a.fast.upload': storage.get('fast_upload'),
+    }
+    if storage.get('key'):
+        options['fs.s3a.access.key'] = storage['key']
+        options['fs.s3a.secret.key'] = storage['secret']
+    if storage['backend'] == 'minio':
+        options['fs.s3a.endpoint'] = storage['endpoint']
+        options['fs.s3a.path.style.access'] = 'true'
+        options['fs.s3a.connection.ssl.enabled'] = str(storage['endpoint'].startswith('https')).lower()
+
+    return {'spark.hadoop.' + key: value for key, value in options.items() if value is not None}
+
+
+def configure_builder(builder, storage):
+    '''
+    applies the storage backend options to a SparkSession builder,
+    a local backend with a master setting also runs spark on it
+    '''
+    if storage['backend'] == 'local':
+        if storage.get('master'):
+            builder = builder.master(storage['master'])
+    else:
+        builder = builder.config("spark.jars.packages", HADOOP_AWS)
+    for key, value in hadoop_options(storage).items():
+        builder = builder.config(key, value)
+    return builder
+
+
+def path_size(spark, path):
+    '''
+    returns the number of bytes stored under path,
+    using the hadoop filesystem so it works for every backend
+    '''
+    jvm = spark._jvm
+    hadoop_path = jvm.org.apache.hadoop.fs.Path(path)
+    fs = hadoop_path.getFileSystem(spark._jsc.hadoopConfiguration())
+    return fs.getContentSummary(hadoop_path).getLength()
+
+
+def benchmark_throughput(spark, storage, rows=2000000, runs=3):
+    '''
+    writes and reads back a synthetic parquet dataset on the
+    storage backend and prints the read/write MB/s of each run
+    '''
+    from pyspark.sql import functions as F
+
+    path = storage['output_data'] + '_benchmark/throughput'
+    df = spark.range(rows) \
+        .withColumn('payload', F.sha2(F.col('id').cast('string'), 256)) \
+        .withColumn('value', F.rand(seed=42))
+
+    results = []
+    for run in range(1, runs + 1):
+        start = time.time()
+        df.write.mode('overwrite').parquet(path)
+        write_seconds = time.time() - start
+
+        size_mb = path_size(spark, path) / (1024 * 1024)
+
+        start = time.time()
+        spark.read.parquet(path).agg(F.sum('value'), F.count('payload')).collect()
+        read_seconds = time.time() - start
+
+        results.append((size_mb / write_seconds, size_mb / read_seconds))
+        print('{} run {}: {:.1f} MB written at {:.1f} MB/s, read at {:.1f} MB/s'.format(
+            storage['backend'], run, size_mb, results[-1][0], results[-1][1]))
+
+    write_mbs = sorted(r[0] for r in results)[len(results) // 2]
+    read_mbs = sorted(r[1] for r in results)[len(results) // 2]
+    print('{} median: write {:.1f} MB/s, read {:.1f} MB/s'.format(storage['backend'], write_mbs, read_mbs))
+    return {'backend': storage['backend'], 'write_mb_s': write_mbs, 'read_mb_s': read_mbs}
+
+
+def main(config_file, paths):
+    '''
+    runs the throughput benchmark for the backends given on the
+    command line (default: the one configured in config_file).
+    with several backends each one runs in a process of its own,
+    the spark session and its jars are fixed once its JVM is up
+    '''
+    backends = sys.argv[1:]
+    if len(backends) > 1:
+        for backend in backends:
+            subprocess.run([sys.executable, sys.argv[0], backend], check=True)
+        return
+
+    from pyspark.sql import SparkSession
+
+    storage = get_storage(config_file, backends[0] if backends else None, paths)
+    spark = configure_builder(SparkSession.builder, storage).getOrCreate()
+    benchmark_throughput(spark, storage)
+    spark.stop()
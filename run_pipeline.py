@@ -0,0 +1,249 @@
+'''
+Runs the Sparkify projects as one dependency graph of steps.
+
+Every step is a few lines of python run in its project folder, so each
+project keeps its own sql_queries.py, config files and relative paths.
+Steps whose dependencies are done run concurrently, up to --workers.
+The steps that finished are recorded in .pipeline_state.json and --resume
+skips them, so a failed insert does not repeat the COPY before it.
+
+With --migrate the databases are not dropped: the create steps are replaced
+by the migrate.py of their project, which only adds what the schema is
+missing, and the loads skip the rows the tables already hold.
+
+usage: python run_pipeline.py [--workers N] [--resume] [--migrate] [--project NAME ...] [--list]
+'''
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+STATE_FILE = os.path.join(ROOT, '.pipeline_state.json')
+
+# (step, project folder, code run in the folder, dependencies)
+steps = [
+    # DataModelPostgres
+    ('postgres.create_database', 'DataModelPostgres',
+     "import create_tables; cur, conn = create_tables.create_database(); conn.close()", []),
+    ('postgres.create_tables', 'DataModelPostgres',
+     "import create_tables, etl; cur, conn = etl.connect(); "
+     "create_tables.drop_tables(cur, conn); create_tables.create_tables(cur, conn); conn.close()",
+     ['postgres.create_database']),
+    ('postgres.song_data', 'DataModelPostgres',
+     "import etl; cur, conn = etl.connect(); "
+     "etl.process_data(cur, conn, filepath='data/song_data', func=etl.process_song_file); conn.close()",
+     ['postgres.create_tables']),
+    ('postgres.log_data', 'DataModelPostgres',
+     "import etl; cur, conn = etl.connect(); "
+     "etl.process_data(cur, conn, filepath='data/log_data', func=etl.process_log_file); conn.close()",
+     ['postgres.song_data']),
+    ('postgres.rollups', 'DataModelPostgres',
+     "import etl, rollups; cur, conn = etl.connect(); rollups.update_rollups(cur, conn); rollups.update_sessions(cur, conn); "
+     "rollups.refresh_views(cur, conn); conn.close()",
+     ['postgres.log_data']),
+
+    # Cloud Datawarehouse
+    ('redshift.drop_tables', 'Cloud Datawarehouse',
+     "import create_tables, etl; cur, conn = etl.connect(); create_tables.drop_tables(cur, conn); conn.close()", []),
+    ('redshift.create_tables', 'Cloud Datawarehouse',
+     "import create_tables, etl; cur, conn = etl.connect(); create_tables.create_tables(cur, conn); conn.close()",
+     ['redshift.drop_tables']),
+    ('redshift.stage_events', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.staging_events_truncate); cur.execute(sql_queries.staging_events_copy); conn.commit(); conn.close()",
+     ['redshift.create_tables']),
+    ('redshift.stage_songs', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.staging_songs_truncate); cur.execute(sql_queries.staging_songs_copy); conn.commit(); conn.close()",
+     ['redshift.create_tables']),
+    ('redshift.location', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.location_table_insert); conn.commit(); conn.close()",
+     ['redshift.stage_events']),
+    ('redshift.user_agent', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.user_agent_table_insert); conn.commit(); conn.close()",
+     ['redshift.stage_events']),
+    ('redshift.songplay', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.songplay_table_insert); conn.commit(); conn.close()",
+     ['redshift.stage_events', 'redshift.stage_songs', 'redshift.location', 'redshift.user_agent']),
+    ('redshift.users', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.user_table_delete); cur.execute(sql_queries.user_table_insert); conn.commit(); conn.close()",
+     ['redshift.stage_events']),
+    ('redshift.song', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.song_table_insert); conn.commit(); conn.close()",
+     ['redshift.stage_songs']),
+    ('redshift.artist', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.artist_table_insert); conn.commit(); conn.close()",
+     ['redshift.stage_songs']),
+    ('redshift.time', 'Cloud Datawarehouse',
+     "import etl, sql_queries; cur, conn = etl.connect(); cur.execute(sql_queries.time_table_insert); conn.commit(); conn.close()",
+     ['redshift.songplay']),
+    ('redshift.rollups', 'Cloud Datawarehouse',
+     "import etl, rollups; cur, conn = etl.connect(); rollups.update_rollups(cur, conn); rollups.refresh_views(cur, conn); conn.close()",
+     ['redshift.songplay', 'redshift.song', 'redshift.artist']),
+
+    # Data Lakes & Spark
+    ('lake.song_data', 'Data Lakes & Spark',
+     "import etl; storage = etl.get_storage('dl.cfg'); spark = etl.create_spark_session(storage); "
+     "etl.process_song_data(spark, storage['input_data'], storage['output_data'])", []),
+    ('lake.log_data', 'Data Lakes & Spark',
+     "import etl; storage = etl.get_storage('dl.cfg'); spark = etl.create_spark_session(storage); "
+     "etl.process_log_data(spark, storage['input_data'], storage['output_data'])",
+     ['lake.song_data']),
+]
+
+# with --migrate: step -> code that replaces it, None removes the step
+migrate_steps = {
+    'postgres.create_database': None,
+    'postgres.create_tables': "import migrate, etl; migrate.ensure_database(); cur, conn = etl.connect(); "
+                              "migrate.migrate(cur, conn); conn.close()",
+    'redshift.drop_tables': None,
+    'redshift.create_tables': "import migrate, etl; cur, conn = etl.connect(); migrate.migrate(cur, conn); conn.close()",
+}
+
+
+def load_state():
+    if os.path.exists(STATE_FILE):
+        with open(STATE_FILE) as f:
+            return json.load(f)
+    return {'done': {}}
+
+
+def save_state(state):
+    with open(STATE_FILE, 'w') as f:
+        json.dump(state, f, indent=2)
+
+
+def select_steps(projects, migrate=False):
+    '''
+    returns the steps of the chosen projects (step name prefix), all of them by default,
+    with the create steps replaced by the migrations when migrate is set
+    '''
+    selected = [s for s in steps if not projects or s[0].split('.')[0] in projects]
+    if migrate:
+        removed = {name for name, code in migrate_steps.items() if code is None}
+        selected = [(name, folder, migrate_steps.get(name, code), [d for d in deps if d not in removed])
+                    for name, folder, code, deps in selected if name not in removed]
+    return selected
+
+
+def run_step(step):
+    '''
+    runs one step in its project folder and returns (returncode, output, seconds)
+    '''
+    name, folder, code, deps = step
+    start = time.time()
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.join(ROOT, folder),
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return result.returncode, result.stdout, time.time() - start
+
+
+def run(selected, workers, resume):
+    '''
+    runs the selected steps as a dependency graph with `workers` steps at a time.
+    returns the durations of the steps that ran and whether all of them succeeded
+    '''
+    state = load_state() if resume else {'done': {}}
+    names = {s[0] for s in selected}
+    done = {name for name in state['done'] if name in names}
+    durations = {name: 0.0 for name in done}
+    pending = [s for s in selected if s[0] not in done]
+    failed = False
+    for name in sorted(done):
+        print('{} already done, skipped'.format(name))
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        running = {}
+        while pending or running:
+            if not failed:
+                for step in [s for s in pending if all(d in done or d not in names for d in s[3])]:
+                    if len(running) >= workers:
+                        break
+                    pending.remove(step)
+                    print('{} started'.format(step[0]))
+                    running[pool.submit(run_step, step)] = step
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                returncode, output, seconds = future.result()
+                for line in output.splitlines():
+                    print('[{}] {}'.format(step[0], line))
+                if returncode == 0:
+                    done.add(step[0])
+                    durations[step[0]] = seconds
+                    state['done'][step[0]] = {'seconds': seconds, 'finished': time.strftime('%Y-%m-%d %H:%M:%S')}
+                    save_state(state)
+                    print('{} done in {:.1f}s'.format(step[0], seconds))
+                else:
+                    failed = True
+                    print('{} FAILED after {:.1f}s, rerun with --resume to continue from here'.format(step[0], seconds))
+
+    return durations, not failed and not pending
+
+
+def critical_path(selected, durations):
+    '''
+    returns the total time and the chain of steps of the longest path through the graph
+    '''
+    finish = {}
+    previous = {}
+    for name, folder, code, deps in selected:
+        if name not in durations:
+            continue
+        deps = [d for d in deps if d in finish]
+        slowest = max(deps, key=lambda d: finish[d], default=None)
+        finish[name] = durations.get(name, 0.0) + (finish[slowest] if slowest else 0.0)
+        previous[name] = slowest
+
+    if not finish:
+        return 0.0, []
+    last = max(finish, key=finish.get)
+    path = []
+    while last:
+        path.append(last)
+        last = previous[last]
+    return finish[path[0]], path[::-1]
+
+
+def print_report(selected, durations, wall_seconds):
+    print('\nStep timings')
+    for name, folder, code, deps in selected:
+        if name in durations:
+            print('  {:<28} {:>8.1f}s'.format(name, durations[name]))
+    total, path = critical_path(selected, durations)
+    print('Critical path ({:.1f}s of {:.1f}s wall time, {:.1f}s of work):'.format(
+        total, wall_seconds, sum(durations.values())))
+    for name in path:
+        print('  {:<28} {:>8.1f}s'.format(name, durations.get(name, 0.0)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the Sparkify pipelines as a dependency graph')
+    parser.add_argument('--workers', type=int, default=4, help='steps run at the same time')
+    parser.add_argument('--resume', action='store_true', help='skip the steps that finished in the last run')
+    parser.add_argument('--migrate', action='store_true', help='migrate the schemas instead of dropping the tables')
+    parser.add_argument('--project', nargs='*', default=[], help='postgres, redshift and/or lake')
+    parser.add_argument('--list', action='store_true', help='print the steps and their dependencies')
+    args = parser.parse_args()
+
+    selected = select_steps(args.project, args.migrate)
+    if args.list:
+        for name, folder, code, deps in selected:
+            print('{:<28} <- {}'.format(name, ', '.join(deps) or '-'))
+        return
+
+    start = time.time()
+    durations, ok = run(selected, args.workers, args.resume)
+    print_report(selected, durations, time.time() - start)
+    if not ok:
+        sys.exit(1)
+    if os.path.exists(STATE_FILE):
+        os.remove(STATE_FILE)
+
+
+if __name__ == "__main__":
+    main()